@@ -12,6 +12,9 @@ python manage.py migrate
 echo "Collecting static files..."
 python manage.py collectstatic --noinput
 
+# Drop the metric files of the previous run (see tickets/metrics.py)
+rm -rf "${METRICS_DIR:-/tmp/tms-metrics}"
+
 # Start the application
 echo "Starting Django application..."
 exec gunicorn --bind 0.0.0.0:8000 --workers 1 tms.wsgi:application 
\ No newline at end of file
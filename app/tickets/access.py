@@ -0,0 +1,91 @@
+"""
+Per-request access context.
+
+The user's profile and role are loaded once per request with a single joined
+query and exposed as an immutable AccessContext on request.access. The loaded
+UserMeta (with its role) is also cached on request.user, so code that still
+follows request.user.user_meta.role does not query again.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+from django.contrib.auth.models import User
+
+from .models import Role, UserMeta
+
+STAFF_ROLES = frozenset(['admin', 'support_agent'])
+
+
+@dataclass(frozen=True)
+class AccessContext:
+    """What the access checks need to know about the current user"""
+    is_authenticated: bool = False
+    user_id: Optional[int] = None
+    role: Optional[str] = None
+    role_id: Optional[int] = None
+    has_profile: bool = False
+    is_profile_completed: bool = False
+    permissions: int = 0
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
+    @property
+    def is_support_agent(self):
+        return self.role == 'support_agent'
+
+    @property
+    def is_staff_role(self):
+        """Admins and support agents, who must work in the admin interface"""
+        return self.role in STAFF_ROLES
+
+    @property
+    def is_customer(self):
+        return self.is_authenticated and not self.is_staff_role
+
+    def has_permissions(self, *permissions, require_all=True):
+        """Checks role permissions against the compiled bitmask (see Role.has_permissions)"""
+        required = Role.mask_for(permissions)
+        if not required:
+            return False
+        granted = self.permissions & required
+        return granted == required if require_all else bool(granted)
+
+
+ANONYMOUS = AccessContext()
+
+
+def resolve_access(user):
+    """Builds the AccessContext for a user with one query.
+
+    The UserMeta row is cached on the user object (None when missing) so later
+    user.user_meta / user.user_meta.role lookups are free.
+    """
+    if not user.is_authenticated:
+        return ANONYMOUS
+
+    meta = UserMeta.objects.select_related('role').filter(user_id=user.pk).first()
+    User.user_meta.related.set_cached_value(user, meta)
+    if meta is None:
+        return AccessContext(is_authenticated=True, user_id=user.pk)
+
+    UserMeta.user.field.set_cached_value(meta, user)
+    return AccessContext(
+        is_authenticated=True,
+        user_id=user.pk,
+        role=meta.role.name.lower() if meta.role else None,
+        role_id=meta.role_id,
+        has_profile=True,
+        is_profile_completed=meta.is_profile_completed,
+        permissions=meta.role.permission_mask if meta.role else 0,
+    )
+
+
+def get_access(request):
+    """Returns request.access, resolving it on first use"""
+    access = getattr(request, 'access', None)
+    if access is None or access.user_id != getattr(request.user, 'pk', None):
+        access = resolve_access(request.user)
+        request.access = access
+    return access
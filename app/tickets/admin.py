@@ -1,14 +1,26 @@
-from django.contrib import admin
+import logging
+
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils.html import format_html
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models import Count, Max, Q, Sum
 from django import forms
 
 from .models import (
     Role, UserMeta, Ticket, TicketCategory, 
-    TicketResponse, TicketAction, Media, FAQKnowledgeBase
+    TicketResponse, TicketAction, Media, FAQKnowledgeBase, SlowQuery
 )
 from .admin_mixins import SupportAgentAdminMixin
+from . import assignment, bulk_actions, queue, sampling_profiler, search, permission_cache, thumbnails
+from .concurrency import TicketConflict, save_ticket
+
+logger = logging.getLogger(__name__)
 
 # Define inline admin for UserMeta
 class UserMetaInline(admin.StackedInline):
@@ -22,6 +34,7 @@ class CustomUserAdmin(BaseUserAdmin):
     inlines = [UserMetaInline]
     list_display = ['username', 'email', 'get_role', 'is_staff', 'is_active']
     list_filter = ['is_staff', 'is_active', 'user_meta__role']
+    list_select_related = ['user_meta__role']
     
     def get_role(self, obj):
         try:
@@ -48,14 +61,7 @@ class CustomUserAdmin(BaseUserAdmin):
             return True
             
         # Check for admin role
-        try:
-            role = request.user.user_meta.role.name.lower()
-            if role == 'admin':
-                return True
-        except:
-            pass
-            
-        return False
+        return permission_cache.get(request.user).is_admin
 
 # Re-register UserAdmin
 admin.site.unregister(User)
@@ -66,7 +72,12 @@ class TicketResponseInline(admin.TabularInline):
     model = TicketResponse
     extra = 0
     fields = ['user', 'message', 'created_at']
-    readonly_fields = ['created_at']
+    # Shown rather than edited: a select would list every user, a raw id widget costs a query per row.
+    # New responses are written as the admin user (see TicketAdmin.save_formset)
+    readonly_fields = ['user', 'created_at']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('ticket', 'user')
 
 # Ticket Action Inline
 class TicketActionInline(admin.TabularInline):
@@ -97,6 +108,18 @@ class TicketActionInline(admin.TabularInline):
 class MediaInline(admin.TabularInline):
     model = Media
     extra = 0
+    # Read-only for the same reason as TicketResponseInline.user
+    readonly_fields = ['preview', 'response', 'user']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('response__ticket', 'response__user', 'user')
+    
+    def preview(self, obj):
+        if not obj.pk or not obj.is_image:
+            return '-'
+        return format_html('<a href="{}" target="_blank"><img src="{}" alt="" style="max-height: 80px;" loading="lazy"></a>',
+                           obj.file.url, thumbnails.url(obj, 'small'))
+    preview.short_description = 'Preview'
 
 # Role Admin
 @admin.register(Role)
@@ -164,19 +187,60 @@ class TicketCategoryAdmin(admin.ModelAdmin):
     list_display = ['name', 'description']
     search_fields = ['name']
 
+class TicketAdminForm(forms.ModelForm):
+    """Ticket change form that remembers the version it was rendered from"""
+    # Not named version: the admin refuses non-editable model fields in its fieldsets
+    expected_version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+
+    class Meta:
+        model = Ticket
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.fields['expected_version'].initial = self.instance.version
+
+    def clean(self):
+        cleaned_data = super().clean()
+        version = cleaned_data.get('expected_version')
+        # The instance was just loaded, so it carries the stored version
+        if self.instance.pk and version is not None and version != self.instance.version:
+            raise forms.ValidationError(
+                "This ticket was changed by someone else while you were editing it. "
+                "Reload the page to see the latest version before saving again."
+            )
+        return cleaned_data
+
+class BulkTargetForm(forms.Form):
+    """Target of a bulk ticket action, picked on the action's intermediate page"""
+    target = forms.ModelChoiceField(queryset=None, empty_label=None, widget=forms.Select(attrs={'class': 'form-control'}))
+
+    def __init__(self, *args, targets, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['target'].queryset = targets
+
 # Ticket Admin
 @admin.register(Ticket)
 class TicketAdmin(SupportAgentAdminMixin, admin.ModelAdmin):
+    form = TicketAdminForm
     list_display = ['id', 'title', 'user', 'status', 'priority', 'assigned_to', 'created_at']
     list_filter = ['status', 'priority', 'category', 'created_at']
     search_fields = ['id', 'title', 'description', 'user__username']
     readonly_fields = ['created_at', 'updated_at']
     list_editable = ['status', 'assigned_to']
+    raw_id_fields = ['user']
+    # assigned_to is nullable, so the admin would not join it by itself
+    list_select_related = ['user', 'assigned_to', 'category']
+    # Newest first, served by ticket_recent_idx / ticket_status_recent_idx
+    ordering = ['-created_at', '-id']
     inlines = [TicketResponseInline, TicketActionInline, MediaInline]
-    actions = ['mark_as_resolved', 'assign_to_support']
+    actions = ['mark_as_resolved', 'mark_as_closed', 'assign_to_support', 'move_to_category', 'reassign_to_agent',
+               'claim_next_selected']
     fieldsets = [
         ('Basic Information', {
-            'fields': ('user', 'title', 'description')
+            # Hidden input; without it the change form could not detect stale edits
+            'fields': ('user', 'title', 'description', 'expected_version')
         }),
         ('Status and Assignment', {
             'fields': ('status', 'priority', 'category', 'assigned_to')
@@ -195,20 +259,49 @@ class TicketAdmin(SupportAgentAdminMixin, admin.ModelAdmin):
                 kwargs["queryset"] = User.objects.filter(user_meta__role=support_role)
             else:
                 kwargs["queryset"] = User.objects.filter(is_staff=True)
+            field = super().formfield_for_foreignkey(db_field, request, **kwargs)
+            # Load the agents once; a queryset would be re-run for every row of the changelist form
+            field.choices = list(field.choices)
+            return field
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
     
+    def get_search_results(self, request, queryset, search_term):
+        # Use the full-text index instead of LIKE scans over search_fields; requester
+        # names match by prefix, which the username index can serve
+        if not search_term:
+            return queryset, False
+        ticket_ids = search.search_tickets(search_term, queryset)
+        return queryset.filter(Q(id__in=ticket_ids) | Q(user__username__istartswith=search_term)), False
+    
     def save_formset(self, request, form, formset, change):
         instances = formset.save(commit=False)
         for instance in instances:
             # Check if this is a TicketAction instance and set performed_by
             if isinstance(instance, TicketAction) and not instance.performed_by_id:
                 instance.performed_by = request.user
+            # Responses and files added from the admin are the admin user's
+            if isinstance(instance, (TicketResponse, Media)) and not instance.user_id:
+                instance.user = request.user
             instance.save()
         formset.save_m2m()
         
     def save_model(self, request, obj, form, change):
+        if not change:
+            super().save_model(request, obj, form, change)
+            return
+        
+        # Write only the changed columns, and only if the ticket is still at the
+        # version the form was rendered from (the changelist has no version field
+        # and checks against the version loaded with the POST). The form's clean()
+        # already rejected stale versions; a TicketConflict here means the ticket
+        # changed since then, and it rolls back the whole save (see changeform_view).
+        fields = [name for name in form.changed_data if name != 'expected_version']
+        if fields:
+            expected = form.cleaned_data.get('expected_version')
+            save_ticket(obj, fields, obj.version if expected is None else expected)
+        
         # Track status changes with ticket actions
-        if change and form.has_changed() and 'status' in form.changed_data:
+        if form.has_changed() and 'status' in form.changed_data:
             try:
                 TicketAction.objects.create(
                     ticket=obj,
@@ -216,12 +309,12 @@ class TicketAdmin(SupportAgentAdminMixin, admin.ModelAdmin):
                     action_type='status_change',
                     notes=f"Status changed to {obj.get_status_display()}"
                 )
-            except Exception as e:
+            except Exception:
                 # Log the error but continue saving
-                print(f"Error creating status change action: {e}")
+                logger.exception("Could not record the status change of ticket %s", obj.pk)
                 
         # Track assignment changes
-        if change and form.has_changed() and 'assigned_to' in form.changed_data:
+        if form.has_changed() and 'assigned_to' in form.changed_data:
             try:
                 TicketAction.objects.create(
                     ticket=obj,
@@ -229,36 +322,160 @@ class TicketAdmin(SupportAgentAdminMixin, admin.ModelAdmin):
                     action_type='assign',
                     notes=f"Ticket assigned to {obj.assigned_to.username if obj.assigned_to else 'nobody'}"
                 )
-            except Exception as e:
+            except Exception:
                 # Log the error but continue saving
-                print(f"Error creating assignment action: {e}")
-        
-        super().save_model(request, obj, form, change)
+                logger.exception("Could not record the reassignment of ticket %s", obj.pk)
+    
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        # The admin saves inside a transaction, so by now nothing of the change was kept
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except TicketConflict as conflict:
+            self.message_conflict(request, conflict)
+            return redirect(request.get_full_path())
+    
+    def message_conflict(self, request, conflict):
+        self.message_user(
+            request,
+            f"Ticket #{conflict.ticket.pk} was changed by someone else in the meantime; nothing was saved. "
+            f"Review the latest version and make your changes again.",
+            level=messages.ERROR,
+        )
         
     def assign_to_support(self, request, queryset):
-        # Implementation for bulk assignment
-        for ticket in queryset:
-            # Logic to assign to a support agent
-            pass
+        # Spread the unassigned tickets over the least-loaded support agents
+        try:
+            assigned, skipped = assignment.assign_tickets(queryset, performed_by=request.user)
+        except ValueError as e:
+            self.message_user(request, str(e), level=messages.ERROR)
+            return
+        message = f"{assigned} tickets have been assigned to support agents."
+        if skipped:
+            message += f" {skipped} already assigned tickets were left unchanged."
+        self.message_user(request, message)
             
     assign_to_support.short_description = "Assign selected tickets to support agent"
     
+    def get_urls(self):
+        urls = [
+            path('claim-next/', self.admin_site.admin_view(self.claim_next_view), name='tickets_ticket_claim_next'),
+        ]
+        return urls + super().get_urls()
+    
+    def can_claim_tickets(self, request):
+        """Support agents and admins can take tickets from the work queue"""
+        cached = permission_cache.get(request.user)
+        return request.user.is_superuser or cached.is_support_agent or cached.is_admin
+    
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {**(extra_context or {}), 'can_claim_tickets': self.can_claim_tickets(request)}
+        # Inline edits of the list are saved in one transaction; a conflict on any row undoes them all
+        try:
+            return super().changelist_view(request, extra_context)
+        except TicketConflict as conflict:
+            self.message_conflict(request, conflict)
+            return redirect(request.get_full_path())
+    
+    def claim_next_view(self, request):
+        # Atomically take the most urgent, oldest unassigned ticket
+        if request.method != 'POST' or not self.can_claim_tickets(request):
+            raise PermissionDenied
+        ticket = queue.claim_next(request.user)
+        if ticket is None:
+            self.message_user(request, "The queue is empty: there are no unassigned pending tickets.", level=messages.WARNING)
+            return redirect('admin:tickets_ticket_changelist')
+        self.message_user(request, f"Ticket {ticket.ticket_id} is now assigned to you.")
+        return redirect('admin:tickets_ticket_change', ticket.pk)
+    
+    def claim_next_selected(self, request, queryset):
+        # Claim the next queued ticket among the selection. A support agent's
+        # changelist queryset holds only their own tickets, none of them queued,
+        # so take the candidates from the selected ids instead
+        if not self.can_claim_tickets(request):
+            self.message_user(request, "Only support agents can claim tickets.", level=messages.ERROR)
+            return
+        if request.POST.get('select_across') != '1':
+            selected = request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME)
+            queryset = Ticket.objects.filter(pk__in=selected)
+        ticket = queue.claim_next(request.user, queryset)
+        if ticket is None:
+            self.message_user(request, "None of the selected tickets is waiting in the queue.", level=messages.WARNING)
+            return
+        self.message_user(request, f"Ticket {ticket.ticket_id} is now assigned to you.")
+        return redirect('admin:tickets_ticket_change', ticket.pk)
+    claim_next_selected.short_description = "Claim the next queued ticket among the selected"
+    
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        if not actions or not self.has_change_permission(request):
+            return actions
+        
+        # One action per priority, so "select all" works without an intermediate form
+        for value, label in Ticket.PRIORITY_CHOICES:
+            self._add_bulk_action(actions, f'set_priority_{value}', f'Set priority to {label}',
+                                  {'priority': value, 'priority_rank': Ticket.PRIORITY_RANKS[value]},
+                                  'update', f'Priority changed to {label}')
+        return actions
+    
+    def _add_bulk_action(self, actions, name, description, fields, action_type, notes):
+        def action(modeladmin, request, queryset):
+            modeladmin.run_bulk_update(request, queryset, fields, action_type, f'{notes} (bulk action)')
+        actions[name] = (action, name, description)
+    
+    def move_to_category(self, request, queryset):
+        def change(category):
+            return {'category_id': category.pk}, 'update', f'Category changed to {category.name}'
+        return self.bulk_target_view(request, queryset, 'move_to_category', 'Move tickets to category',
+                                     TicketCategory.objects.order_by('name'), change)
+    move_to_category.short_description = "Move selected tickets to category…"
+    move_to_category.allowed_permissions = ('change',)
+    
+    def reassign_to_agent(self, request, queryset):
+        def change(agent):
+            return {'assigned_to_id': agent.pk}, 'assign', f'Ticket assigned to {agent.username}'
+        return self.bulk_target_view(request, queryset, 'reassign_to_agent', 'Reassign tickets',
+                                     assignment.support_agents().order_by('username'), change)
+    reassign_to_agent.short_description = "Reassign selected tickets to…"
+    reassign_to_agent.allowed_permissions = ('change',)
+    
+    def bulk_target_view(self, request, queryset, action, title, targets, change):
+        # Asks for the target on an intermediate page (like delete_selected), so the
+        # changelist does not load every category and agent into its action list
+        form = BulkTargetForm(request.POST if 'apply' in request.POST else None, targets=targets)
+        if form.is_valid():
+            fields, action_type, notes = change(form.cleaned_data['target'])
+            self.run_bulk_update(request, queryset, fields, action_type, f'{notes} (bulk action)')
+            return None
+        context = {
+            **self.admin_site.each_context(request),
+            'title': title,
+            'opts': self.model._meta,
+            'form': form,
+            'action': action,
+            'ticket_count': queryset.count(),
+            'select_across': request.POST.get('select_across', '0'),
+            'selected': request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME),
+            'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+        }
+        return TemplateResponse(request, 'admin/tickets/ticket/bulk_target.html', context)
+    
+    def run_bulk_update(self, request, queryset, fields, action_type, notes):
+        # Chunked by primary key, one UPDATE and one bulk insert of actions per chunk
+        result = bulk_actions.bulk_update(queryset, fields, action_type, notes, performed_by=request.user)
+        message = f"{result.updated} tickets updated"
+        if result.unchanged:
+            message += f", {result.unchanged} were already up to date"
+        self.message_user(request, message + '.')
+    
     def mark_as_resolved(self, request, queryset):
-        updated = queryset.update(status='resolved')
-        # Create ticket actions for bulk resolution
-        for ticket in queryset:
-            try:
-                TicketAction.objects.create(
-                    ticket=ticket,
-                    performed_by=request.user,
-                    action_type='status_change',
-                    notes="Ticket marked as resolved (bulk action)"
-                )
-            except Exception as e:
-                # Log error but continue
-                print(f"Error creating bulk resolve action: {e}")
-                
-        self.message_user(request, f"{updated} tickets have been marked as resolved.")
+        self.run_bulk_update(request, queryset, {'status': 'resolved'}, 'status_change',
+                             'Ticket marked as resolved (bulk action)')
+    mark_as_resolved.short_description = "Mark selected tickets as resolved"
+    
+    def mark_as_closed(self, request, queryset):
+        self.run_bulk_update(request, queryset, {'status': 'closed'}, 'status_change',
+                             'Ticket marked as closed (bulk action)')
+    mark_as_closed.short_description = "Mark selected tickets as closed"
 
 # TicketResponse Admin
 @admin.register(TicketResponse)
@@ -267,11 +484,20 @@ class TicketResponseAdmin(SupportAgentAdminMixin, admin.ModelAdmin):
     list_filter = ['created_at', 'user']
     search_fields = ['message', 'ticket__title']
     readonly_fields = ['created_at', 'updated_at']
+    
+    def get_search_results(self, request, queryset, search_term):
+        # Use the full-text index instead of LIKE scans over search_fields
+        if not search_term:
+            return queryset, False
+        response_ids = search.search_responses(search_term, queryset)
+        ticket_ids = search.search_tickets(search_term, Ticket.objects.all())
+        return queryset.filter(Q(id__in=response_ids) | Q(ticket_id__in=ticket_ids)), False
 
 # TicketAction Admin
 @admin.register(TicketAction)
 class TicketActionAdmin(SupportAgentAdminMixin, admin.ModelAdmin):
     list_display = ['ticket', 'performed_by', 'action_type', 'action_taken', 'created_at']
+    list_select_related = ['ticket', 'performed_by']
     list_filter = ['action_type', 'created_at', 'performed_by']
     search_fields = ['notes', 'action_taken', 'resolution_summary', 'ticket__title']
     readonly_fields = ['created_at', 'updated_at']
@@ -297,10 +523,11 @@ class TicketActionAdmin(SupportAgentAdminMixin, admin.ModelAdmin):
 # Media Admin
 @admin.register(Media)
 class MediaAdmin(admin.ModelAdmin):
-    list_display = ['file', 'ticket', 'user', 'uploaded_at']
+    list_display = ['display_name', 'file_type', 'ticket', 'user', 'uploaded_at']
+    list_select_related = ['ticket', 'user']
     list_filter = ['uploaded_at', 'user']
-    search_fields = ['file', 'ticket__title', 'user__username']
-    readonly_fields = ['uploaded_at']
+    search_fields = ['original_name', 'file', 'ticket__title', 'user__username']
+    readonly_fields = ['original_name', 'file_type', 'uploaded_at']
 
 # FAQ/KnowledgeBase Admin
 @admin.register(FAQKnowledgeBase)
@@ -309,3 +536,83 @@ class FAQKnowledgeBaseAdmin(admin.ModelAdmin):
     list_filter = ['category', 'is_published']
     search_fields = ['question', 'answer']
     list_editable = ['is_published', 'order', 'category']
+    # Matches faq_order_idx; ending on the primary key keeps the admin from adding a sort of its own
+    ordering = ['category', 'order', 'question', 'id']
+
+# Slow query log (written by tickets.slow_queries, never edited by hand)
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ['recorded_at', 'duration_ms', 'view_name', 'short_sql']
+    list_filter = ['view_name', 'database']
+    ordering = ['-recorded_at', '-id']
+    readonly_fields = ['recorded_at', 'duration_ms', 'view_name', 'database', 'fingerprint',
+                       'normalized_sql', 'sql', 'stack', 'explain']
+    fields = readonly_fields
+    # Query groups shown above the list, slowest in total first
+    groups_shown = 25
+
+    def short_sql(self, obj):
+        return obj.normalized_sql[:120]
+    short_sql.short_description = 'Query'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def fingerprint_groups(self):
+        """The most expensive queries by total time, repeats of one query counted together"""
+        groups = list(
+            SlowQuery.objects.order_by()
+            .values('fingerprint')
+            .annotate(count=Count('id'), total_ms=Sum('duration_ms'), max_ms=Max('duration_ms'),
+                      last_seen=Max('recorded_at'), latest_id=Max('id'))
+            .order_by('-total_ms')[:self.groups_shown]
+        )
+        latest = SlowQuery.objects.only('normalized_sql', 'view_name').in_bulk([group['latest_id'] for group in groups])
+        for group in groups:
+            group['normalized_sql'] = latest[group['latest_id']].normalized_sql
+            group['view_name'] = latest[group['latest_id']].view_name
+            group['average_ms'] = group['total_ms'] / group['count']
+        return groups
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {
+            **(extra_context or {}),
+            'fingerprint_groups': self.fingerprint_groups(),
+            'can_profile': request.user.is_superuser,
+        }
+        return super().changelist_view(request, extra_context)
+
+    def get_urls(self):
+        urls = [
+            path('profiles/', self.admin_site.admin_view(self.profiles_view), name='tickets_slowquery_profiles'),
+            path('profiles/<str:name>/', self.admin_site.admin_view(self.profile_download_view),
+                 name='tickets_slowquery_profile_download'),
+        ]
+        return urls + super().get_urls()
+
+    def profiles_view(self, request):
+        # Request profiles written by the sampling profiler, for superusers only
+        if not request.user.is_superuser:
+            raise PermissionDenied
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Request profiles',
+            'opts': self.model._meta,
+            'profiles': sampling_profiler.list_profiles(),
+            'token': sampling_profiler.make_token(request.user),
+            'query_parameter': sampling_profiler.QUERY_PARAMETER,
+            'header': sampling_profiler.HEADER,
+            'token_hours': sampling_profiler.TOKEN_MAX_AGE // 3600,
+        }
+        return TemplateResponse(request, 'admin/tickets/slowquery/profiles.html', context)
+
+    def profile_download_view(self, request, name):
+        if not request.user.is_superuser:
+            raise PermissionDenied
+        path = sampling_profiler.profile_path(name)
+        if path is None:
+            raise Http404
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=name, content_type='text/plain')
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.db.models import Q
 
+from . import permission_cache
+
 class SupportAgentAdminMixin:
     """
     Admin mixin to restrict what support agents can see in the admin panel
@@ -18,8 +20,7 @@ class SupportAgentAdminMixin:
             
         # Check if this is a support agent
         try:
-            role = request.user.user_meta.role
-            if role and role.name.lower() == 'support_agent':
+            if permission_cache.get(request.user).is_support_agent:
                 # For tickets, show only tickets assigned to this agent
                 if hasattr(self, 'model') and hasattr(self.model, 'assigned_to'):
                     return qs.filter(assigned_to=request.user)
@@ -61,18 +62,14 @@ class SupportAgentAdminMixin:
             return super().has_change_permission(request, obj)
             
         # Check if this is a support agent
-        try:
-            role = request.user.user_meta.role
-            if role and role.name.lower() == 'support_agent':
-                # Support agents cannot edit tickets
-                if hasattr(obj, 'assigned_to'):
-                    return False
-                    
-                # For ticket responses, they can only add new ones but not edit
-                if hasattr(obj, 'user'):
-                    return False
-        except Exception:
-            pass
+        if permission_cache.get(request.user).is_support_agent:
+            # Support agents cannot edit tickets
+            if hasattr(obj, 'assigned_to'):
+                return False
+                
+            # For ticket responses, they can only add new ones but not edit
+            if hasattr(obj, 'user'):
+                return False
             
         return super().has_change_permission(request, obj)
         
@@ -85,15 +82,11 @@ class SupportAgentAdminMixin:
             return True
             
         # Check if this is a support agent
-        try:
-            role = request.user.user_meta.role
-            if role and role.name.lower() == 'support_agent':
-                # Allow adding responses only
-                if hasattr(self, 'model') and self.model.__name__ == 'TicketResponse':
-                    return True
-                return False
-        except Exception:
-            pass
+        if permission_cache.get(request.user).is_support_agent:
+            # Allow adding responses only
+            if hasattr(self, 'model') and self.model.__name__ == 'TicketResponse':
+                return True
+            return False
             
         return super().has_add_permission(request)
         
@@ -102,11 +95,7 @@ class SupportAgentAdminMixin:
         Support agents cannot delete any data
         """
         # By default, support agents cannot delete anything
-        try:
-            role = request.user.user_meta.role
-            if role and role.name.lower() == 'support_agent':
-                return False
-        except Exception:
-            pass
+        if permission_cache.get(request.user).is_support_agent:
+            return False
             
         return super().has_delete_permission(request, obj)
@@ -0,0 +1,129 @@
+"""
+Least-loaded assignment of tickets to support agents.
+
+An agent's load is their number of open (pending or in progress) tickets,
+read from the maintained per-agent status counters in one query. Tickets go
+to the least-loaded active support agent, round-robin between agents with
+equal load. Bulk assignment runs in batches, each in its own transaction with
+one UPDATE per agent and one bulk insert of 'assign' actions.
+"""
+import heapq
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import counters
+from .models import Role, Ticket, TicketAction, TicketStatusCounter
+
+BATCH_SIZE = 500
+OPEN_STATUSES = ('pending', 'in_progress')
+
+
+def support_agents():
+    """Active users with the support agent role, in no particular order.
+
+    Filtering on the role ids lets the database start from the role's
+    user_meta rows instead of walking the users table; callers sort the
+    handful of agents themselves rather than have the database sort them.
+    Role names compare case-insensitively, as in the permission sync.
+    """
+    roles = Role.objects.filter(name__iexact='support_agent').values('id')
+    return User.objects.filter(is_active=True, user_meta__role__in=roles).order_by()
+
+
+class AgentLoadIndex:
+    """Min-heap of eligible agents keyed on (open tickets, round-robin sequence)"""
+
+    def __init__(self, agents):
+        # agents is a list of (user id, username) in a stable order
+        self.usernames = dict(agents)
+        keys = [counters.agent_key(pk) for pk, _ in agents]
+        loads = {
+            key: pending + in_progress
+            for key, pending, in_progress in TicketStatusCounter.objects.filter(key__in=keys)
+            .values_list('key', 'pending', 'in_progress')
+        }
+        self.heap = [
+            (loads.get(counters.agent_key(pk), 0), sequence, pk)
+            for sequence, (pk, _) in enumerate(agents)
+        ]
+        heapq.heapify(self.heap)
+        self.sequence = len(self.heap)
+
+    @classmethod
+    def for_support_agents(cls):
+        return cls(sorted(support_agents().values_list('id', 'username')))
+
+    def __bool__(self):
+        return bool(self.heap)
+
+    def take(self, opens_ticket=True):
+        """Returns the id of the least-loaded agent and charges them one ticket"""
+        load, _, pk = heapq.heappop(self.heap)
+        # A fresh sequence number sends the agent behind everyone else on the same load
+        heapq.heappush(self.heap, (load + (1 if opens_ticket else 0), self.sequence, pk))
+        self.sequence += 1
+        return pk
+
+
+def _assign_rows(rows, index, performed_by):
+    """Assigns (id, status) rows in one transaction; returns the number assigned"""
+    with transaction.atomic():
+        # Lock the batch and keep only tickets that are still unassigned, so
+        # concurrent runs or re-runs never reassign a ticket
+        still_unassigned = set(
+            Ticket.objects.select_for_update()
+            .filter(pk__in=[pk for pk, _ in rows], assigned_to__isnull=True)
+            .values_list('pk', flat=True)
+        )
+        by_agent = {}
+        actions = []
+        for pk, status in rows:
+            if pk not in still_unassigned:
+                continue
+            agent_id = index.take(opens_ticket=status in OPEN_STATUSES)
+            by_agent.setdefault(agent_id, []).append(pk)
+            actions.append(TicketAction(
+                ticket_id=pk, performed_by=performed_by, action_type='assign',
+                notes=f"Ticket assigned to {index.usernames[agent_id]}"
+            ))
+
+        for agent_id, ids in by_agent.items():
+            counters.update_tickets(Ticket.objects.filter(pk__in=ids), assigned_to_id=agent_id)
+        TicketAction.objects.bulk_create(actions)
+    return len(actions)
+
+
+def assign_tickets(queryset, performed_by=None, batch_size=BATCH_SIZE):
+    """Assigns the unassigned tickets of queryset to the least-loaded support agents.
+
+    Returns (assigned, skipped); skipped counts the selected tickets that
+    already had an agent. Raises ValueError when there is no eligible agent.
+    """
+    index = AgentLoadIndex.for_support_agents()
+    if not index:
+        raise ValueError('There are no active support agents to assign tickets to.')
+
+    skipped = queryset.filter(assigned_to__isnull=False).count()
+    assigned = 0
+    last_pk = 0
+    unassigned = queryset.filter(assigned_to__isnull=True).order_by('pk')
+    while True:
+        rows = list(unassigned.filter(pk__gt=last_pk).values_list('pk', 'status')[:batch_size])
+        if not rows:
+            break
+        assigned += _assign_rows(rows, index, performed_by)
+        last_pk = rows[-1][0]
+    return assigned, skipped
+
+
+def assign_new_ticket(ticket, performed_by=None):
+    """Assigns a just-created ticket to the least-loaded agent; returns the agent id or None"""
+    if ticket.assigned_to_id:
+        return None
+    index = AgentLoadIndex.for_support_agents()
+    if not index:
+        return None
+    _assign_rows([(ticket.pk, ticket.status)], index, performed_by)
+    ticket.refresh_from_db(fields=['assigned_to'])
+    return ticket.assigned_to_id
@@ -0,0 +1,14 @@
+from django.contrib.auth.backends import ModelBackend
+
+from . import permission_cache
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend whose permission checks are answered from the cross-request permission cache"""
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            user_obj._perm_cache = set(permission_cache.get(user_obj).permissions)
+        return user_obj._perm_cache
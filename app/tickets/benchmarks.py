@@ -0,0 +1,253 @@
+"""
+Micro-benchmarks of the project's hot functions, with stored baselines.
+
+Each benchmark is a function registered with @benchmark. It takes the
+Fixture (a fixed set of rows) and returns the callable to time. The benchmark
+command times every callable with timeit (the number of calls per run picked
+by Timer.autorange unless given) and writes the per-call times to JSON.
+compare() checks them against an earlier file.
+
+The fixture is created inside a transaction that is rolled back afterwards,
+so the benchmarks can run against any database, including production
+copies, without leaving rows behind.
+"""
+import statistics
+import timeit
+from dataclasses import dataclass
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.urls import resolve, reverse
+
+from . import signals
+from .forms import MediaUploadForm, TicketActionForm, TicketForm, TicketResponseForm
+from .models import Media, Role, Ticket, TicketAction, TicketCategory, TicketResponse, UserMeta
+from .pagination import paginate
+from .timeline import build_timeline
+
+# Responses and actions on the fixture ticket (half the actions are internal notes)
+TIMELINE_ENTRIES = 30
+
+# Tickets in the fixture list page
+LIST_TICKETS = 25
+
+# Users holding the support agent role in the whole-role benchmark
+ROLE_USERS = 200
+
+AGENT_PERMISSIONS = 'view_assigned_tickets,respond_to_tickets,view_all_tickets,close_tickets'
+# Alternated with AGENT_PERMISSIONS, so every whole-role sync has a change to apply
+AGENT_PERMISSIONS_ALTERED = 'view_assigned_tickets,respond_to_tickets'
+
+# An 8x8 PNG, so the upload benchmark sends a real image
+SAMPLE_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000080000000808020000004b6d29dc0000001449444154'
+    '789c633c2127c7800d3061151db41200d0ca01143e63a8990000000049454e44ae426082'
+)
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers a benchmark: a function taking the Fixture and returning the callable to time"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@dataclass
+class Fixture:
+    """The rows every benchmark works on"""
+    requester: User
+    agent: User
+    admin: User
+    user_role: Role
+    agent_role: Role
+    category: TicketCategory
+    ticket: Ticket
+
+
+def build_fixture():
+    """Creates the fixture rows; call inside a transaction that is rolled back"""
+    user_role, _ = Role.objects.get_or_create(name='user')
+    agent_role, _ = Role.objects.get_or_create(name='support_agent')
+    Role.objects.filter(pk=agent_role.pk).update(permissions=AGENT_PERMISSIONS)
+    agent_role.refresh_from_db()
+
+    requester = User.objects.create_user(username='benchmark_requester')
+    agent = User.objects.create_user(username='benchmark_agent')
+    admin = User.objects.create_user(username='benchmark_admin', is_staff=True, is_superuser=True)
+    UserMeta.objects.filter(user=agent).update(role=agent_role)
+    UserMeta.objects.filter(user=admin).update(role=Role.objects.get_or_create(name='admin')[0])
+
+    # Bulk rows: only the role's size matters to the whole-role benchmark
+    User.objects.bulk_create([User(username=f'benchmark_holder_{number}', is_staff=True) for number in range(ROLE_USERS)])
+    holders = User.objects.filter(username__startswith='benchmark_holder_')
+    UserMeta.objects.bulk_create([UserMeta(user=holder, role=agent_role) for holder in holders])
+
+    category = TicketCategory.objects.create(name='Benchmark')
+    tickets = [
+        Ticket.objects.create(
+            user=requester, assigned_to=agent, category=category, title=f'Benchmark ticket {number}',
+            description='Printer on the third floor jams.\nIt started this morning.',
+            priority=['low', 'medium', 'high', 'urgent'][number % 4],
+            status=['pending', 'in_progress', 'resolved', 'closed'][number % 4],
+        )
+        for number in range(LIST_TICKETS)
+    ]
+    ticket = tickets[-1]
+    for number in range(TIMELINE_ENTRIES):
+        response = TicketResponse.objects.create(ticket=ticket, user=requester if number % 2 else agent,
+                                                 message=f'Response {number}\nwith a second line')
+        if number % 5 == 0:
+            Media.objects.create(ticket=ticket, response=response, user=response.user,
+                                 file=f'uploads/benchmark_{number}.png', file_type='image')
+        TicketAction.objects.create(ticket=ticket, performed_by=agent, action_type='note' if number % 2 else 'review',
+                                    action_taken='Checked the printer', notes=f'Note {number}')
+    return Fixture(requester, agent, admin, user_role, agent_role, category, ticket)
+
+
+def page_request(user, path):
+    """A GET request for path as user, as the middleware would have left it"""
+    request = RequestFactory().get(path)
+    request.user = user
+    request.resolver_match = resolve(path)
+    return request
+
+
+@benchmark('role.get_permissions')
+def role_get_permissions(fixture):
+    return fixture.agent_role.get_permissions
+
+
+@benchmark('role.has_permission')
+def role_has_permission(fixture):
+    role = fixture.agent_role
+    return lambda: role.has_permission('close_tickets')
+
+
+@benchmark('role.has_permission (fresh instance)')
+def role_has_permission_fresh(fixture):
+    # Every request loads its own Role instance
+    name, permissions = fixture.agent_role.name, fixture.agent_role.permissions
+    return lambda: Role(name=name, permissions=permissions).has_permission('close_tickets')
+
+
+@benchmark('timeline.build_timeline')
+def timeline_build(fixture):
+    return lambda: build_timeline(fixture.ticket, include_notes=True)
+
+
+@benchmark('signals.update_user_permissions (one user)')
+def update_user_permissions_one_user(fixture):
+    meta = fixture.requester.user_meta
+    roles = [fixture.agent_role, fixture.user_role]
+    calls = [0]
+
+    def update():
+        # Alternate roles so every call has a group membership to change
+        calls[0] += 1
+        meta.role = roles[calls[0] % 2]
+        meta._role_changed = True
+        signals.update_user_permissions(sender=UserMeta, instance=meta, created=False)
+    return update
+
+
+@benchmark('signals.update_role_user_permissions (whole role)')
+def update_role_permissions_whole_role(fixture):
+    role = fixture.agent_role
+    versions = [AGENT_PERMISSIONS, AGENT_PERMISSIONS_ALTERED]
+    calls = [0]
+
+    def update():
+        calls[0] += 1
+        role._previous_permissions = (role.name, role.permissions)
+        role.permissions = versions[calls[0] % 2]
+        signals.update_role_user_permissions(sender=Role, instance=role, created=False)
+    return update
+
+
+@benchmark('forms.TicketForm.is_valid')
+def ticket_form_is_valid(fixture):
+    data = {'title': 'Printer jams', 'description': 'Printer on the third floor jams.', 'category': fixture.category.pk}
+    return lambda: TicketForm(data).is_valid()
+
+
+@benchmark('forms.MediaUploadForm.is_valid')
+def media_upload_form_is_valid(fixture):
+    def validate():
+        upload = SimpleUploadedFile('screenshot.png', SAMPLE_PNG, content_type='image/png')
+        return MediaUploadForm({}, {'file': upload}, user=fixture.requester, ticket=fixture.ticket).is_valid()
+    return validate
+
+
+@benchmark('render tickets/ticket_list.html')
+def render_ticket_list(fixture):
+    request = page_request(fixture.admin, reverse('ticket_list'))
+    page = paginate(Ticket.objects.select_related('category'))
+    page.total, page.total_is_exact = LIST_TICKETS, True
+    context = {
+        'tickets': page, 'categories': list(TicketCategory.objects.all()), 'status': '', 'priority': '',
+        'category': '', 'search_query': '', 'filter_query': '', 'role': 'admin',
+    }
+    return lambda: render_to_string('tickets/ticket_list.html', context, request)
+
+
+@benchmark('render tickets/ticket_detail.html')
+def render_ticket_detail(fixture):
+    ticket = Ticket.objects.select_related('user', 'assigned_to', 'category').get(pk=fixture.ticket.pk)
+    request = page_request(fixture.admin, reverse('ticket_detail', args=[ticket.pk]))
+    context = {
+        'ticket': ticket, 'responses': list(ticket.responses.order_by('created_at')),
+        'response_form': TicketResponseForm(), 'action_form': TicketActionForm(),
+        'timeline': build_timeline(ticket, include_notes=True), 'role': 'admin',
+        'ticket_files': list(Media.objects.filter(ticket=ticket, response__isnull=True).select_related('user')),
+    }
+    return lambda: render_to_string('tickets/ticket_detail.html', context, request)
+
+
+def time_callable(func, number=None, repeat=5):
+    """Times func with timeit; returns per-call statistics in microseconds"""
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    per_call = [total / number * 1e6 for total in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best_us': round(min(per_call), 3),
+        'median_us': round(statistics.median(per_call), 3),
+        'worst_us': round(max(per_call), 3),
+    }
+
+
+def run(names=None, number=None, repeat=5, progress=None):
+    """Runs the named benchmarks (all by default); returns their results by name"""
+    results = {}
+    with transaction.atomic():
+        fixture = build_fixture()
+        for name, setup in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            results[name] = time_callable(setup(fixture), number, repeat)
+            if progress:
+                progress(name, results[name])
+        transaction.set_rollback(True)
+    return results
+
+
+def compare(results, baseline, tolerance, metric='best_us'):
+    """Returns (name, baseline value, new value) for benchmarks slower than tolerance allows.
+
+    The best run is compared by default: it is the least disturbed by other
+    work on the machine. Benchmarks missing from either side are skipped.
+    """
+    regressions = []
+    for name, current in results['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous is not None and current[metric] > previous[metric] * (1 + tolerance):
+            regressions.append((name, previous[metric], current[metric]))
+    return regressions
@@ -0,0 +1,69 @@
+"""
+Chunked bulk updates for the ticket admin actions.
+
+A selection (possibly "select all" across tens of thousands of tickets) is
+walked in primary-key order, CHUNK_SIZE tickets at a time. Each chunk runs in
+its own short transaction with one counter-aware UPDATE and one bulk insert
+of TicketAction rows, so no long-held locks build up. Tickets already in the
+target state are left out of the chunk, which makes a re-run (for instance
+after a timeout) pick up only what is left.
+"""
+import logging
+from dataclasses import dataclass
+
+from django.db import transaction
+
+from . import counters
+from .models import Ticket, TicketAction
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+
+@dataclass
+class BulkResult:
+    """Outcome of a bulk update"""
+    updated: int = 0
+    unchanged: int = 0
+    chunks: int = 0
+
+
+def _update_chunk(ids, fields, action_type, notes, performed_by):
+    with transaction.atomic():
+        changed = list(
+            Ticket.objects.filter(pk__in=ids).exclude(**fields).values_list('pk', flat=True)
+        )
+        if changed:
+            counters.update_tickets(Ticket.objects.filter(pk__in=changed), **fields)
+            TicketAction.objects.bulk_create([
+                TicketAction(ticket_id=pk, performed_by=performed_by, action_type=action_type, notes=notes)
+                for pk in changed
+            ])
+    return len(changed)
+
+
+def bulk_update(queryset, fields, action_type, notes, performed_by=None, chunk_size=CHUNK_SIZE, progress=None):
+    """Sets fields on every ticket of queryset and logs one TicketAction per changed ticket.
+
+    progress, if given, is called as progress(result) after each chunk.
+    Returns a BulkResult.
+    """
+    result = BulkResult()
+    selection = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = 0
+    while True:
+        ids = list(selection.filter(pk__gt=last_pk)[:chunk_size])
+        if not ids:
+            break
+        updated = _update_chunk(ids, fields, action_type, notes, performed_by)
+        result.updated += updated
+        result.unchanged += len(ids) - updated
+        result.chunks += 1
+        last_pk = ids[-1]
+
+        logger.info('Bulk %s: chunk %d up to ticket %d, %d updated, %d unchanged',
+                    action_type, result.chunks, last_pk, result.updated, result.unchanged)
+        if progress:
+            progress(result)
+    return result
@@ -0,0 +1,69 @@
+"""
+Optimistic concurrency control for ticket writes.
+
+Every write to a ticket increments Ticket.version. A change made from a form
+is written with a conditional UPDATE ... WHERE id = %s AND version = n that
+sets only the changed columns, where n is the version the user was looking
+at. If someone else saved the ticket in between, the UPDATE matches no row
+and TicketConflict is raised instead of silently overwriting their change.
+No row locks are held between reading the ticket and writing it back.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import counters, search
+from .models import Ticket
+
+# Changes to these need the search index refreshed, which the save signals would normally do
+SEARCH_FIELDS = {'title', 'description'}
+
+
+class TicketConflict(Exception):
+    """The ticket was changed by someone else since the expected version"""
+
+    def __init__(self, ticket, expected_version, current):
+        self.ticket = ticket
+        self.expected_version = expected_version
+        # The ticket as it is now stored, or None if it was deleted
+        self.current = current
+        super().__init__(f"Ticket {ticket.pk} was changed by someone else (expected version {expected_version})")
+
+
+def parse_version(value, default):
+    """Returns a version submitted with a form, or default if it is missing or invalid"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def save_ticket(ticket, fields, expected_version=None):
+    """Writes the named fields of ticket if the stored row is still at expected_version.
+
+    expected_version defaults to ticket.version (the version it was loaded
+    at). On success ticket.version is advanced; on a lost race TicketConflict
+    is raised and nothing is written.
+    """
+    expected = ticket.version if expected_version is None else expected_version
+    attnames = [Ticket._meta.get_field(name).attname for name in fields]
+    changes = {attname: getattr(ticket, attname) for attname in attnames}
+    if 'priority' in changes:
+        changes['priority_rank'] = Ticket.PRIORITY_RANKS.get(ticket.priority, Ticket.PRIORITY_RANKS['medium'])
+    ticket.updated_at = changes['updated_at'] = timezone.now()
+
+    with transaction.atomic():
+        row = Ticket.objects.filter(pk=ticket.pk, version=expected)
+        # Versions only move forward, so the row read at this version is the one the UPDATE matches
+        old_state = row.values_list(*counters.TRACKED_FIELDS).first()
+        updated = row.update(version=F('version') + 1, **changes) if old_state else 0
+        if updated:
+            new_state = tuple(changes.get(field, old_state[index]) for index, field in enumerate(counters.TRACKED_FIELDS))
+            counters.apply_deltas(counters.record_transition(old_state, new_state))
+    if not updated:
+        raise TicketConflict(ticket, expected, Ticket.objects.filter(pk=ticket.pk).first())
+
+    ticket.version = expected + 1
+    if SEARCH_FIELDS & set(fields):
+        search.get_backend(ticket._state.db).index_ticket(ticket)
+    return ticket
@@ -0,0 +1,179 @@
+"""
+Incrementally maintained ticket status counters.
+
+Every write to a Ticket adjusts the matching TicketStatusCounter rows (global,
+per-agent and per-requester) so the dashboards read their stats with a single
+primary-key lookup instead of counting the tickets table on every request.
+
+Ticket.save and delete lock the ticket row while they read its previous
+state, and update_tickets() and save_ticket() move the counters in the same
+transaction as their UPDATE, so concurrent writers cannot apply a transition
+twice. Writes that go around all of these (queryset.update(), raw SQL,
+restored backups) leave the counters wrong until reconcile_ticket_counters
+is run.
+"""
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from .models import Ticket, TicketStatusCounter
+
+GLOBAL_KEY = 'global'
+STATUS_FIELDS = [status for status, _ in Ticket.STATUS_CHOICES]
+COUNTER_FIELDS = ['total'] + STATUS_FIELDS
+
+# Ticket fields whose changes affect the counters
+TRACKED_FIELDS = ('status', 'assigned_to_id', 'user_id')
+
+
+def agent_key(user_id):
+    return f'agent:{user_id}'
+
+
+def requester_key(user_id):
+    return f'user:{user_id}'
+
+
+def counter_keys(assigned_to_id, user_id):
+    """Returns the counter keys a ticket with the given owners contributes to"""
+    keys = [GLOBAL_KEY]
+    if assigned_to_id:
+        keys.append(agent_key(assigned_to_id))
+    if user_id:
+        keys.append(requester_key(user_id))
+    return keys
+
+
+def ticket_state(ticket, fallback=None):
+    """Returns the tracked (status, assigned_to_id, user_id) state of a ticket.
+
+    Deferred fields are taken from fallback, the previously stored state.
+    """
+    values = []
+    for index, field in enumerate(TRACKED_FIELDS):
+        if field in ticket.__dict__:
+            values.append(ticket.__dict__[field])
+        elif fallback is not None:
+            values.append(fallback[index])
+        else:
+            values.append(getattr(ticket, field))
+    return tuple(values)
+
+
+def _add_state(deltas, state, amount):
+    status, assigned_to_id, user_id = state
+    for key in counter_keys(assigned_to_id, user_id):
+        deltas[key]['total'] += amount
+        if status in STATUS_FIELDS:
+            deltas[key][status] += amount
+
+
+def new_deltas():
+    return defaultdict(lambda: defaultdict(int))
+
+
+def record_transition(old_state, new_state, deltas=None):
+    """Accumulates the counter changes for a ticket moving from old_state to new_state.
+
+    Either state may be None for a ticket being created or deleted.
+    """
+    if deltas is None:
+        deltas = new_deltas()
+    if old_state == new_state:
+        return deltas
+    if old_state is not None:
+        _add_state(deltas, old_state, -1)
+    if new_state is not None:
+        _add_state(deltas, new_state, 1)
+    return deltas
+
+
+def apply_deltas(deltas):
+    """Writes accumulated deltas to the counter table using atomic increments"""
+    # Keys are visited in a fixed order so concurrent writers lock rows consistently
+    for key in sorted(deltas):
+        changes = {field: amount for field, amount in deltas[key].items() if amount}
+        if not changes:
+            continue
+        increments = {field: F(field) + amount for field, amount in changes.items()}
+        if TicketStatusCounter.objects.filter(pk=key).update(**increments):
+            continue
+        try:
+            with transaction.atomic():
+                TicketStatusCounter.objects.create(key=key, **changes)
+        except IntegrityError:
+            # Another writer created the row first
+            TicketStatusCounter.objects.filter(pk=key).update(**increments)
+
+
+def update_tickets(queryset, **fields):
+    """Runs queryset.update(**fields) and adjusts the counters to match.
+
+    Use this instead of a bare queryset.update() whenever status, assigned_to
+    or user may change, otherwise the dashboards drift until the next
+    reconcile_ticket_counters run.
+    """
+    # Every write to a ticket moves its version on (see tickets.concurrency)
+    fields.setdefault('version', F('version') + 1)
+    reassigning = 'assigned_to' in fields or 'assigned_to_id' in fields
+    if reassigning:
+        agent = fields.get('assigned_to', fields.get('assigned_to_id'))
+        new_agent_id = getattr(agent, 'pk', agent)
+    tracked = reassigning or 'status' in fields
+
+    with transaction.atomic():
+        deltas = new_deltas()
+        if tracked:
+            groups = (
+                queryset.order_by()
+                .values('status', 'assigned_to_id', 'user_id')
+                .annotate(count=Count('id'))
+            )
+            for group in groups:
+                old_state = (group['status'], group['assigned_to_id'], group['user_id'])
+                new_state = (
+                    fields.get('status', old_state[0]),
+                    new_agent_id if reassigning else old_state[1],
+                    old_state[2],
+                )
+                if old_state == new_state:
+                    continue
+                _add_state(deltas, old_state, -group['count'])
+                _add_state(deltas, new_state, group['count'])
+        updated = queryset.update(**fields)
+        apply_deltas(deltas)
+    return updated
+
+
+def get_counts(key):
+    """Returns the counters for a key as a dict, with zeros if the key has no tickets"""
+    row = TicketStatusCounter.objects.filter(pk=key).values(*COUNTER_FIELDS).first()
+    if row is None:
+        return {field: 0 for field in COUNTER_FIELDS}
+    return row
+
+
+def rebuild():
+    """Recomputes every counter from the tickets table.
+
+    Returns the number of counter rows written.
+    """
+    deltas = new_deltas()
+    groups = (
+        Ticket.objects.order_by()
+        .values('status', 'assigned_to_id', 'user_id')
+        .annotate(count=Count('id'))
+    )
+    for group in groups:
+        state = (group['status'], group['assigned_to_id'], group['user_id'])
+        _add_state(deltas, state, group['count'])
+
+    rows = [
+        TicketStatusCounter(key=key, **{field: deltas[key][field] for field in COUNTER_FIELDS})
+        for key in sorted(deltas)
+    ]
+    with transaction.atomic():
+        TicketStatusCounter.objects.all().delete()
+        TicketStatusCounter.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
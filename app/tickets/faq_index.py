@@ -0,0 +1,164 @@
+"""
+In-memory ranked search over the published FAQ entries.
+
+The published FAQ corpus is small and read-mostly, so each worker process
+compiles it once into an inverted index and answers searches without touching
+the database. Writes to FAQKnowledgeBase bump a shared CacheGeneration row;
+workers compare it with the generation their index was built from (at most
+once per CHECK_INTERVAL seconds) and rebuild lazily when it moved.
+"""
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from .models import CacheGeneration, FAQKnowledgeBase
+from .profiling import record_cache
+
+GENERATION_NAME = 'faq_index'
+
+# Seconds between generation checks in a process
+CHECK_INTERVAL = 1.0
+
+# BM25 parameters and field weights (a question hit counts double)
+K1 = 1.2
+B = 0.75
+QUESTION_WEIGHT = 2
+ANSWER_WEIGHT = 1
+
+WORD_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return WORD_RE.findall((text or '').lower())
+
+
+class FAQIndex:
+    """BM25 index over a fixed list of FAQ entries"""
+
+    def __init__(self, faqs):
+        self.faqs = list(faqs)
+        self.postings = defaultdict(dict)
+        self.lengths = []
+
+        for position, faq in enumerate(self.faqs):
+            frequencies = defaultdict(int)
+            for term in tokenize(faq.question):
+                frequencies[term] += QUESTION_WEIGHT
+            for term in tokenize(faq.answer):
+                frequencies[term] += ANSWER_WEIGHT
+            for term, frequency in frequencies.items():
+                self.postings[term][position] = frequency
+            self.lengths.append(sum(frequencies.values()))
+
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        self.vocabulary = sorted(self.postings)
+        self.idf = {
+            term: math.log(1 + (len(self.faqs) - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+        choices = dict(FAQKnowledgeBase.CATEGORY_CHOICES)
+        self.categories = sorted(
+            {(faq.category, choices.get(faq.category, faq.category)) for faq in self.faqs},
+            key=lambda category: category[1]
+        )
+
+    def expand(self, prefix):
+        """Returns the indexed terms starting with prefix"""
+        start = bisect_left(self.vocabulary, prefix)
+        terms = []
+        for term in self.vocabulary[start:]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def _term_scores(self, term):
+        scores = {}
+        idf = self.idf[term]
+        for position, frequency in self.postings[term].items():
+            norm = 1 - B + B * self.lengths[position] / self.average_length
+            scores[position] = idf * frequency * (K1 + 1) / (frequency + K1 * norm)
+        return scores
+
+    def search(self, query, category=None):
+        """Returns the FAQs matching every word of query, best match first.
+
+        The last word is matched as a prefix so partially typed queries work.
+        Without a query all entries are returned in display order.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return [faq for faq in self.faqs if not category or faq.category == category]
+
+        totals = None
+        for index, term in enumerate(terms):
+            if index == len(terms) - 1:
+                expansions = self.expand(term)
+            elif term in self.postings:
+                expansions = [term]
+            else:
+                return []
+
+            # A prefix may expand to several terms; the best of them counts
+            term_scores = {}
+            for expansion in expansions:
+                for position, score in self._term_scores(expansion).items():
+                    term_scores[position] = max(term_scores.get(position, 0), score)
+
+            if totals is None:
+                totals = term_scores
+            else:
+                totals = {position: totals[position] + score
+                          for position, score in term_scores.items() if position in totals}
+            if not totals:
+                return []
+
+        if category:
+            totals = {position: score for position, score in totals.items()
+                      if self.faqs[position].category == category}
+        ranked = sorted(totals, key=lambda position: (-totals[position], position))
+        return [self.faqs[position] for position in ranked]
+
+
+_lock = threading.Lock()
+_index = None
+_generation = None
+_checked_at = 0.0
+
+
+def get_index():
+    """Returns the process-wide FAQ index, rebuilding it if the FAQs changed"""
+    global _index, _generation, _checked_at
+
+    with _lock:
+        now = time.monotonic()
+        if _index is not None and now - _checked_at < CHECK_INTERVAL:
+            record_cache('faq_index', hit=True)
+            return _index
+
+        # Read the generation before the rows so a concurrent write is never missed
+        generation = CacheGeneration.current(GENERATION_NAME)
+        _checked_at = now
+        stale = _index is None or generation != _generation
+        record_cache('faq_index', hit=not stale)
+        if stale:
+            faqs = (
+                FAQKnowledgeBase.objects.filter(is_published=True)
+                .select_related('related_ticket_category')
+                .order_by('category', 'order', 'question')
+            )
+            _index = FAQIndex(faqs)
+            _generation = generation
+        return _index
+
+
+def invalidate():
+    """Marks every process's FAQ index stale; called when an FAQ changes"""
+    global _index
+    CacheGeneration.bump(GENERATION_NAME)
+    with _lock:
+        _index = None
@@ -97,18 +97,7 @@ class MediaUploadForm(forms.ModelForm):
         if self.ticket:
             instance.ticket = self.ticket
             
-        # Determine file type
-        file_name = instance.file.name
-        file_extension = file_name.split('.')[-1].lower()
-        
-        # Set file type based on extension
-        if file_extension in ['jpg', 'jpeg', 'png', 'gif']:
-            instance.file_type = 'image'
-        elif file_extension in ['pdf', 'doc', 'docx', 'txt']:
-            instance.file_type = 'document'
-        else:
-            instance.file_type = 'other'
-            
+        # file_type is detected from the content when the file is stored (see Media.save)
         if commit:
             instance.save()
         return instance
@@ -0,0 +1,262 @@
+"""
+Synthetic load against a running server, with latency percentiles per URL name.
+
+Each worker thread signs in as a requester, a support agent or an admin
+(chosen by weight) and repeats that persona's scenario until the run ends.
+Every request is timed on its own (redirects are not followed), labelled
+with the URL name it was built from, and counted as an error when it fails
+or answers with a 4xx/5xx status. Only the standard library is used on the
+client side, so the harness runs wherever manage.py does.
+
+The load_test management command prepares the accounts, runs the workers
+and writes summarize() results to JSON. compare() checks them against a
+stored baseline.
+"""
+import http.cookiejar
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from django.urls import reverse
+
+PERSONAS = ('requester', 'agent', 'admin')
+
+# Share of workers playing each persona unless the command is told otherwise
+DEFAULT_MIX = {'requester': 70, 'agent': 20, 'admin': 10}
+
+# Percentiles reported per URL name
+PERCENTILES = (50, 95, 99)
+
+# Seconds before a request counts as failed
+REQUEST_TIMEOUT = 30
+
+# Growth of an error rate (absolute, 0.01 is one percentage point) that counts as a regression
+ERROR_RATE_TOLERANCE = 0.01
+
+
+@dataclass
+class Account:
+    """Credentials of one load-test user and the tickets it may open"""
+    persona: str
+    username: str
+    password: str
+    ticket_ids: list = field(default_factory=list)
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Recorder:
+    """Latencies and errors per URL name, shared by the worker threads"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, ok):
+        with self._lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def mark_error(self, name):
+        """Counts the last request recorded under name as failed after all"""
+        with self._lock:
+            self.errors[name] += 1
+
+
+class Client:
+    """A cookie-keeping HTTP client for one worker, timing every request"""
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), _NoRedirects,
+        )
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == 'csrftoken':
+                return cookie.value
+        return ''
+
+    def request(self, name, path, data=None):
+        """Requests path, records it under name and returns (status, body)"""
+        url = self.base_url + path
+        headers = {'User-Agent': 'tms-load-test'}
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode({**data, 'csrfmiddlewaretoken': self.csrf_token()}).encode()
+            headers['Referer'] = url
+        started = time.perf_counter()
+        status, content = 0, b''
+        try:
+            with self.opener.open(urllib.request.Request(url, data=body, headers=headers), timeout=REQUEST_TIMEOUT) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            # Unfollowed redirects arrive here too
+            status, content = e.code, e.read()
+        except (urllib.error.URLError, OSError):
+            status = 0
+        self.recorder.add(name, time.perf_counter() - started, 200 <= status < 400)
+        return status, content
+
+    def get(self, name, *args, query=None):
+        path = reverse(name, args=args)
+        if query:
+            path += '?' + urllib.parse.urlencode(query)
+        return self.request(name, path)
+
+    def post(self, name, *args, data):
+        return self.request(name, reverse(name, args=args), data)
+
+    def login(self, account):
+        self.get('login')
+        status, _ = self.post('login', data={'username': account.username, 'password': account.password})
+        # A successful sign-in redirects; a failed one renders the form again
+        if status != 302:
+            self.recorder.mark_error('login')
+            return False
+        return True
+
+
+def requester_scenario(client, account, rng):
+    client.get('dashboard')
+    client.get('ticket_list')
+    client.get('ticket_list', query={'status': rng.choice(['pending', 'in_progress', 'resolved'])})
+    client.get('ticket_list', query={'q': rng.choice(['printer', 'login', 'invoice', 'network'])})
+    if account.ticket_ids:
+        ticket_id = rng.choice(account.ticket_ids)
+        client.get('ticket_detail', ticket_id)
+        if rng.random() < 0.3:
+            client.post('ticket_detail', ticket_id, data={'form_type': 'response', 'message': 'Any update on this?'})
+
+
+def agent_scenario(client, account, rng):
+    client.get('admin:tickets_ticket_changelist')
+    client.get('admin:tickets_ticket_changelist', query={'status__exact': 'pending'})
+    client.get('admin:tickets_ticket_changelist', query={'q': rng.choice(['printer', 'login', 'invoice'])})
+    if account.ticket_ids:
+        client.get('admin:tickets_ticket_change', rng.choice(account.ticket_ids))
+    client.get('admin:tickets_ticketresponse_changelist')
+
+
+def admin_scenario(client, account, rng):
+    client.get('admin:index')
+    client.get('admin:tickets_ticket_changelist')
+    client.get('admin:tickets_ticket_changelist', query={'priority__exact': rng.choice(['low', 'medium', 'high'])})
+    if account.ticket_ids:
+        client.get('admin:tickets_ticket_change', rng.choice(account.ticket_ids))
+    client.get('admin:tickets_ticketaction_changelist')
+    client.get('admin:auth_user_changelist')
+    client.get('admin:tickets_faqknowledgebase_changelist')
+
+
+SCENARIOS = {
+    'requester': requester_scenario,
+    'agent': agent_scenario,
+    'admin': admin_scenario,
+}
+
+
+def assign_personas(workers, mix, rng=random):
+    """Returns one persona per worker, in proportion to the mix weights"""
+    total = sum(mix.values())
+    personas = []
+    for persona, weight in mix.items():
+        personas.extend([persona] * math.floor(workers * weight / total))
+    # Workers left over by rounding down go to randomly drawn personas
+    while len(personas) < workers:
+        personas.append(rng.choices(list(mix), weights=list(mix.values()))[0])
+    return personas
+
+
+def run(base_url, accounts, duration, seed=None):
+    """Runs one worker thread per account for duration seconds; returns (Recorder, elapsed seconds)"""
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+
+    def work(index, account):
+        rng = random.Random(None if seed is None else seed + index)
+        client = Client(base_url, recorder)
+        if not client.login(account):
+            return
+        scenario = SCENARIOS[account.persona]
+        # Every signed-in worker completes at least one pass, however short the run
+        while True:
+            scenario(client, account, rng)
+            if time.monotonic() >= deadline:
+                break
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(index, account), daemon=True) for index, account in enumerate(accounts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - started
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def _summary(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'error_rate': round(errors / len(latencies), 4) if latencies else 0.0,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+    }
+    for percent in PERCENTILES:
+        summary[f'p{percent}_ms'] = round(percentile(latencies, percent) * 1000, 2)
+    return summary
+
+
+def summarize(recorder, elapsed):
+    """The results of a run: a summary per URL name and one over all requests"""
+    endpoints = {
+        name: _summary(latencies, recorder.errors[name], elapsed)
+        for name, latencies in sorted(recorder.latencies.items())
+    }
+    everything = [seconds for latencies in recorder.latencies.values() for seconds in latencies]
+    return {
+        'elapsed_seconds': round(elapsed, 2),
+        'endpoints': endpoints,
+        'total': _summary(everything, sum(recorder.errors.values()), elapsed),
+    }
+
+
+def compare(results, baseline, tolerance, metric='p95_ms'):
+    """Returns (name, baseline value, new value) for URL names that got worse than tolerance allows.
+
+    A latency metric regresses when it grew by more than tolerance (0.2 is
+    20 %), the error rate when it grew by more than ERROR_RATE_TOLERANCE.
+    """
+    regressions = []
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if previous is None:
+            continue
+        if current[metric] > previous[metric] * (1 + tolerance):
+            regressions.append((f'{name} {metric}', previous[metric], current[metric]))
+        if current['error_rate'] > previous['error_rate'] + ERROR_RATE_TOLERANCE:
+            regressions.append((f'{name} error_rate', previous['error_rate'], current['error_rate']))
+    return regressions
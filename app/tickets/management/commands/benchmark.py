@@ -0,0 +1,68 @@
+import json
+import platform
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tickets import benchmarks, slow_queries
+
+
+class Command(BaseCommand):
+    """Django command to run the micro-benchmarks and compare them with a stored baseline"""
+    help = 'Times the hot functions (permissions, timeline, forms, templates) with timeit and reports µs per call'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Benchmarks to run (all by default; see --list)')
+        parser.add_argument('--list', action='store_true', help='List the benchmarks and exit')
+        parser.add_argument('--number', type=int, default=None, help='Calls per timing run (picked automatically by default)')
+        parser.add_argument('--repeat', type=int, default=5, help='Timing runs per benchmark')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare the results with this earlier JSON output')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed growth of the best time over the baseline (0.2 is 20%%)')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for name in benchmarks.BENCHMARKS:
+                self.stdout.write(name)
+            return
+        unknown = [name for name in options['names'] if name not in benchmarks.BENCHMARKS]
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(unknown)} (see --list)")
+        if options['repeat'] < 1 or (options['number'] is not None and options['number'] < 1):
+            raise CommandError('--number and --repeat must be at least 1')
+
+        self.stdout.write(f"{'benchmark':<52} {'best µs':>11} {'median µs':>11} {'calls':>8}")
+
+        def progress(name, result):
+            self.stdout.write(f"{name:<52} {result['best_us']:>11.2f} {result['median_us']:>11.2f} {result['number']:>8}")
+
+        # Query logging (DEBUG) and the slow query log would be timed along with the code.
+        # DEBUG is not switched off behind the project's back: the results say whether it was on
+        if settings.DEBUG:
+            self.stderr.write('DEBUG is on: statement logging is timed too; run with DEBUG=False for comparable numbers')
+        with slow_queries.paused():
+            results = {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'debug': settings.DEBUG,
+                'benchmarks': benchmarks.run(options['names'], options['number'], options['repeat'], progress),
+            }
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = benchmarks.compare(results, baseline, options['tolerance'])
+            for name, previous, current in regressions:
+                self.stdout.write(self.style.ERROR(f'{name}: {previous:.2f} µs -> {current:.2f} µs'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}"))
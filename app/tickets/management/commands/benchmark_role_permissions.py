@@ -0,0 +1,48 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from tickets.models import Role, compile_permissions
+
+
+def legacy_has_permission(role, permission):
+    """The comma-string check Role.has_permission used before permissions were compiled"""
+    if not role.permissions:
+        return False
+    permissions = [p.strip() for p in role.permissions.split(',') if p.strip()]
+    if role.name.lower() == 'admin':
+        return True
+    return permission in permissions
+
+
+class Command(BaseCommand):
+    """Django command to compare the legacy and compiled role permission checks"""
+    help = 'Times Role permission checks: comma-string parsing against the compiled bitmask'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=100000, help='Checks per timing run')
+        parser.add_argument('--repeat', type=int, default=5, help='Timing runs (the best is reported)')
+
+    def handle(self, *args, **options):
+        number, repeat = options['number'], options['repeat']
+        # Unsaved roles, so the benchmark never touches the database
+        role = Role(name='support_agent', permissions='view_assigned_tickets,respond_to_tickets,view_all_tickets,close_tickets')
+        checks = ['close_tickets', 'view_all_tickets', 'respond_to_tickets']
+
+        def fresh_role():
+            # Each request loads its own Role instance
+            return Role(name=role.name, permissions=role.permissions)
+
+        cases = [
+            ('single check (legacy)', lambda: legacy_has_permission(role, 'close_tickets')),
+            ('single check (compiled)', lambda: role.has_permission('close_tickets')),
+            ('three checks (legacy)', lambda: all(legacy_has_permission(role, p) for p in checks)),
+            ('three checks (compiled)', lambda: role.has_permissions(*checks)),
+            ('fresh instance (legacy)', lambda: legacy_has_permission(fresh_role(), 'close_tickets')),
+            ('fresh instance (compiled)', lambda: fresh_role().has_permission('close_tickets')),
+        ]
+
+        compile_permissions.cache_clear()
+        for label, func in cases:
+            best = min(timeit.repeat(func, number=number, repeat=repeat))
+            self.stdout.write(f'{label:<28} {best / number * 1e9:10.1f} ns/check')
+        self.stdout.write(self.style.SUCCESS(f'Compiled permission cache: {compile_permissions.cache_info()}'))
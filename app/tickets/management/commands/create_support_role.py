@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from tickets.models import Role, UserMeta, Ticket, TicketResponse, TicketAction
-from django.contrib.auth.models import User, Permission
+from tickets import permissions as role_permissions
+from django.contrib.auth.models import User, Permission, Group
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
 
@@ -167,15 +168,15 @@ class Command(BaseCommand):
         return permissions
     
     def apply_django_permissions(self, user, permissions):
-        """Apply Django permissions to the user"""
-        added_count = 0
+        """Apply Django permissions to the user through the support role's group"""
+        role = user.user_meta.role
+        group_id = role_permissions.sync_group(role)
         
-        # First clear existing permissions to avoid duplicates
-        user.user_permissions.clear()
+        # The role group already grants the support agent permissions; add any missing ones to it
+        Group.objects.get(pk=group_id).permissions.add(*permissions)
         
-        # Then add the required permissions
-        for perm in permissions:
-            user.user_permissions.add(perm)
-            added_count += 1
+        # Drop per-user copies and make the user a member of the group
+        user.user_permissions.remove(*permissions)
+        role_permissions.sync_user(user, role)
         
-        return added_count
+        return len(permissions)
@@ -0,0 +1,140 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from tickets import load_test
+from tickets.models import Role, Ticket, TicketCategory
+
+ROLE_NAMES = {'requester': 'user', 'agent': 'support_agent', 'admin': 'admin'}
+
+# Tickets opened by the agent and admin workers
+TICKETS_PER_STAFF_ACCOUNT = 50
+
+SAMPLE_TITLES = ['Printer jams on every job', 'Cannot login after reset', 'Invoice shows the wrong amount',
+                 'Network drops every hour', 'Email attachments missing']
+
+
+def parse_mix(value):
+    """Parses 'requester=70,agent=20,admin=10' into weights"""
+    mix = {}
+    for part in value.split(','):
+        persona, _, weight = part.partition('=')
+        persona = persona.strip()
+        if persona not in load_test.PERSONAS:
+            raise CommandError(f"Unknown persona '{persona}' (expected one of {', '.join(load_test.PERSONAS)})")
+        try:
+            mix[persona] = float(weight)
+        except ValueError:
+            raise CommandError(f"Invalid weight for {persona}: '{weight}'")
+    if not any(mix.values()):
+        raise CommandError('The mix needs at least one persona with a positive weight')
+    return mix
+
+
+class Command(BaseCommand):
+    """Django command to put a running server under a synthetic mix of requester, agent and admin traffic"""
+    help = 'Load-tests a running server and reports latency percentiles, throughput and errors per URL name'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='Server under test (sharing this database)')
+        parser.add_argument('--workers', type=int, default=10, help='Concurrent simulated users')
+        parser.add_argument('--duration', type=float, default=60, help='Seconds to run')
+        parser.add_argument('--mix', default='requester=70,agent=20,admin=10', help='Persona weights')
+        parser.add_argument('--tickets-per-requester', type=int, default=5, help='Tickets each requester account owns')
+        parser.add_argument('--password', default='load-test-password', help='Password of the load-test accounts')
+        parser.add_argument('--seed', type=int, default=None, help='Seed for the scenario choices')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare the results with this earlier JSON output')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95 growth over the baseline (0.2 is 20%%)')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        mix = {persona: weight for persona, weight in parse_mix(options['mix']).items() if weight > 0}
+        personas = load_test.assign_personas(options['workers'], mix)
+
+        self.stdout.write('Preparing load-test accounts...')
+        accounts = self.prepare_accounts(personas, options['password'], options['tickets_per_requester'])
+
+        self.stdout.write(f"Running {options['workers']} workers against {options['base_url']} for {options['duration']:g}s...")
+        recorder, elapsed = load_test.run(options['base_url'], accounts, options['duration'], options['seed'])
+        results = {
+            'base_url': options['base_url'],
+            'workers': options['workers'],
+            'mix': mix,
+            **load_test.summarize(recorder, elapsed),
+        }
+        self.write_table(results)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = load_test.compare(results, baseline, options['tolerance'])
+            for label, previous, current in regressions:
+                self.stdout.write(self.style.ERROR(f'{label}: {previous} -> {current}'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}"))
+
+    def prepare_accounts(self, personas, password, tickets_per_requester):
+        """Creates (or reuses) one account per worker, and the tickets they open"""
+        counts = {persona: personas.count(persona) for persona in load_test.PERSONAS}
+        users = {persona: [self.account_user(persona, number, password) for number in range(counts[persona])]
+                 for persona in load_test.PERSONAS}
+
+        category = TicketCategory.objects.order_by('id').first() or TicketCategory.objects.create(name='Load test')
+        agents = users['agent']
+        for index, requester in enumerate(users['requester']):
+            missing = tickets_per_requester - Ticket.objects.filter(user=requester).count()
+            for number in range(max(missing, 0)):
+                Ticket.objects.create(
+                    user=requester, category=category,
+                    assigned_to=agents[(index + number) % len(agents)] if agents else None,
+                    title=SAMPLE_TITLES[number % len(SAMPLE_TITLES)], description='Created by the load test',
+                )
+
+        latest = Ticket.objects.order_by('-created_at', '-id')
+        accounts = []
+        for persona in load_test.PERSONAS:
+            for user in users[persona]:
+                if persona == 'requester':
+                    tickets = latest.filter(user=user)
+                elif persona == 'agent':
+                    tickets = latest.filter(assigned_to=user)
+                else:
+                    tickets = latest
+                ticket_ids = list(tickets.values_list('id', flat=True)[:TICKETS_PER_STAFF_ACCOUNT])
+                accounts.append(load_test.Account(persona, user.username, password, ticket_ids))
+        return accounts
+
+    def account_user(self, persona, number, password):
+        user, created = User.objects.get_or_create(username=f'loadtest_{persona}_{number}')
+        if created or not user.check_password(password):
+            user.set_password(password)
+        if persona == 'admin':
+            user.is_staff = user.is_superuser = True
+        user.save()
+        meta = user.user_meta
+        role, _ = Role.objects.get_or_create(name=ROLE_NAMES[persona])
+        if meta.role_id != role.id or not meta.is_profile_completed:
+            meta.role = role
+            meta.is_profile_completed = True
+            meta.save()
+        return user
+
+    def write_table(self, results):
+        header = f"{'URL name':<44} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        self.stdout.write(header)
+        rows = list(results['endpoints'].items()) + [('(all)', results['total'])]
+        for name, summary in rows:
+            self.stdout.write(
+                f"{name:<44} {summary['requests']:>9} {summary['errors']:>7} {summary['throughput_rps']:>8.1f} "
+                f"{summary['p50_ms']:>9.1f} {summary['p95_ms']:>9.1f} {summary['p99_ms']:>9.1f}"
+            )
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from tickets import search
+
+
+class Command(BaseCommand):
+    """Django command to rebuild the ticket full-text search index"""
+    help = 'Creates the search index if needed and re-indexes every ticket and response'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database',
+            default='default',
+            help='Database alias whose search index should be rebuilt'
+        )
+
+    def handle(self, *args, **options):
+        backend = search.get_backend(options['database'])
+        self.stdout.write(f'Rebuilding search index with {backend.__class__.__name__}...')
+        count = backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} tickets and responses'))
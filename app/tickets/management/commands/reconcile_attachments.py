@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from tickets import storage
+
+
+class Command(BaseCommand):
+    """Django command to recount stored attachment references and remove unreferenced files"""
+    help = 'Recounts StoredFile references from the Media rows and deletes files nothing refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stray-age',
+            type=int,
+            default=storage.STRAY_AGE,
+            help='Seconds before a stored file without a StoredFile row counts as stray'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Reconciling stored attachments...')
+        summary = storage.reconcile(options['stray_age'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Recounted {summary['recounted']}, deleted {summary['deleted']} unreferenced "
+            f"and {summary['stray_files']} stray files"
+        ))
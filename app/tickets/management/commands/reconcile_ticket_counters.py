@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from tickets import counters
+
+
+class Command(BaseCommand):
+    """Django command to rebuild the dashboard ticket status counters from scratch"""
+    help = 'Recomputes the global, per-agent and per-requester ticket status counters'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding ticket status counters...')
+        rows = counters.rebuild()
+        totals = counters.get_counts(counters.GLOBAL_KEY)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {rows} counter rows ({totals['total']} tickets in total)"
+        ))
@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+
+from tickets import counters, permission_cache, permissions, search, seeding, slow_queries
+from tickets.models import Role, Ticket, TicketCategory
+
+CATEGORY_NAMES = ['Hardware', 'Software', 'Network', 'Accounts', 'Email', 'Billing', 'Access', 'Printing',
+                  'Phones', 'Facilities', 'Security', 'Other']
+
+
+def count_argument(value):
+    try:
+        return seeding.parse_count(value)
+    except ValueError as e:
+        raise CommandError(str(e))
+
+
+def next_id(model, using):
+    return (model.objects.using(using).aggregate(last=Max('pk'))['last'] or 0) + 1
+
+
+class Command(BaseCommand):
+    """Django command to fill the database with a large, realistic, reproducible data set"""
+    help = ('Bulk-generates users, tickets, responses and actions at a given scale '
+            '(e.g. --tickets 5M --responses-per-ticket 8), in parallel processes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickets', type=count_argument, default=10000, help='Tickets to create (accepts 200k, 5M)')
+        parser.add_argument('--users', type=count_argument, default=1000, help='Requester accounts to create')
+        parser.add_argument('--agents', type=count_argument, default=50, help='Support agent accounts to create')
+        parser.add_argument('--admins', type=count_argument, default=5, help='Admin accounts to create')
+        parser.add_argument('--categories', type=int, default=12, help='Categories to spread tickets over (created if missing)')
+        parser.add_argument('--responses-per-ticket', type=float, default=3, help='Average responses per ticket')
+        parser.add_argument('--actions-per-ticket', type=float, default=2, help='Average agent actions per ticket')
+        parser.add_argument('--days', type=int, default=365, help='Tickets are spread over this many past days')
+        parser.add_argument('--seed', type=int, default=1, help='Same seed and scale, same data')
+        parser.add_argument('--password', default='seed-password', help='Password of every generated account')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Parallel writer processes')
+        parser.add_argument('--chunk-size', type=int, default=20000, help='Tickets per unit of parallel work')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows per INSERT')
+        parser.add_argument('--load-data', action='store_true',
+                            help='On MySQL, write through LOAD DATA LOCAL INFILE instead of INSERT (needs local_infile on the server)')
+        parser.add_argument('--skip-search-index', action='store_true', help='Do not rebuild the search index afterwards')
+        parser.add_argument('--database', default='default', help='Database alias to fill')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if options['users'] < 1:
+            raise CommandError('--users must be at least 1')
+        if options['categories'] < 1 or options['chunk_size'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--categories, --chunk-size and --batch-size must be at least 1')
+        if options['load_data'] and connections[using].vendor != 'mysql':
+            raise CommandError('--load-data needs a MySQL database')
+
+        # The slow query log would fill up with the bulk INSERTs. With DEBUG on the
+        # connections also keep every statement; seeding drops them after each step
+        with slow_queries.paused():
+            started = time.perf_counter()
+            plan = self.prepare(options)
+            self.stdout.write(f'Users ready in {time.perf_counter() - started:.1f}s')
+            self.seed_tickets(plan, options['processes'])
+            self.finish(plan, options['skip_search_index'])
+        self.stdout.write(self.style.SUCCESS(f'Seeded in {time.perf_counter() - started:.1f}s'))
+
+    def prepare(self, options):
+        """Creates the accounts and categories and returns the plan for the tickets"""
+        using = options['database']
+        end = timezone.now()
+        start = end - timedelta(days=options['days'])
+        # One hash for every account: hashing is deliberately slow
+        password_hash = make_password(options['password'])
+        first_user_id = next_id(User, using)
+        ranges = {}
+        for kind, role_name, count in (('requester', 'user', options['users']),
+                                       ('agent', 'support_agent', options['agents']),
+                                       ('admin', 'admin', options['admins'])):
+            role, _ = Role.objects.using(using).get_or_create(name=role_name)
+            if role.group_id is None:
+                permissions.sync_group(role)
+            self.stdout.write(f'Creating {count} {kind} accounts...')
+            ranges[kind] = seeding.create_users(
+                kind, count, first_user_id, role, password_hash, options['batch_size'],
+                options['seed'], (start, end), using,
+            )
+            first_user_id += count
+
+        category_ids = list(TicketCategory.objects.using(using).order_by('id').values_list('id', flat=True)[:options['categories']])
+        for number in range(len(category_ids), options['categories']):
+            name = CATEGORY_NAMES[number] if number < len(CATEGORY_NAMES) else f'Category {number + 1}'
+            category_ids.append(TicketCategory.objects.using(using).create(name=name).id)
+
+        return seeding.SeedPlan(
+            seed=options['seed'],
+            tickets=options['tickets'],
+            first_ticket_id=next_id(Ticket, using),
+            requester_ids=ranges['requester'],
+            agent_ids=ranges['agent'],
+            category_ids=tuple(category_ids),
+            responses_per_ticket=options['responses_per_ticket'],
+            actions_per_ticket=options['actions_per_ticket'],
+            start=start,
+            end=end,
+            chunk_size=options['chunk_size'],
+            batch_size=options['batch_size'],
+            using=using,
+            load_data=options['load_data'],
+        )
+
+    def seed_tickets(self, plan, processes):
+        processes = max(min(processes, plan.chunk_count), 1)
+        if processes > 1 and connections[plan.using].vendor == 'sqlite':
+            # SQLite takes one writer at a time: parallel chunks only wait on its lock
+            self.stdout.write('SQLite allows one writer at a time: using a single process')
+            processes = 1
+        self.stdout.write(f'Creating {plan.tickets} tickets in {plan.chunk_count} chunks on {processes} processes...')
+        started = time.perf_counter()
+        totals = [0, 0, 0]
+
+        def report(result):
+            for index, count in enumerate(result):
+                totals[index] += count
+            rate = totals[0] / max(time.perf_counter() - started, 1e-9)
+            self.stdout.write(f'  {totals[0]} tickets, {totals[1]} responses, {totals[2]} actions ({rate:.0f} tickets/s)')
+
+        if processes == 1:
+            seeding.prepare_worker(plan.using, plan.load_data)
+            for chunk in range(plan.chunk_count):
+                report(seeding.seed_chunk(plan, chunk))
+            if connections[plan.using].vendor == 'mysql':
+                # Drop the session settings prepare_worker made
+                connections[plan.using].close()
+        else:
+            # Forked workers must open their own connections
+            connections.close_all()
+            with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=seeding.prepare_worker,
+                                     initargs=(plan.using, plan.load_data)) as pool:
+                for result in pool.map(seeding.seed_chunk, [plan] * plan.chunk_count, range(plan.chunk_count)):
+                    report(result)
+
+    def finish(self, plan, skip_search_index):
+        """Does in bulk what the skipped model signals would have done row by row"""
+        connection = connections[plan.using]
+        # Explicit keys do not advance sequences on backends that have them
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, Ticket]):
+                cursor.execute(sql)
+        permission_cache.invalidate()
+        self.stdout.write('Rebuilding ticket status counters...')
+        counters.rebuild()
+        if not skip_search_index:
+            self.stdout.write('Rebuilding the search index...')
+            search.get_backend(plan.using).rebuild()
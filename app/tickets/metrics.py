@@ -0,0 +1,344 @@
+"""
+Process-shared application metrics in the Prometheus text format.
+
+Gunicorn runs several worker processes, so a metric kept in a Python object
+would only describe the worker that happens to answer the scrape. Instead
+every process writes its values to its own memory mapped file in METRICS_DIR
+(one float per metric sample), and the /metrics view adds up the files of
+all processes when it is scraped:
+
+- counters and histograms are summed over every file, including those of
+  workers that have exited, so they only ever go up
+- gauges (in-flight requests) live in separate files and only processes
+  that are still running are counted
+
+Writing a sample is a dictionary lookup and an 8-byte store into the mapped
+file; nothing is flushed or locked across processes. The directory should
+be emptied when the server starts (start.sh does) so values from a previous
+deployment are not carried over.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+
+# Histogram bucket upper bounds for request latencies, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER_PREFIX = 'counter_'
+GAUGE_PREFIX = 'gauge_'
+
+# File layout: an 8-byte header holding the number of bytes used, then entries of
+# a 4-byte key length, the UTF-8 key padded to 8 bytes and a float64 value
+HEADER = struct.Struct('Q')
+KEY_LENGTH = struct.Struct('I')
+VALUE = struct.Struct('d')
+INITIAL_FILE_SIZE = 64 * 1024
+
+
+def metrics_dir():
+    return settings.METRICS_DIR
+
+
+def _padded(length):
+    return length + (-length % 8)
+
+
+def read_file(path):
+    """Returns the {key: value} entries of one metrics file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        return {}
+    used = HEADER.unpack_from(data, 0)[0]
+    values = {}
+    offset = HEADER.size
+    while offset < used:
+        length = KEY_LENGTH.unpack_from(data, offset)[0]
+        key_start = offset + KEY_LENGTH.size
+        value_offset = key_start + _padded(KEY_LENGTH.size + length) - KEY_LENGTH.size
+        values[data[key_start:key_start + length].decode()] = VALUE.unpack_from(data, value_offset)[0]
+        offset = value_offset + VALUE.size
+    return values
+
+
+class MappedValues:
+    """The metric values of one process, kept in a memory mapped file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() < HEADER.size:
+            self._file.truncate(INITIAL_FILE_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = HEADER.unpack_from(self._map, 0)[0] or HEADER.size
+        self._offsets = {}
+        # Reopening the file of an earlier process with the same pid continues from its values
+        offset = HEADER.size
+        while offset < self._used:
+            length = KEY_LENGTH.unpack_from(self._map, offset)[0]
+            key_start = offset + KEY_LENGTH.size
+            value_offset = key_start + _padded(KEY_LENGTH.size + length) - KEY_LENGTH.size
+            self._offsets[self._map[key_start:key_start + length].decode()] = value_offset
+            offset = value_offset + VALUE.size
+
+    def _add_key(self, key):
+        encoded = key.encode()
+        entry_size = _padded(KEY_LENGTH.size + len(encoded)) + VALUE.size
+        if self._used + entry_size > len(self._map):
+            size = len(self._map)
+            while self._used + entry_size > size:
+                size *= 2
+            self._map.close()
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + KEY_LENGTH.size:self._used + KEY_LENGTH.size + len(encoded)] = encoded
+        value_offset = self._used + entry_size - VALUE.size
+        VALUE.pack_into(self._map, value_offset, 0.0)
+        # The header is moved last so readers never see a partly written entry
+        self._used += entry_size
+        HEADER.pack_into(self._map, 0, self._used)
+        self._offsets[key] = value_offset
+        return value_offset
+
+    def add(self, key, amount):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._add_key(key)
+        VALUE.pack_into(self._map, offset, VALUE.unpack_from(self._map, offset)[0] + amount)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class ProcessStore:
+    """The counter and gauge files of the current process"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.pid = os.getpid()
+        self.counters = MappedValues(os.path.join(directory, f'{COUNTER_PREFIX}{self.pid}.db'))
+        # Gauges describe the running process only, so a reused pid starts them from zero
+        gauge_path = os.path.join(directory, f'{GAUGE_PREFIX}{self.pid}.db')
+        if os.path.exists(gauge_path):
+            os.remove(gauge_path)
+        self.gauges = MappedValues(gauge_path)
+
+    def close(self):
+        self.counters.close()
+        self.gauges.close()
+
+
+_lock = threading.Lock()
+_store = None
+
+
+def _get_store():
+    """Returns the store of this process, opening new files after a fork"""
+    global _store
+    if _store is None or _store.pid != os.getpid():
+        _store = ProcessStore(metrics_dir())
+    return _store
+
+
+def _sample_key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {self.labelnames}, got {tuple(labels)}')
+        return {name: str(value) for name, value in labels.items()}
+
+    def _add(self, suffix, labels, amount):
+        key = _sample_key(self.name + suffix, labels)
+        with _lock:
+            store = _get_store()
+            (store.gauges if self.kind == 'gauge' else store.counters).add(key, amount)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._add('', self._labels(labels), amount)
+
+
+class Gauge(Metric):
+    """A gauge summed over the running processes"""
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        self._add('', self._labels(labels), amount)
+
+    def dec(self, amount=1, **labels):
+        self._add('', self._labels(labels), -amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        labels = self._labels(labels)
+        # Buckets are stored non-cumulative (one write per observation) and added up when exposed
+        index = bisect_left(self.buckets, value)
+        le = _format_value(self.buckets[index]) if index < len(self.buckets) else '+Inf'
+        with _lock:
+            counters = _get_store().counters
+            counters.add(_sample_key(self.name + '_bucket', {**labels, 'le': le}), 1)
+            counters.add(_sample_key(self.name + '_sum', labels), value)
+            counters.add(_sample_key(self.name + '_count', labels), 1)
+
+
+class CollectedGauge:
+    """A gauge whose samples are computed when the metrics are scraped.
+
+    collect() returns a list of (labels dict, value) pairs.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, collect):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        REGISTRY.append(self)
+
+
+REGISTRY = []
+
+
+def _ticket_queue_depth():
+    from . import counters
+    counts = counters.get_counts(counters.GLOBAL_KEY)
+    return [({'status': status}, counts[status]) for status in counters.STATUS_FIELDS]
+
+
+REQUEST_LATENCY = Histogram(
+    'tms_http_request_duration_seconds', 'Time to answer a request, by URL name and status code',
+    ['view', 'status'],
+)
+REQUESTS_IN_FLIGHT = Gauge('tms_http_requests_in_flight', 'Requests being handled')
+DB_QUERIES = Counter('tms_db_queries_total', 'SQL statements run while handling requests, by URL name', ['view'])
+CACHE_REQUESTS = Counter(
+    'tms_cache_requests_total', 'Lookups in the in-process caches, by cache and hit or miss',
+    ['cache', 'result'],
+)
+TICKET_QUEUE_DEPTH = CollectedGauge('tms_ticket_queue_depth', 'Tickets by status', _ticket_queue_depth)
+
+
+def record_cache(name, hit):
+    CACHE_REQUESTS.inc(cache=name, result='hit' if hit else 'miss')
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect(directory=None):
+    """Returns {sample key: value} summed over the files of all processes"""
+    directory = directory or metrics_dir()
+    totals = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return totals
+    for filename in names:
+        if filename.startswith(GAUGE_PREFIX):
+            pid = filename[len(GAUGE_PREFIX):-len('.db')]
+            if not pid.isdigit() or not _is_running(int(pid)):
+                continue
+        elif not filename.startswith(COUNTER_PREFIX):
+            continue
+        try:
+            values = read_file(os.path.join(directory, filename))
+        except FileNotFoundError:
+            continue
+        for key, value in values.items():
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else f'{int(value)}.0'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _sample_line(name, labels, value):
+    if labels:
+        rendered = ','.join(f'{label}="{_escape(str(label_value))}"' for label, label_value in labels)
+        return f'{name}{{{rendered}}} {_format_value(value)}'
+    return f'{name} {_format_value(value)}'
+
+
+def _histogram_lines(metric, samples):
+    series = {}
+    for name, labels, value in samples:
+        if name == metric.name + '_bucket':
+            le = dict(labels)['le']
+            base = tuple(label for label in labels if label[0] != 'le')
+            series.setdefault(base, {'buckets': {}, 'sum': 0.0, 'count': 0.0})['buckets'][le] = value
+        else:
+            field = 'sum' if name.endswith('_sum') else 'count'
+            series.setdefault(tuple(labels), {'buckets': {}, 'sum': 0.0, 'count': 0.0})[field] = value
+    lines = []
+    for labels, data in sorted(series.items()):
+        cumulative = 0.0
+        for bound in [_format_value(bucket) for bucket in metric.buckets] + ['+Inf']:
+            cumulative += data['buckets'].get(bound, 0.0)
+            lines.append(_sample_line(metric.name + '_bucket', labels + (('le', bound),), cumulative))
+        lines.append(_sample_line(metric.name + '_sum', labels, data['sum']))
+        lines.append(_sample_line(metric.name + '_count', labels, data['count']))
+    return lines
+
+
+def render(directory=None):
+    """The metrics of all processes in the Prometheus text exposition format"""
+    by_metric = {}
+    for key, value in collect(directory).items():
+        name, labels = json.loads(key)
+        by_metric.setdefault(name, []).append((name, tuple(map(tuple, labels)), value))
+
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        if isinstance(metric, CollectedGauge):
+            for labels, value in metric.collect():
+                lines.append(_sample_line(metric.name, tuple(sorted(labels.items())), value))
+        elif isinstance(metric, Histogram):
+            samples = [sample for suffix in ('_bucket', '_sum', '_count') for sample in by_metric.get(metric.name + suffix, [])]
+            lines.extend(_histogram_lines(metric, samples))
+        else:
+            lines.extend(_sample_line(name, labels, value) for name, labels, value in sorted(by_metric.get(metric.name, [])))
+    return '\n'.join(lines) + '\n'
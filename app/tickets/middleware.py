@@ -1,43 +1,46 @@
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.contrib import messages
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import MiddlewareNotUsed, PermissionDenied
+from django.db import connection
+
+from . import metrics, sampling_profiler, slow_queries
+from .access import get_access
+from .profiling import profile_request
+
+profile_logger = logging.getLogger('tickets.profiling')
+
+# Paths that never need a profile or role check
+ASSET_PREFIXES = ('/static/', '/media/')
+ADMIN_PREFIX = '/admin/'
+
 
 class ProfileCompletionMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
+        # Resolve the exempt URLs once instead of on every request
+        self.exempt_paths = frozenset([reverse('logout'), reverse('profile')])
+        self.exempt_prefixes = (ADMIN_PREFIX,) + ASSET_PREFIXES
 
     def __call__(self, request):
         # Process request - check if profile is completed
-        if request.user.is_authenticated:
-            # Skip check for admin pages
-            if request.path.startswith('/admin/'):
-                return self.get_response(request)
-                
-            # Skip the check for logout URL
-            if request.path == reverse('logout'):
-                return self.get_response(request)
-                
-            # Skip the check for profile URL itself
-            if request.path == reverse('profile'):
-                return self.get_response(request)
-                
-            # Skip for static files
-            if request.path.startswith('/static/') or request.path.startswith('/media/'):
-                return self.get_response(request)
-            
-            # Check if user has a profile and if it's complete
-            try:
-                if not request.user.user_meta.is_profile_completed:
-                    messages.warning(request, 'Please complete your profile before accessing other pages.')
-                    return redirect('profile')
-            except:
-                # If user_meta doesn't exist, proceed normally 
-                # (it will be created in the profile view)
-                pass
-                
-        response = self.get_response(request)
-        return response
+        path = request.path
+        if path.startswith(self.exempt_prefixes) or path in self.exempt_paths:
+            return self.get_response(request)
+
+        access = get_access(request)
+        # Users without a profile proceed normally (it will be created in the profile view)
+        if access.has_profile and not access.is_profile_completed:
+            messages.warning(request, 'Please complete your profile before accessing other pages.')
+            return redirect('profile')
+
+        return self.get_response(request)
 
 
 class RoleBasedAccessMiddleware:
@@ -47,40 +50,130 @@ class RoleBasedAccessMiddleware:
     """
     def __init__(self, get_response):
         self.get_response = get_response
+        self.logout_path = reverse('logout')
+
+    def __call__(self, request):
+        path = request.path
+        # Skip for static files and media
+        if path.startswith(ASSET_PREFIXES):
+            return self.get_response(request)
+
+        access = get_access(request)
+
+        # STRICT ENFORCEMENT: Support agents and admins MUST use the admin panel
+        # (logout is the only other URL they may use)
+        if access.is_staff_role and not path.startswith(ADMIN_PREFIX) and path != self.logout_path:
+            messages.warning(request, f"{access.role.capitalize()} users must use the admin interface.")
+            return redirect(ADMIN_PREFIX)
+
+        # Prevent users from accessing admin pages
+        if access.role == 'user' and path.startswith(ADMIN_PREFIX):
+            messages.warning(request, 'You do not have permission to access the admin area.')
+            return redirect('dashboard')
+
+        return self.get_response(request)
+
+
+class RequestProfilingMiddleware:
+    """Profiles a sample of requests: wall time, SQL count and time, template time, cache hits.
+
+    The sampled share is REQUEST_PROFILING_RATE (0 to 1). The results go out
+    as a Server-Timing header and one JSON log line on the tickets.profiling
+    logger. With a rate of 0 (the default) the middleware removes itself at
+    startup.
+    """
+    def __init__(self, get_response):
+        self.rate = getattr(settings, 'REQUEST_PROFILING_RATE', 0)
+        if self.rate <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
 
     def __call__(self, request):
-        # Process the request before it reaches the view
-        if request.user.is_authenticated:
-            # Skip for static files and media
-            if request.path.startswith('/static/') or request.path.startswith('/media/'):
-                return self.get_response(request)
-                
-            # Check user role
-            try:
-                role = request.user.user_meta.role.name.lower()
-                
-                # STRICT ENFORCEMENT: Support agents and admins MUST use the admin panel
-                if role in ['support_agent', 'admin']:
-                    # Allow access to admin, logout, and static resources only
-                    if request.path.startswith('/admin/'):
-                        # They're accessing admin, which is allowed
-                        pass
-                    elif request.path == reverse('logout'):
-                        # Allow logout
-                        pass
-                    else:
-                        # Redirect to admin for any other URL
-                        messages.warning(request, f"{role.capitalize()} users must use the admin interface.")
-                        return redirect('/admin/')
-                        
-                # Prevent users from accessing admin pages
-                if role == 'user' and request.path.startswith('/admin/'):
-                    messages.warning(request, 'You do not have permission to access the admin area.')
-                    return redirect('dashboard')
-                    
-            except Exception as e:
-                # If role checking fails, proceed normally
-                pass
-                
-        response = self.get_response(request)
+        if self.rate < 1 and random.random() >= self.rate:
+            return self.get_response(request)
+
+        with profile_request() as profile:
+            response = self.get_response(request)
+
+        response['Server-Timing'] = profile.server_timing()
+        match = request.resolver_match
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            **profile.as_dict(),
+        }
+        profile_logger.info(json.dumps(record), extra={'profile': record})
+        return response
+
+
+
+class MetricsMiddleware:
+    """Records every request in the shared metrics: latency by URL name and status,
+    SQL statements by URL name and the number of requests in flight.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        query_count = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            query_count[0] += 1
+            return execute(sql, params, many, context)
+
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_queries):
+                response = self.get_response(request)
+        finally:
+            metrics.REQUESTS_IN_FLIGHT.dec()
+        # Static and media files would only add noise; they are served by the web server in production
+        if request.path.startswith(ASSET_PREFIXES):
+            return response
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - started, view=view, status=response.status_code)
+        if query_count[0]:
+            metrics.DB_QUERIES.inc(query_count[0], view=view)
+        return response
+
+
+class SlowQueryViewMiddleware:
+    """Names the view being served on the statements captured by the slow query log"""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request._slow_query_view = None
+        try:
+            return self.get_response(request)
+        finally:
+            if request._slow_query_view is not None:
+                slow_queries.reset_view(request._slow_query_view)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._slow_query_view = slow_queries.set_view(request.resolver_match.view_name)
+
+
+class SamplingProfilerMiddleware:
+    """Runs the sampling profiler over requests carrying a superuser's profiling token.
+
+    The profile file name is returned in the X-Profile-File header; the files
+    are listed in the admin (Slow queries > Request profiles).
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = sampling_profiler.requested_token(request)
+        if not token or not sampling_profiler.token_is_valid(token, request.user):
+            return self.get_response(request)
+
+        with sampling_profiler.sample_current_thread() as sampler:
+            response = self.get_response(request)
+        response['X-Profile-File'] = sampling_profiler.save(sampler, request)
         return response
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.7 on 2026-10-17 21:48
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_counters(apps, schema_editor):
+    Ticket = apps.get_model('tickets', 'Ticket')
+    TicketStatusCounter = apps.get_model('tickets', 'TicketStatusCounter')
+    statuses = ['pending', 'in_progress', 'resolved', 'closed']
+
+    counts = defaultdict(lambda: defaultdict(int))
+    groups = Ticket.objects.order_by().values('status', 'assigned_to_id', 'user_id').annotate(count=Count('id'))
+    for group in groups:
+        keys = ['global']
+        if group['assigned_to_id']:
+            keys.append(f"agent:{group['assigned_to_id']}")
+        if group['user_id']:
+            keys.append(f"user:{group['user_id']}")
+        for key in keys:
+            counts[key]['total'] += group['count']
+            if group['status'] in statuses:
+                counts[key][group['status']] += group['count']
+
+    TicketStatusCounter.objects.bulk_create(
+        [TicketStatusCounter(key=key, **values) for key, values in counts.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0008_ticketaction_action_taken_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketStatusCounter',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('total', models.IntegerField(default=0)),
+                ('pending', models.IntegerField(default=0)),
+                ('in_progress', models.IntegerField(default=0)),
+                ('resolved', models.IntegerField(default=0)),
+                ('closed', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-17 21:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import timedelta
+
+
+def link_media_to_responses(apps, schema_editor):
+    # Attachments used to be stored without a link to their response. Files
+    # posted with a reply were saved in the same request, so match each one to
+    # the requester's latest response on the ticket written just before it.
+    Media = apps.get_model('tickets', 'Media')
+    TicketResponse = apps.get_model('tickets', 'TicketResponse')
+
+    for media in Media.objects.filter(ticket__isnull=False, response__isnull=True).iterator():
+        response = TicketResponse.objects.filter(
+            ticket_id=media.ticket_id,
+            user_id=media.user_id,
+            created_at__lte=media.uploaded_at,
+            created_at__gte=media.uploaded_at - timedelta(minutes=1),
+        ).order_by('-created_at').first()
+        if response:
+            Media.objects.filter(pk=media.pk).update(response=response)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0009_ticketstatuscounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='response',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='media', to='tickets.ticketresponse'),
+        ),
+        migrations.RunPython(link_media_to_responses, migrations.RunPython.noop),
+    ]
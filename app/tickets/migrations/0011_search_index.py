@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# The search schema as of this migration, per database vendor (forward, reverse).
+# MySQL fills FULLTEXT indexes from the existing rows; the SQLite index starts
+# empty, so run rebuild_search_index after migrating a database with tickets.
+SEARCH_SCHEMA = {
+    'mysql': (
+        [
+            'CREATE FULLTEXT INDEX tickets_ticket_title_description_ft ON tickets_ticket (title, description)',
+            'CREATE FULLTEXT INDEX tickets_ticketresponse_message_ft ON tickets_ticketresponse (message)',
+        ],
+        [
+            'DROP INDEX tickets_ticket_title_description_ft ON tickets_ticket',
+            'DROP INDEX tickets_ticketresponse_message_ft ON tickets_ticketresponse',
+        ],
+    ),
+    'sqlite': (
+        [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS tickets_search_index "
+            "USING fts5(title, body, ticket_id UNINDEXED, tokenize='porter unicode61')",
+        ],
+        [
+            'DROP TABLE IF EXISTS tickets_search_index',
+        ],
+    ),
+}
+
+
+def install_search_index(apps, schema_editor):
+    for sql in SEARCH_SCHEMA.get(schema_editor.connection.vendor, ([], []))[0]:
+        schema_editor.execute(sql)
+
+
+def uninstall_search_index(apps, schema_editor):
+    for sql in SEARCH_SCHEMA.get(schema_editor.connection.vendor, ([], []))[1]:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0010_media_response'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-17 21:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0011_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheGeneration',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('generation', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,110 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The role permission mapping as of this migration, frozen so later edits to
+# tickets.permissions do not change what it does
+ROLE_PERMISSION_MAPPING = {
+    'view_all_tickets': ['view_ticket'],
+    'edit_all_tickets': ['change_ticket'],
+    'assign_tickets': ['change_ticket'],
+    'view_assigned_tickets': ['view_ticket'],
+    'respond_to_tickets': ['add_ticketresponse', 'view_ticketresponse', 'change_ticketresponse'],
+    'close_tickets': ['change_ticket'],
+    'manage_users': ['view_user', 'change_user'],
+    'manage_categories': ['add_ticketcategory', 'change_ticketcategory', 'view_ticketcategory'],
+    'manage_faq': ['add_faqknowledgebase', 'change_faqknowledgebase', 'view_faqknowledgebase'],
+}
+SUPPORT_AGENT_MODELS = ('ticket', 'ticketresponse', 'ticketaction')
+SUPPORT_AGENT_EXTRA = ('add_ticketresponse', 'add_ticketaction')
+
+
+def resolve(permissions, role_name, role_permissions):
+    """Returns the Permission ids a role grants, from (id, codename, app_label, model) rows"""
+    permission_ids = set()
+    for role_perm in role_permissions:
+        for django_perm in ROLE_PERMISSION_MAPPING.get(role_perm, ()):
+            action, model = django_perm.split('_', 1)
+            permission_ids.update(pk for pk, codename, _, _ in permissions
+                                  if codename.startswith(action) and codename.endswith(model))
+    if (role_name or '').lower() == 'support_agent':
+        permission_ids.update(pk for pk, codename, app_label, model in permissions
+                              if app_label == 'tickets' and model in SUPPORT_AGENT_MODELS and codename == f'view_{model}')
+        permission_ids.update(pk for pk, codename, app_label, _ in permissions
+                              if app_label == 'tickets' and codename in SUPPORT_AGENT_EXTRA)
+    return permission_ids
+
+
+def collapse_user_permissions(apps, schema_editor):
+    """Moves each role's per-user permission copies onto one group per role"""
+    Role = apps.get_model('tickets', 'Role')
+    UserMeta = apps.get_model('tickets', 'UserMeta')
+    Group = apps.get_model('auth', 'Group')
+    Permission = apps.get_model('auth', 'Permission')
+    User = apps.get_model('auth', 'User')
+    UserPermission = User.user_permissions.through
+    Membership = User.groups.through
+    GroupPermission = Group.permissions.through
+
+    permissions = list(Permission.objects.values_list('id', 'codename', 'content_type__app_label', 'content_type__model'))
+    for role in Role.objects.all():
+        # Same name as tickets.permissions.group_name
+        group, _ = Group.objects.get_or_create(name=f'{role.name} (role #{role.pk})'[-150:])
+        role.group = group
+        role.save(update_fields=['group'])
+
+        permission_ids = resolve(permissions, role.name, [p.strip() for p in (role.permissions or '').split(',') if p.strip()])
+        GroupPermission.objects.bulk_create(
+            [GroupPermission(group_id=group.pk, permission_id=pk) for pk in permission_ids],
+            ignore_conflicts=True
+        )
+
+        user_ids = list(UserMeta.objects.filter(role=role).values_list('user_id', flat=True))
+        Membership.objects.bulk_create(
+            [Membership(user_id=user_id, group_id=group.pk) for user_id in user_ids],
+            batch_size=1000, ignore_conflicts=True
+        )
+        # Direct rows the group now provides are redundant; anything else was granted by hand
+        UserPermission.objects.filter(
+            user_id__in=UserMeta.objects.filter(role=role).values('user_id'),
+            permission_id__in=permission_ids
+        ).delete()
+
+
+def expand_user_permissions(apps, schema_editor):
+    """Copies each role group's permissions back onto its members and drops the groups"""
+    Role = apps.get_model('tickets', 'Role')
+    UserMeta = apps.get_model('tickets', 'UserMeta')
+    Group = apps.get_model('auth', 'Group')
+    User = apps.get_model('auth', 'User')
+    UserPermission = User.user_permissions.through
+    GroupPermission = Group.permissions.through
+
+    for role in Role.objects.filter(group__isnull=False):
+        permission_ids = list(GroupPermission.objects.filter(group_id=role.group_id).values_list('permission_id', flat=True))
+        UserPermission.objects.bulk_create(
+            [UserPermission(user_id=user_id, permission_id=pk)
+             for user_id in UserMeta.objects.filter(role=role).values_list('user_id', flat=True)
+             for pk in permission_ids],
+            batch_size=1000, ignore_conflicts=True
+        )
+        Group.objects.filter(pk=role.group_id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('tickets', '0012_cachegeneration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='role',
+            name='group',
+            field=models.OneToOneField(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ticket_role', to='auth.group'),
+        ),
+        migrations.RunPython(collapse_user_permissions, expand_user_permissions),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:07
+
+from django.db import migrations, models
+
+PRIORITY_RANKS = {'urgent': 0, 'high': 1, 'medium': 2, 'low': 3}
+
+
+def populate_priority_rank(apps, schema_editor):
+    Ticket = apps.get_model('tickets', 'Ticket')
+    for priority, rank in PRIORITY_RANKS.items():
+        Ticket.objects.filter(priority=priority).update(priority_rank=rank)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0013_role_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='priority_rank',
+            field=models.PositiveSmallIntegerField(default=2, editable=False),
+        ),
+        migrations.RunPython(populate_priority_rank, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['status', 'assigned_to', 'priority_rank', 'created_at', 'id'], name='ticket_queue_idx'),
+        ),
+    ]
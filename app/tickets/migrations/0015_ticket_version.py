@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0014_ticket_priority_rank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:16
+
+from django.db import migrations, models
+
+
+class AddIndexesOnline(migrations.operations.base.Operation):
+    """Adds several indexes to one table without blocking writes.
+
+    On MySQL the indexes are built by a single ALTER TABLE, so the table is
+    read once, with ALGORITHM=INPLACE, LOCK=NONE: InnoDB keeps serving reads
+    and writes meanwhile, and the statement fails rather than silently
+    falling back to a copying, locking rebuild. Other databases use the
+    regular CREATE INDEX.
+    """
+    reduces_to_sql = True
+
+    def __init__(self, model_name, indexes):
+        self.model_name = model_name
+        self.indexes = indexes
+
+    def deconstruct(self):
+        return self.__class__.__name__, [], {'model_name': self.model_name, 'indexes': self.indexes}
+
+    def state_forwards(self, app_label, state):
+        for index in self.indexes:
+            state.add_index(app_label, self.model_name.lower(), index)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if schema_editor.connection.vendor != 'mysql':
+            for index in self.indexes:
+                schema_editor.add_index(model, index)
+            return
+        quote = schema_editor.quote_name
+        clauses = [
+            'ADD INDEX {} ({})'.format(
+                quote(index.name),
+                ', '.join(quote(model._meta.get_field(field).column) for field in index.fields),
+            )
+            for index in self.indexes
+        ]
+        schema_editor.execute('ALTER TABLE {} {}, ALGORITHM=INPLACE, LOCK=NONE'.format(
+            quote(model._meta.db_table), ', '.join(clauses)
+        ))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            for index in self.indexes:
+                schema_editor.remove_index(model, index)
+
+    def describe(self):
+        return 'Create indexes {} on {} without locking'.format(
+            ', '.join(index.name for index in self.indexes), self.model_name
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0015_ticket_version'),
+    ]
+
+    operations = [
+        AddIndexesOnline(
+            model_name='faqknowledgebase',
+            indexes=[
+                models.Index(fields=['category', 'order', 'question', 'id'], name='faq_order_idx'),
+            ],
+        ),
+        AddIndexesOnline(
+            model_name='media',
+            indexes=[
+                models.Index(fields=['ticket', 'uploaded_at', 'id'], name='media_ticket_time_idx'),
+            ],
+        ),
+        AddIndexesOnline(
+            model_name='ticket',
+            indexes=[
+                models.Index(fields=['created_at', 'id'], name='ticket_recent_idx'),
+                models.Index(fields=['status', 'created_at', 'id'], name='ticket_status_recent_idx'),
+                models.Index(fields=['assigned_to', 'created_at', 'id'], name='ticket_agent_recent_idx'),
+                models.Index(fields=['assigned_to', 'status', 'created_at', 'id'], name='ticket_agent_status_idx'),
+                models.Index(fields=['user', 'created_at', 'id'], name='ticket_user_recent_idx'),
+            ],
+        ),
+        AddIndexesOnline(
+            model_name='ticketaction',
+            indexes=[
+                models.Index(fields=['ticket', 'created_at', 'id'], name='action_ticket_time_idx'),
+            ],
+        ),
+        AddIndexesOnline(
+            model_name='ticketresponse',
+            indexes=[
+                models.Index(fields=['ticket', 'created_at', 'id'], name='response_ticket_time_idx'),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0016_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recorded_at', models.DateTimeField()),
+                ('duration_ms', models.FloatField()),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('normalized_sql', models.TextField()),
+                ('sql', models.TextField()),
+                ('params', models.TextField(blank=True)),
+                ('database', models.CharField(default='default', max_length=100)),
+                ('view_name', models.CharField(blank=True, max_length=200)),
+                ('stack', models.TextField(blank=True)),
+                ('explain', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Slow queries',
+                'indexes': [models.Index(fields=['fingerprint', 'recorded_at'], name='slowquery_fingerprint_idx'), models.Index(fields=['recorded_at'], name='slowquery_recorded_idx')],
+            },
+        ),
+    ]
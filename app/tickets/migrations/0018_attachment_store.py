@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:54
+
+from django.db import migrations, models
+import posixpath
+
+import tickets.storage
+
+
+def fill_original_names(apps, schema_editor):
+    # Existing uploads keep their files; their names were the uploaders' names
+    Media = apps.get_model('tickets', 'Media')
+    for media in Media.objects.filter(original_name='').iterator():
+        Media.objects.filter(pk=media.pk).update(original_name=posixpath.basename(media.file.name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0017_slowquery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('file_type', models.CharField(max_length=50)),
+                ('reference_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='original_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='media',
+            name='file',
+            field=models.FileField(storage=tickets.storage.ContentAddressedStorage(), upload_to='uploads/'),
+        ),
+        migrations.RunPython(fill_original_names, migrations.RunPython.noop),
+    ]
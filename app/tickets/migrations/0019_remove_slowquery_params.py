@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:55
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0018_attachment_store'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='slowquery',
+            name='params',
+        ),
+    ]
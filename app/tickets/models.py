@@ -1,9 +1,14 @@
-from django.db import models
-from django.contrib.auth.models import User
+import os
+from functools import lru_cache
+
+from django.db import models, router, transaction
+from django.contrib.auth.models import Group, User
 from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from .storage import IMAGE_TYPES, attachment_storage, extension
+
 # Role model for user permissions
 class Role(models.Model):
     AVAILABLE_PERMISSIONS = [
@@ -17,30 +22,64 @@ class Role(models.Model):
         ('manage_categories', 'Can manage ticket categories'),
         ('manage_faq', 'Can manage FAQ/Knowledge Base'),
     ]
+    # One bit per permission, in AVAILABLE_PERMISSIONS order
+    PERMISSION_BITS = {codename: 1 << index for index, (codename, _) in enumerate(AVAILABLE_PERMISSIONS)}
+    ALL_PERMISSIONS = (1 << len(AVAILABLE_PERMISSIONS)) - 1
     
     name = models.CharField(max_length=100)
     permissions = models.TextField(blank=True, null=True, help_text="Comma-separated list of permissions")
+    # Django group holding the role's auth permissions; users with the role are its members
+    group = models.OneToOneField(Group, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='ticket_role')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
         
+    def save(self, *args, **kwargs):
+        # Drop the compiled permissions so they are rebuilt from the saved values
+        self.__dict__.pop('_compiled_permissions', None)
+        super(Role, self).save(*args, **kwargs)
+        
     def get_permissions(self):
         """Returns the list of permissions for this role"""
         if not self.permissions:
             return []
         return [p.strip() for p in self.permissions.split(',') if p.strip()]
     
+    @property
+    def permission_mask(self):
+        """Bitmask of this role's permissions (every bit for the admin role)"""
+        key = (self.name, self.permissions)
+        compiled = self.__dict__.get('_compiled_permissions')
+        if compiled is None or compiled[0] != key:
+            compiled = (key, compile_permissions(*key))
+            self._compiled_permissions = compiled
+        return compiled[1]
+    
+    @classmethod
+    def mask_for(cls, permissions):
+        """Returns the bitmask for permission codenames, or None if any is unknown"""
+        mask = 0
+        for permission in permissions:
+            bit = cls.PERMISSION_BITS.get(permission)
+            if bit is None:
+                return None
+            mask |= bit
+        return mask
+    
     def has_permission(self, permission):
         """Check if this role has the specified permission"""
-        if not self.permissions:
+        bit = self.PERMISSION_BITS.get(permission)
+        return bit is not None and self.permission_mask & bit == bit
+    
+    def has_permissions(self, *permissions, require_all=True):
+        """Check several permissions at once; any one is enough when require_all is False"""
+        required = self.mask_for(permissions)
+        if not required:
             return False
-        permissions = self.get_permissions()
-        # Admin role has all permissions
-        if self.name.lower() == 'admin':
-            return True
-        return permission in permissions
+        granted = self.permission_mask & required
+        return granted == required if require_all else bool(granted)
     
     def set_permissions(self, permissions_list):
         """Set permissions from a list of permission strings"""
@@ -54,8 +93,7 @@ class Role(models.Model):
         permissions = self.get_permissions()
         
         # Check if the permission is valid
-        valid_permissions = [p[0] for p in self.AVAILABLE_PERMISSIONS]
-        if permission_name not in valid_permissions:
+        if permission_name not in self.PERMISSION_BITS:
             raise ValueError(f"Invalid permission: {permission_name}")
             
         if has_permission and permission_name not in permissions:
@@ -66,6 +104,21 @@ class Role(models.Model):
         self.permissions = ",".join(permissions)
         self.save()
 
+@lru_cache(maxsize=128)
+def compile_permissions(name, permissions):
+    """Compiles a role name and comma-separated permissions into a bitmask.
+
+    Cached per process on the exact values, so every Role instance loaded with
+    the same permissions shares one parse and an edited role compiles afresh.
+    """
+    # Admin role has all permissions
+    if (name or '').lower() == 'admin':
+        return Role.ALL_PERMISSIONS
+    mask = 0
+    for permission in (permissions or '').split(','):
+        mask |= Role.PERMISSION_BITS.get(permission.strip(), 0)
+    return mask
+
 # User metadata model
 class UserMeta(models.Model):
     GENDER_CHOICES = (
@@ -131,6 +184,8 @@ class Ticket(models.Model):
         ('high', 'High'),
         ('urgent', 'Urgent'),
     ]
+    # Sortable form of priority, most urgent first
+    PRIORITY_RANKS = {'urgent': 0, 'high': 1, 'medium': 2, 'low': 3}
     
     # Relationship fields
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='tickets')
@@ -142,13 +197,60 @@ class Ticket(models.Model):
     description = models.TextField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     priority = models.CharField(max_length=10, choices=PRIORITY_CHOICES, default='medium')
+    priority_rank = models.PositiveSmallIntegerField(default=2, editable=False)
+    # Incremented on every write, for optimistic concurrency control (see tickets.concurrency)
+    version = models.PositiveIntegerField(default=0, editable=False)
     
     # Timestamp fields
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            # Work queue: unassigned tickets of a status, most urgent then oldest first
+            models.Index(fields=['status', 'assigned_to', 'priority_rank', 'created_at', 'id'], name='ticket_queue_idx'),
+            # Newest-first lists (keyset pagination over created_at, id) for each scope
+            models.Index(fields=['created_at', 'id'], name='ticket_recent_idx'),
+            models.Index(fields=['status', 'created_at', 'id'], name='ticket_status_recent_idx'),
+            models.Index(fields=['assigned_to', 'created_at', 'id'], name='ticket_agent_recent_idx'),
+            models.Index(fields=['assigned_to', 'status', 'created_at', 'id'], name='ticket_agent_status_idx'),
+            models.Index(fields=['user', 'created_at', 'id'], name='ticket_user_recent_idx'),
+        ]
+    
     def __str__(self):
         return f"#{self.id} - {self.title}"
+    
+    def save(self, *args, **kwargs):
+        from . import counters
+        
+        # Keep the sortable rank in step with priority
+        self.priority_rank = self.PRIORITY_RANKS.get(self.priority, self.PRIORITY_RANKS['medium'])
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'priority' in update_fields:
+            update_fields = set(update_fields) | {'priority_rank'}
+        
+        # Previous (status, assigned_to_id, user_id), for the counter signals
+        self._counter_state = None
+        if self._state.adding or self.pk is None:
+            super(Ticket, self).save(*args, **kwargs)
+            return
+        
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'version'}
+        using = kwargs.get('using') or router.db_for_write(Ticket, instance=self)
+        with transaction.atomic(using=using):
+            # Locked until the write commits, so concurrent saves of this ticket queue
+            # up and each moves the counters from the state the other one left
+            stored = (
+                Ticket.objects.using(using).select_for_update().filter(pk=self.pk)
+                .values_list('version', *counters.TRACKED_FIELDS).first()
+            )
+            if stored is not None:
+                # Every write bumps the stored version, even from a stale instance
+                self.version = stored[0] + 1
+                if update_fields is None or {'status', 'assigned_to', 'user'} & set(update_fields):
+                    self._counter_state = stored[1:]
+            super(Ticket, self).save(*args, **kwargs)
         
     @property
     def ticket_id(self):
@@ -158,6 +260,48 @@ class Ticket(models.Model):
     def get_absolute_url(self):
         return reverse('ticket_detail', args=[str(self.id)])
 
+# Ticket status counter model
+class TicketStatusCounter(models.Model):
+    """Denormalised ticket counts per scope, maintained by the Ticket signal handlers.
+
+    Keys are 'global', 'agent:<user id>' (tickets assigned to the agent) and
+    'user:<user id>' (tickets raised by the requester).
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    total = models.IntegerField(default=0)
+    pending = models.IntegerField(default=0)
+    in_progress = models.IntegerField(default=0)
+    resolved = models.IntegerField(default=0)
+    closed = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.key}: {self.total} tickets"
+
+# Cache generation model
+class CacheGeneration(models.Model):
+    """Shared counter bumped whenever the data behind a per-process cache changes.
+
+    Worker processes compare it with the generation their cache was built
+    from to know when to rebuild.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    generation = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} (generation {self.generation})"
+    
+    @classmethod
+    def current(cls, name):
+        """Returns the current generation for name (0 if it was never bumped)"""
+        generation = cls.objects.filter(pk=name).values_list('generation', flat=True).first()
+        return generation or 0
+    
+    @classmethod
+    def bump(cls, name):
+        """Atomically increments the generation for name"""
+        if not cls.objects.filter(pk=name).update(generation=models.F('generation') + 1):
+            cls.objects.get_or_create(name=name, defaults={'generation': 1})
+
 # Ticket response model
 class TicketResponse(models.Model):
     ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, related_name='responses')
@@ -166,6 +310,12 @@ class TicketResponse(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Ticket timeline, oldest first
+            models.Index(fields=['ticket', 'created_at', 'id'], name='response_ticket_time_idx'),
+        ]
+
     def __str__(self):
         return f"Response to {self.ticket.title} by {self.user.username}"
 
@@ -192,8 +342,15 @@ class TicketAction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True, null=True)
     
+    class Meta:
+        indexes = [
+            # Ticket timeline and the admin inline (newest first), walked in either direction
+            models.Index(fields=['ticket', 'created_at', 'id'], name='action_ticket_time_idx'),
+        ]
+    
     def __str__(self):
-        return f"{self.get_action_type_display()} by {self.performed_by.username} on {self.created_at.strftime('%Y-%m-%d %H:%M')}"
+        performer = self.performed_by.username if self.performed_by_id else 'system'
+        return f"{self.get_action_type_display()} by {performer} on {self.created_at.strftime('%Y-%m-%d %H:%M')}"
 
 # FAQ/Knowledge Base model
 class FAQKnowledgeBase(models.Model):
@@ -222,17 +379,90 @@ class FAQKnowledgeBase(models.Model):
         verbose_name = "FAQ Item"
         verbose_name_plural = "FAQ Knowledge Base"
         ordering = ['category', 'order', 'question']
+        indexes = [
+            # Display order; published FAQs are read by walking it (is_published is
+            # tested as a bare boolean, which an index cannot seek on)
+            models.Index(fields=['category', 'order', 'question', 'id'], name='faq_order_idx'),
+        ]
+
+# Attachment file kept once per content by tickets.storage
+class StoredFile(models.Model):
+    """A distinct attachment file, shared by every Media row with the same bytes.
+
+    reference_count is the number of Media rows using the file; the file is
+    deleted along with the last of them.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    # Detected from the content, as a file extension
+    file_type = models.CharField(max_length=50)
+    reference_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.reference_count} references)"
 
 # Media model for file uploads
 class Media(models.Model):
     ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, related_name='media', null=True, blank=True)
+    response = models.ForeignKey(TicketResponse, on_delete=models.CASCADE, related_name='media', null=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='media')
-    file = models.FileField(upload_to='uploads/')
+    # Stored under the SHA-256 of the content; the uploader's file name is kept in original_name
+    file = models.FileField(upload_to='uploads/', storage=attachment_storage)
+    original_name = models.CharField(max_length=255, blank=True)
     file_type = models.CharField(max_length=50)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         verbose_name_plural = "Media"
+        indexes = [
+            # Attachments of a ticket in upload order
+            models.Index(fields=['ticket', 'uploaded_at', 'id'], name='media_ticket_time_idx'),
+        ]
     
     def __str__(self):
         return f"File uploaded by {self.user.username} at {self.uploaded_at.strftime('%Y-%m-%d %H:%M')}"
+    
+    def save(self, *args, **kwargs):
+        if self.file and not self.file._committed:
+            # Store the upload now rather than in the field's pre_save: the stored
+            # name carries the type read from the content
+            self.original_name = self.original_name or os.path.basename(self.file.name)
+            self.file.save(self.file.name, self.file.file, save=False)
+        if self.file:
+            self.file_type = extension(self.file.name)
+        super().save(*args, **kwargs)
+    
+    @property
+    def display_name(self):
+        return self.original_name or os.path.basename(self.file.name)
+    
+    @property
+    def is_image(self):
+        """Whether the file gets thumbnails (see tickets.thumbnails)"""
+        return extension(self.file.name) in IMAGE_TYPES
+
+# Slow query log, written in batches by tickets.slow_queries
+class SlowQuery(models.Model):
+    recorded_at = models.DateTimeField()
+    duration_ms = models.FloatField()
+    # Hash of the SQL with its literals and parameters replaced, shared by repeats of one query
+    fingerprint = models.CharField(max_length=40)
+    normalized_sql = models.TextField()
+    # The statement as issued, placeholders and all; parameter values are never stored
+    sql = models.TextField()
+    database = models.CharField(max_length=100, default='default')
+    view_name = models.CharField(max_length=200, blank=True)
+    stack = models.TextField(blank=True)
+    explain = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name_plural = "Slow queries"
+        indexes = [
+            models.Index(fields=['fingerprint', 'recorded_at'], name='slowquery_fingerprint_idx'),
+            models.Index(fields=['recorded_at'], name='slowquery_recorded_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.duration_ms:.0f} ms: {self.normalized_sql[:80]}"
@@ -0,0 +1,133 @@
+"""
+Keyset (cursor) pagination over (created_at, id), newest first.
+
+Unlike django.core.paginator.Paginator this never issues COUNT(*) or OFFSET:
+each page is a range scan starting from the position stored in an opaque,
+signed cursor token, so page N costs the same as page 1.
+"""
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = 'tickets.pagination.cursor'
+DEFAULT_PAGE_SIZE = 10
+
+
+def encode_cursor(obj, direction):
+    """Returns an opaque token pointing before ('next') or after ('prev') obj"""
+    return signing.dumps(
+        {'t': obj.created_at.isoformat(), 'i': obj.pk, 'd': direction},
+        salt=CURSOR_SALT, compress=True
+    )
+
+
+def decode_cursor(token):
+    """Returns (created_at, id, direction) for a token, or None if it is missing or invalid"""
+    if not token:
+        return None
+    try:
+        data = signing.loads(token, salt=CURSOR_SALT)
+        return datetime.fromisoformat(data['t']), int(data['i']), data['d']
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+class CursorPage:
+    """One page of results plus the tokens needed to move to its neighbours"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.has_next = next_cursor is not None
+        self.has_previous = previous_cursor is not None
+        self.total = None
+        self.total_is_exact = False
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+
+def paginate(queryset, cursor=None, per_page=DEFAULT_PAGE_SIZE):
+    """Returns the CursorPage of queryset selected by the cursor token.
+
+    The queryset's own ordering is replaced by (-created_at, -id); a missing or
+    tampered token yields the first page. One query is issued per page.
+    """
+    position = decode_cursor(cursor)
+
+    if position is None:
+        rows = list(queryset.order_by('-created_at', '-id')[:per_page + 1])
+        return _keyset_page(rows[:per_page], has_next=len(rows) > per_page, has_previous=False)
+
+    created_at, pk, direction = position
+    if direction == 'prev':
+        # Walk backwards (towards newer tickets) and flip the slice for display
+        after = Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+        rows = list(queryset.filter(after).order_by('created_at', 'id')[:per_page + 1])
+        has_previous = len(rows) > per_page
+        rows = rows[:per_page]
+        rows.reverse()
+        return _keyset_page(rows, has_next=bool(rows), has_previous=has_previous)
+
+    before = Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+    rows = list(queryset.filter(before).order_by('-created_at', '-id')[:per_page + 1])
+    return _keyset_page(rows[:per_page], has_next=len(rows) > per_page, has_previous=bool(rows))
+
+
+def _keyset_page(rows, has_next, has_previous):
+    return CursorPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1], 'next') if has_next else None,
+        previous_cursor=encode_cursor(rows[0], 'prev') if has_previous else None,
+    )
+
+
+def paginate_ranked(queryset, ranked_ids, cursor=None, per_page=DEFAULT_PAGE_SIZE):
+    """Returns a CursorPage over an already ranked list of primary keys.
+
+    The list is bounded by the search limit, so the cursor simply records an
+    offset into it; only the rows on the page are fetched.
+    """
+    try:
+        offset = max(int(signing.loads(cursor, salt=CURSOR_SALT)['o']), 0) if cursor else 0
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        offset = 0
+    page_ids = ranked_ids[offset:offset + per_page]
+    objects = queryset.in_bulk(page_ids)
+
+    next_offset = offset + per_page
+    return CursorPage(
+        [objects[pk] for pk in page_ids if pk in objects],
+        next_cursor=signing.dumps({'o': next_offset}, salt=CURSOR_SALT) if next_offset < len(ranked_ids) else None,
+        previous_cursor=signing.dumps({'o': max(offset - per_page, 0)}, salt=CURSOR_SALT) if offset else None,
+    )
+
+
+def filter_querystring(request):
+    """Returns the request's query string without the cursor, for building page links"""
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    params.pop('page', None)
+    return params.urlencode()
+
+
+def approximate_count(queryset, limit=1000):
+    """Counts at most limit + 1 rows of queryset.
+
+    Returns (count, is_exact); when the cap is hit the count is a lower bound.
+    """
+    count = queryset.order_by()[:limit + 1].count()
+    if count > limit:
+        return limit, False
+    return count, True
@@ -0,0 +1,109 @@
+"""
+Cross-request cache of each user's role and effective auth permissions.
+
+The admin asks has_perm/has_module_perms many times per page and Django only
+caches the answer on the user object of a single request. Each worker keeps
+the resolved role and permission set per user in memory instead. Any change
+to roles, role assignments or permission rows bumps a shared CacheGeneration
+row; workers compare it with the generation their entries were loaded under
+(at most once per CHECK_INTERVAL seconds) and drop everything when it moved.
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from django.contrib.auth.backends import ModelBackend
+
+from .models import CacheGeneration, UserMeta
+from .profiling import record_cache
+
+GENERATION_NAME = 'permissions'
+
+# Seconds between generation checks in a process
+CHECK_INTERVAL = 1.0
+
+# Users kept per process, least recently used dropped first
+MAX_USERS = 10000
+
+
+@dataclass(frozen=True)
+class EffectivePermissions:
+    """A user's role name (lowercase) and 'app_label.codename' permissions"""
+    role: Optional[str]
+    permissions: frozenset
+
+    @property
+    def is_support_agent(self):
+        return self.role == 'support_agent'
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
+
+NO_PERMISSIONS = EffectivePermissions(role=None, permissions=frozenset())
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_generation = None
+_checked_at = 0.0
+
+
+def _current_generation():
+    """Returns the generation entries are valid for, dropping them if it moved"""
+    global _generation, _checked_at
+    now = time.monotonic()
+    if _generation is not None and now - _checked_at < CHECK_INTERVAL:
+        return _generation
+
+    generation = CacheGeneration.current(GENERATION_NAME)
+    with _lock:
+        if generation != _generation:
+            _entries.clear()
+            _generation = generation
+        _checked_at = now
+    return generation
+
+
+def _load(user):
+    role = UserMeta.objects.filter(user_id=user.pk).values_list('role__name', flat=True).first()
+    backend = ModelBackend()
+    permissions = backend.get_user_permissions(user) | backend.get_group_permissions(user)
+    return EffectivePermissions(role=role.lower() if role else None, permissions=frozenset(permissions))
+
+
+def get(user):
+    """Returns the EffectivePermissions of user, loading them on a miss"""
+    if not user.is_authenticated:
+        return NO_PERMISSIONS
+    # Superuser and active flags live on the user row itself
+    key = (user.pk, user.is_superuser, user.is_active)
+    generation = _current_generation()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+            record_cache('permissions', hit=True)
+            return entry
+
+    record_cache('permissions', hit=False)
+
+    # Loaded outside the lock; only stored if nothing changed meanwhile
+    entry = _load(user)
+    with _lock:
+        if generation == _generation:
+            _entries[key] = entry
+            while len(_entries) > MAX_USERS:
+                _entries.popitem(last=False)
+    return entry
+
+
+def invalidate():
+    """Marks every process's cached permissions stale"""
+    global _generation
+    CacheGeneration.bump(GENERATION_NAME)
+    with _lock:
+        _entries.clear()
+        _generation = None
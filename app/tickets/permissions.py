@@ -0,0 +1,176 @@
+"""
+Sync of Django auth permissions from ticket roles.
+
+A role's permission string maps to a set of auth Permission ids, resolved in
+Python from a per-process codename map (Permission rows only change on
+migrate). Each Role is backed by a Django Group holding those permissions and
+users with the role are simply members of it, so editing a role rewrites one
+group's rows however many users hold it. Through-table rows are synced by
+diffing against the current rows: one bulk insert and one bulk delete.
+"""
+import threading
+from collections import defaultdict
+
+from django.contrib.auth.models import Group, Permission, User
+
+from .models import Role
+
+# Map our custom permissions to Django's permission system
+ROLE_PERMISSION_MAPPING = {
+    'view_all_tickets': ['view_ticket'],
+    'edit_all_tickets': ['change_ticket'],
+    'assign_tickets': ['change_ticket'],
+    'view_assigned_tickets': ['view_ticket'],
+    'respond_to_tickets': ['add_ticketresponse', 'view_ticketresponse', 'change_ticketresponse'],
+    'close_tickets': ['change_ticket'],
+    'manage_users': ['view_user', 'change_user'],
+    'manage_categories': ['add_ticketcategory', 'change_ticketcategory', 'view_ticketcategory'],
+    'manage_faq': ['add_faqknowledgebase', 'change_faqknowledgebase', 'view_faqknowledgebase'],
+}
+
+# Extra model permissions for support agents: view the ticket models, add
+# responses and internal notes (never change tickets)
+SUPPORT_AGENT_MODELS = ('ticket', 'ticketresponse', 'ticketaction')
+SUPPORT_AGENT_EXTRA = ('add_ticketresponse', 'add_ticketaction')
+
+INSERT_BATCH_SIZE = 1000
+
+_lock = threading.Lock()
+_codenames = None
+_resolved = {}
+
+
+def codename_map():
+    """Returns {codename: [(permission id, app_label, model), ...]}, loaded once per process"""
+    global _codenames
+    with _lock:
+        if _codenames is None:
+            codenames = defaultdict(list)
+            rows = Permission.objects.values_list(
+                'id', 'codename', 'content_type__app_label', 'content_type__model'
+            )
+            for pk, codename, app_label, model in rows:
+                codenames[codename].append((pk, app_label, model))
+            _codenames = dict(codenames)
+        return _codenames
+
+
+def clear_cache():
+    """Forgets the codename map and resolved roles; called after migrate"""
+    global _codenames
+    with _lock:
+        _codenames = None
+        _resolved.clear()
+
+
+def resolve(role_name, role_permissions):
+    """Returns the frozenset of Permission ids granted by a role name and permission list"""
+    key = ((role_name or '').lower(), tuple(role_permissions))
+    resolved = _resolved.get(key)
+    if resolved is not None:
+        return resolved
+
+    codenames = codename_map()
+    permission_ids = set()
+    for role_perm in key[1]:
+        for django_perm in ROLE_PERMISSION_MAPPING.get(role_perm, ()):
+            # Same loose match as before: any codename starting with the
+            # action and ending with the model name
+            parts = django_perm.split('_', 1)
+            if len(parts) < 2:
+                continue
+            action, model = parts
+            for codename, permissions in codenames.items():
+                if codename.startswith(action) and codename.endswith(model):
+                    permission_ids.update(pk for pk, _, _ in permissions)
+
+    if key[0] == 'support_agent':
+        for model in SUPPORT_AGENT_MODELS:
+            permission_ids.update(
+                pk for pk, app_label, perm_model in codenames.get(f'view_{model}', ())
+                if app_label == 'tickets' and perm_model == model
+            )
+        for codename in SUPPORT_AGENT_EXTRA:
+            permission_ids.update(pk for pk, app_label, _ in codenames.get(codename, ()) if app_label == 'tickets')
+
+    resolved = frozenset(permission_ids)
+    with _lock:
+        _resolved[key] = resolved
+    return resolved
+
+
+def role_permission_ids(role):
+    """Returns the Permission ids granted by a Role"""
+    return resolve(role.name, role.get_permissions())
+
+
+def group_name(role):
+    """Name of the Group backing role (role names are not unique, so the id is included)"""
+    return f'{role.name} (role #{role.pk})'[-150:]
+
+
+def sync_rows(through, owner_field, owner_ids, target_field, target_ids, scope=None):
+    """Makes the target_field values of each owner's rows in a through table exactly target_ids.
+
+    owner_ids may be a list or a values_list queryset (used as a subquery);
+    scope optionally limits which existing target values are managed here.
+    Missing rows go in with one bulk insert and stale rows out with one bulk
+    delete. Returns (added, removed) row counts.
+    """
+    rows = through.objects.filter(**{f'{owner_field}__in': owner_ids})
+    if scope is not None:
+        rows = rows.filter(**{f'{target_field}__in': scope})
+
+    existing = defaultdict(set)
+    stale = False
+    for owner_id, target_id in rows.values_list(owner_field, target_field):
+        existing[owner_id].add(target_id)
+        stale = stale or target_id not in target_ids
+
+    removed = 0
+    if stale:
+        removed, _ = rows.exclude(**{f'{target_field}__in': target_ids}).delete()
+
+    missing = [
+        through(**{owner_field: owner_id, target_field: target_id})
+        for owner_id in owner_ids
+        for target_id in target_ids - existing.get(owner_id, set())
+    ]
+    if missing:
+        through.objects.bulk_create(missing, batch_size=INSERT_BATCH_SIZE, ignore_conflicts=True)
+    return len(missing), removed
+
+
+def role_group_ids():
+    """Subquery of the ids of every Group backing a role"""
+    return Role.objects.filter(group__isnull=False).values('group_id')
+
+
+def sync_group(role):
+    """Creates or updates the Group backing role and returns its id"""
+    if role.group_id is None:
+        group, _ = Group.objects.get_or_create(name=group_name(role))
+        # Queryset update so the Role save signals do not fire again
+        Role.objects.filter(pk=role.pk).update(group=group)
+        role.group = group
+    else:
+        Group.objects.filter(pk=role.group_id).exclude(name=group_name(role)).update(name=group_name(role))
+    sync_rows(Group.permissions.through, 'group_id', [role.group_id], 'permission_id', role_permission_ids(role))
+    return role.group_id
+
+
+def sync_user(user, role):
+    """Makes user a member of role's group and of no other role's group"""
+    target = {role.group_id or sync_group(role)} if role else set()
+    result = sync_rows(User.groups.through, 'user_id', [user.pk], 'group_id', target, scope=role_group_ids())
+    # ModelBackend caches permissions on the instance
+    for attr in ('_perm_cache', '_user_perm_cache', '_group_perm_cache'):
+        user.__dict__.pop(attr, None)
+    return result
+
+
+def sync_role(role):
+    """Re-syncs a role's group after the role changed; independent of how many users hold it"""
+    if role.name.lower() == 'support_agent':
+        User.objects.filter(user_meta__role=role, is_staff=False).update(is_staff=True)
+    return sync_group(role)
@@ -0,0 +1,137 @@
+"""
+Per-request profiling: where the time of a request went.
+
+A RequestProfile is active for the requests RequestProfilingMiddleware
+samples. While it is, SQL statements (through a connection execute wrapper),
+template rendering (through ProfiledDjangoTemplates, the template backend)
+and the in-process caches (through record_cache) add to it. Outside a
+sampled request every hook is a single context variable lookup.
+"""
+import contextvars
+import time
+from collections import Counter
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+from . import metrics
+
+_current = contextvars.ContextVar('tickets_request_profile', default=None)
+
+
+@dataclass
+class RequestProfile:
+    """Timings of one request, in seconds"""
+    started: float = field(default_factory=time.perf_counter)
+    total: float = 0.0
+    sql_count: int = 0
+    sql_time: float = 0.0
+    template_time: float = 0.0
+    # SQL run while rendering (lazy querysets in templates), part of both sql_time and template_time
+    template_sql_time: float = 0.0
+    template_depth: int = 0
+    cache_hits: Counter = field(default_factory=Counter)
+    cache_misses: Counter = field(default_factory=Counter)
+
+    @property
+    def python_time(self):
+        """Time spent outside SQL and template rendering"""
+        return max(self.total - self.sql_time - (self.template_time - self.template_sql_time), 0.0)
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+
+    def server_timing(self):
+        """The profile as a Server-Timing header value (durations in milliseconds)"""
+        hits, misses = sum(self.cache_hits.values()), sum(self.cache_misses.values())
+        return ', '.join([
+            f'total;dur={self.total * 1000:.1f}',
+            f'db;dur={self.sql_time * 1000:.1f};desc="{self.sql_count} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'app;dur={self.python_time * 1000:.1f}',
+            f'cache;desc="{hits} hits, {misses} misses"',
+        ])
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total * 1000, 2),
+            'sql_count': self.sql_count,
+            'sql_ms': round(self.sql_time * 1000, 2),
+            'template_ms': round(self.template_time * 1000, 2),
+            'python_ms': round(self.python_time * 1000, 2),
+            'cache_hits': dict(self.cache_hits),
+            'cache_misses': dict(self.cache_misses),
+        }
+
+    # Connection execute wrapper
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.sql_count += 1
+            self.sql_time += elapsed
+            if self.template_depth:
+                self.template_sql_time += elapsed
+
+
+def current_profile():
+    """The RequestProfile of the request being handled, or None if it is not sampled"""
+    return _current.get()
+
+
+class profile_request:
+    """Context manager making a new RequestProfile current and timing every database's SQL"""
+
+    def __enter__(self):
+        self.profile = RequestProfile()
+        self._token = _current.set(self.profile)
+        self._wrappers = ExitStack()
+        for connection in connections.all():
+            self._wrappers.enter_context(connection.execute_wrapper(self.profile))
+        return self.profile
+
+    def __exit__(self, *exc_info):
+        self._wrappers.close()
+        self.profile.finish()
+        _current.reset(self._token)
+
+
+def record_cache(name, hit):
+    """Counts a hit or miss of the named in-process cache, in the metrics and for the current request"""
+    metrics.record_cache(name, hit)
+    profile = _current.get()
+    if profile is not None:
+        (profile.cache_hits if hit else profile.cache_misses)[name] += 1
+
+
+class ProfiledTemplate(Template):
+    """Template that adds its render time to the current profile"""
+
+    def render(self, context=None, request=None):
+        profile = _current.get()
+        if profile is None:
+            return super().render(context, request)
+        # Templates rendered from inside another render are already being timed
+        profile.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            profile.template_depth -= 1
+            if not profile.template_depth:
+                profile.template_time += time.perf_counter() - started
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    """The Django template backend, returning templates that report their render time"""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return ProfiledTemplate(template.template, self)
@@ -0,0 +1,94 @@
+"""
+Recording of the SQL a block of code runs, with where each query came from.
+
+Used by the query budget tests: every query is stored together with the
+project code frames and the template lines that were executing when it was
+issued, so a budget failure points at the line that added the query (for
+instance a related lookup inside a template loop) rather than only at the SQL.
+The slow query log stores the same origins.
+"""
+import os
+import sys
+from dataclasses import dataclass
+
+import django
+from django.conf import settings
+from django.db import connections
+from django.template.base import Node
+
+# Template nodes are rendered by Django's own frames, which are otherwise skipped
+DJANGO_DIR = os.path.dirname(django.__file__) + os.sep
+
+
+@dataclass
+class RecordedQuery:
+    """One executed statement and the frames that issued it, innermost first"""
+    sql: str
+    params: object
+    origin: list
+
+    def __str__(self):
+        lines = [self.sql if self.params in (None, (), []) else f'{self.sql} -- {self.params!r}']
+        lines.extend(f'    at {frame}' for frame in self.origin)
+        return '\n'.join(lines)
+
+
+def _template_frame(frame):
+    """Returns 'template:line  {% tag %}' for a frame rendering a template node, else None"""
+    if frame.f_code.co_name != 'render_annotated':
+        return None
+    node = frame.f_locals.get('self')
+    if not isinstance(node, Node) or getattr(node, 'token', None) is None or node.origin is None:
+        return None
+    return f'{node.origin.template_name}:{node.token.lineno}  {node.token.contents[:80]}'
+
+
+def _is_execute_wrapper(code):
+    """Whether code is a connection execute wrapper (it only passes the query on)"""
+    arguments = code.co_varnames[:code.co_argcount]
+    return arguments[-5:] == ('execute', 'sql', 'params', 'many', 'context')
+
+
+def query_origin(frame, limit=8):
+    """Returns the project code and template frames on the stack, innermost first"""
+    base_dir = str(settings.BASE_DIR) + os.sep
+    origin = []
+    while frame is not None and len(origin) < limit:
+        filename = frame.f_code.co_filename
+        if filename.startswith(DJANGO_DIR):
+            template = _template_frame(frame)
+            # Nested nodes repeat their parent's line; keep each template line once
+            if template and template not in origin:
+                origin.append(template)
+        elif filename.startswith(base_dir) and filename != __file__ and not _is_execute_wrapper(frame.f_code):
+            origin.append(f'{os.path.relpath(filename, base_dir)}:{frame.f_lineno} in {frame.f_code.co_name}')
+        frame = frame.f_back
+    return origin
+
+
+class QueryRecorder:
+    """Context manager recording the queries run on a connection, with their origins"""
+
+    def __init__(self, using='default'):
+        self.connection = connections[using]
+        self.queries = []
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(RecordedQuery(sql, params, query_origin(sys._getframe(1))))
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def report(self):
+        """The recorded queries, numbered, each followed by its origin"""
+        return '\n'.join(f'{number}. {query}' for number, query in enumerate(self.queries, 1))
@@ -0,0 +1,126 @@
+"""
+EXPLAIN-based checks for the queries of the hot pages.
+
+Queries captured while rendering a page are re-run under the database's
+EXPLAIN and the plan is searched for the two things an index is meant to
+prevent: reading a whole table (a full scan) and sorting rows after reading
+them (a filesort). The plan readers understand MySQL (production) and SQLite
+(local runs); other backends are reported as unsupported.
+
+Walking a table or index in order is accepted when the statement has a LIMIT,
+since that is how a keyset page reads: it stops after one page of rows.
+Row counts are not checked; keeping those cheap is the job of the status
+counters and capped counts, not of an index.
+"""
+import re
+from dataclasses import dataclass
+
+from django.db import connections
+
+# Small lookup tables that are read whole on purpose
+SCAN_ALLOWED_TABLES = {
+    'auth_group',
+    'auth_permission',
+    'django_content_type',
+    'tickets_role',
+    'tickets_ticketcategory',
+}
+
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(?P<table>\w+)"?')
+FROM_TABLE = re.compile(r'\bFROM [`"]?(\w+)[`"]?')
+# Django names subquery tables U0, U1, ... (and T2, T3, ... for repeated joins)
+TABLE_ALIAS = re.compile(r'[`"](\w+)[`"] (?:AS )?[`"]?([UT]\d+)\b')
+LIMIT = re.compile(r'\bLIMIT \d+')
+COUNT = re.compile(r'^SELECT COUNT\(\*\)', re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class PlanProblem:
+    """A full scan or filesort found in the plan of a query"""
+    kind: str
+    table: str
+    sql: str
+
+    def __str__(self):
+        return f"{self.kind} on {self.table or 'result'}: {self.sql}"
+
+
+def _from_table(sql):
+    match = FROM_TABLE.search(sql)
+    return match.group(1) if match else ''
+
+
+def _table_name(name, sql):
+    """Resolves a table alias used in a plan to the table it stands for"""
+    aliases = {alias: table for table, alias in TABLE_ALIAS.findall(sql)}
+    return aliases.get(name, name)
+
+
+def _sqlite_problems(cursor, sql):
+    cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+    limited = LIMIT.search(sql) is not None
+    problems = []
+    for row in cursor.fetchall():
+        detail = row[-1]
+        if detail.startswith('USE TEMP B-TREE FOR ORDER BY'):
+            # SQLite does not say which table the sort is for; it is the driving one
+            problems.append(PlanProblem('filesort', _from_table(sql), sql))
+            continue
+        match = SQLITE_SCAN.match(detail)
+        if match and not limited:
+            problems.append(PlanProblem('full scan', _table_name(match.group('table'), sql), sql))
+    return problems
+
+
+def _mysql_problems(cursor, sql):
+    cursor.execute(f'EXPLAIN {sql}')
+    limited = LIMIT.search(sql) is not None
+    columns = [column[0].lower() for column in cursor.description]
+    problems = []
+    for values in cursor.fetchall():
+        row = dict(zip(columns, values))
+        table = _table_name(row.get('table') or '', sql)
+        extra = row.get('extra') or ''
+        # "index" is a walk over a whole index, fine only when a LIMIT stops it early
+        if row.get('type') == 'ALL' or (row.get('type') == 'index' and not limited):
+            problems.append(PlanProblem('full scan', table, sql))
+        if 'Using filesort' in extra:
+            problems.append(PlanProblem('filesort', table, sql))
+    return problems
+
+
+PLAN_READERS = {
+    'sqlite': _sqlite_problems,
+    'mysql': _mysql_problems,
+}
+
+
+def is_supported(using='default'):
+    return connections[using].vendor in PLAN_READERS
+
+
+def explain(sql, using='default'):
+    """Returns the PlanProblems of one SELECT statement"""
+    connection = connections[using]
+    reader = PLAN_READERS.get(connection.vendor)
+    if reader is None:
+        raise NotImplementedError(f'No query plan reader for {connection.vendor}')
+    with connection.cursor() as cursor:
+        return reader(cursor, sql)
+
+
+def check_queries(captured_queries, using='default', allowed_tables=SCAN_ALLOWED_TABLES):
+    """Returns the PlanProblems of the SELECTs in captured_queries.
+
+    captured_queries is the list recorded by CaptureQueriesContext. Scans
+    and sorts of allowed_tables are not reported.
+    """
+    problems = []
+    seen = set()
+    for query in captured_queries:
+        sql = query['sql'].strip()
+        if sql in seen or not sql.upper().startswith('SELECT') or COUNT.match(sql):
+            continue
+        seen.add(sql)
+        problems.extend(problem for problem in explain(sql, using) if problem.table not in allowed_tables)
+    return problems
@@ -0,0 +1,67 @@
+"""
+Atomic "grab next ticket" work queue for support agents.
+
+The queue is every pending, unassigned ticket, most urgent (priority_rank)
+then oldest first, read through ticket_queue_idx so the head of the queue is
+found with a short index scan however long the backlog is. Claiming assigns
+the head to the agent so that two agents can never receive the same ticket:
+
+* where the database supports it (MySQL 8, PostgreSQL) the head is read with
+  SELECT ... FOR UPDATE SKIP LOCKED, so concurrent claims take different
+  rows without waiting on each other;
+* elsewhere (SQLite) a compare-and-set UPDATE that only matches a still
+  unassigned, pending row decides the race, and the loser moves on to the
+  next candidate.
+"""
+from django.db import connection, transaction
+from django.db.models import F
+
+from . import counters
+from .models import Ticket, TicketAction
+
+QUEUE_ORDER = ('priority_rank', 'created_at', 'id')
+
+# Candidates tried per attempt by the compare-and-set fallback
+CAS_CANDIDATES = 5
+
+
+def queued_tickets(queryset=None):
+    """Returns the claimable tickets of queryset (default: all) in queue order"""
+    queryset = Ticket.objects.all() if queryset is None else queryset
+    return queryset.filter(status='pending', assigned_to__isnull=True).order_by(*QUEUE_ORDER)
+
+
+def _assign(pk, user_id, agent):
+    """Compare-and-set assignment of one ticket; returns True if this call won it"""
+    claimed = Ticket.objects.filter(pk=pk, status='pending', assigned_to__isnull=True).update(
+        assigned_to=agent, version=F('version') + 1
+    )
+    if not claimed:
+        return False
+    counters.apply_deltas(counters.record_transition(('pending', None, user_id), ('pending', agent.pk, user_id)))
+    TicketAction.objects.create(
+        ticket_id=pk, performed_by=agent, action_type='assign',
+        notes=f"Ticket claimed from the queue by {agent.username}"
+    )
+    return True
+
+
+def claim_next(agent, queryset=None):
+    """Assigns the next ticket in the queue to agent and returns it, or None if the queue is empty"""
+    queue = queued_tickets(queryset).values_list('pk', 'user_id')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            head = queue.select_for_update(skip_locked=True).first()
+            if head is None or not _assign(head[0], head[1], agent):
+                return None
+        return Ticket.objects.get(pk=head[0])
+
+    while True:
+        candidates = list(queue[:CAS_CANDIDATES])
+        if not candidates:
+            return None
+        for pk, user_id in candidates:
+            with transaction.atomic():
+                if _assign(pk, user_id, agent):
+                    return Ticket.objects.get(pk=pk)
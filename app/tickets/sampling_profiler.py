@@ -0,0 +1,153 @@
+"""
+On-demand sampling profiler for single requests.
+
+A superuser asks for a profile by adding a signed token (see make_token) to
+a request, as the _profile query parameter or the X-Profile-Token header.
+While that request runs, a helper thread looks at the request thread's
+stack every SAMPLE_INTERVAL seconds. The stacks are counted and written to
+SAMPLING_PROFILES_DIR in the collapsed-stack format: one "outer;...;inner
+count" line per distinct stack. flamegraph.pl and speedscope both read this
+format. Requests without a token only pay for the token lookup.
+"""
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+QUERY_PARAMETER = '_profile'
+HEADER = 'X-Profile-Token'
+
+# Seconds between two samples of the request thread
+SAMPLE_INTERVAL = 0.005
+
+# Seconds a token stays valid
+TOKEN_MAX_AGE = 60 * 60
+
+# Oldest profiles are deleted beyond this many files
+MAX_PROFILES = 200
+
+TOKEN_SALT = 'tickets.sampling_profiler'
+PROFILE_SUFFIX = '.collapsed'
+PROFILE_NAME = re.compile(r'^[\w.-]+\.collapsed$')
+
+
+def make_token(user):
+    """A token letting user profile requests for TOKEN_MAX_AGE seconds"""
+    return signing.dumps({'user': user.pk}, salt=TOKEN_SALT)
+
+
+def token_is_valid(token, user):
+    """Whether token was made for user, is recent, and user is (still) a superuser"""
+    if not user.is_authenticated or not user.is_superuser:
+        return False
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return payload.get('user') == user.pk
+
+
+def requested_token(request):
+    return request.GET.get(QUERY_PARAMETER) or request.headers.get(HEADER)
+
+
+def _frame_name(frame, base_dir):
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(base_dir):
+        filename = filename[len(base_dir):]
+    else:
+        # Library frames: keep the path from the package directory on
+        parts = filename.split(os.sep)
+        filename = os.sep.join(parts[-3:])
+    # ';' separates frames and the last space the count in the collapsed format
+    return f'{code.co_name} ({filename}:{frame.f_lineno})'.replace(';', ':')
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled by a helper thread"""
+
+    def __init__(self, thread_id, interval=None):
+        self.thread_id = thread_id
+        self.interval = SAMPLE_INTERVAL if interval is None else interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._base_dir = str(settings.BASE_DIR) + os.sep
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame, self._base_dir))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """The samples in the collapsed-stack format, most frequent first"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+def sample_current_thread():
+    return StackSampler(threading.get_ident())
+
+
+def profiles_dir():
+    return settings.SAMPLING_PROFILES_DIR
+
+
+def save(sampler, request):
+    """Writes a sampler's profile and returns the file name"""
+    directory = profiles_dir()
+    os.makedirs(directory, exist_ok=True)
+    match = request.resolver_match
+    view = re.sub(r'[^\w.-]', '_', match.view_name if match else 'unresolved')
+    name = f"{timezone.now().strftime('%Y%m%d-%H%M%S-%f')}-{view}{PROFILE_SUFFIX}"
+    with open(os.path.join(directory, name), 'w') as f:
+        f.write(sampler.collapsed())
+    for old in list_profiles()[MAX_PROFILES:]:
+        os.remove(os.path.join(directory, old['name']))
+    return name
+
+
+def list_profiles():
+    """The saved profiles as dicts (name, size, modified), newest first"""
+    directory = profiles_dir()
+    try:
+        names = [name for name in os.listdir(directory) if PROFILE_NAME.match(name)]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        stat = os.stat(os.path.join(directory, name))
+        profiles.append({
+            'name': name,
+            'size': stat.st_size,
+            'modified': datetime.fromtimestamp(stat.st_mtime, tz=dt_timezone.utc),
+        })
+    profiles.sort(key=lambda profile: profile['name'], reverse=True)
+    return profiles
+
+
+def profile_path(name):
+    """The path of a saved profile, or None if name is not one"""
+    if not PROFILE_NAME.match(name):
+        return None
+    path = os.path.join(profiles_dir(), name)
+    return path if os.path.isfile(path) else None
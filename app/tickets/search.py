@@ -0,0 +1,366 @@
+"""
+Pluggable full-text search for tickets and ticket responses.
+
+The backend is picked from the database vendor (MySQL FULLTEXT in production,
+SQLite FTS5 for local runs) or from the TICKET_SEARCH_BACKEND setting, which
+takes a dotted path to a SearchBackend subclass. Queries that look like a
+ticket reference ("TKT-0042", "#42") resolve to a primary-key lookup instead
+of a text search.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Max, Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Ticket, TicketResponse
+
+TICKET_REFERENCE_RE = re.compile(r'^\s*(tkt-?|#)?\s*0*(\d+)\s*$', re.IGNORECASE)
+WORD_RE = re.compile(r'\w+')
+
+# Most results returned for a single search
+DEFAULT_LIMIT = 1000
+
+# A match in a response counts for less than a match in the ticket itself
+RESPONSE_WEIGHT = 0.5
+
+
+def parse_ticket_reference(query):
+    """Returns (ticket_id, explicit) for queries like 'TKT-0042', '#42' or '42'.
+
+    explicit is True when the query carried a TKT-/# prefix, i.e. it can only
+    mean a ticket id. Returns (None, False) for anything else.
+    """
+    match = TICKET_REFERENCE_RE.match(query or '')
+    if not match:
+        return None, False
+    return int(match.group(2)), bool(match.group(1))
+
+
+def tokenize(query):
+    """Splits a query into lower-cased word tokens"""
+    return WORD_RE.findall((query or '').lower())
+
+
+class SearchBackend:
+    """Base class for search backends.
+
+    Backends that keep their own index implement the index_*/remove_* hooks,
+    which are called from the Ticket and TicketResponse save/delete signals.
+    """
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def install(self):
+        """Creates whatever schema the backend needs; must be idempotent"""
+
+    def uninstall(self):
+        """Drops the schema created by install()"""
+
+    def index_ticket(self, ticket):
+        pass
+
+    def index_response(self, response):
+        pass
+
+    def remove_ticket(self, ticket_id):
+        pass
+
+    def remove_response(self, response_id):
+        pass
+
+    def rebuild(self):
+        """Rebuilds the index from scratch and returns the number of documents indexed"""
+        self.install()
+        return 0
+
+    def ranked_ticket_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        """Returns ids of tickets in queryset matching query, best match first"""
+        raise NotImplementedError
+
+    def ranked_response_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        """Returns ids of responses in queryset matching query, best match first"""
+        raise NotImplementedError
+
+
+class BasicSearchBackend(SearchBackend):
+    """Unindexed substring search for databases without a full-text engine"""
+
+    def ranked_ticket_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        condition = Q()
+        for term in terms:
+            condition &= (
+                Q(title__icontains=term) |
+                Q(description__icontains=term) |
+                Q(responses__message__icontains=term)
+            )
+        return list(
+            queryset.filter(condition).order_by('-created_at').values_list('id', flat=True).distinct()[:limit]
+        )
+
+    def ranked_response_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        condition = Q()
+        for term in terms:
+            condition &= Q(message__icontains=term)
+        return list(queryset.filter(condition).order_by('-created_at').values_list('id', flat=True)[:limit])
+
+
+class MySQLFullTextBackend(SearchBackend):
+    """InnoDB FULLTEXT indexes on the ticket and response tables.
+
+    InnoDB maintains the indexes itself, so the incremental hooks are no-ops.
+    """
+    INDEXES = [
+        ('tickets_ticket', 'tickets_ticket_title_description_ft', '(title, description)'),
+        ('tickets_ticketresponse', 'tickets_ticketresponse_message_ft', '(message)'),
+    ]
+    TICKET_MATCH = 'MATCH(tickets_ticket.title, tickets_ticket.description) AGAINST (%s IN BOOLEAN MODE)'
+    RESPONSE_MATCH = 'MATCH(tickets_ticketresponse.message) AGAINST (%s IN BOOLEAN MODE)'
+
+    def _existing_indexes(self, cursor):
+        cursor.execute(
+            "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND INDEX_TYPE = 'FULLTEXT'"
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            existing = self._existing_indexes(cursor)
+            for table, name, columns in self.INDEXES:
+                if name not in existing:
+                    cursor.execute(f'CREATE FULLTEXT INDEX {name} ON {table} {columns}')
+
+    def uninstall(self):
+        with self.connection.cursor() as cursor:
+            existing = self._existing_indexes(cursor)
+            for table, name, _ in self.INDEXES:
+                if name in existing:
+                    cursor.execute(f'DROP INDEX {name} ON {table}')
+
+    def rebuild(self):
+        self.install()
+        with self.connection.cursor() as cursor:
+            for table, _, _ in self.INDEXES:
+                cursor.execute(f'OPTIMIZE TABLE {table}')
+                cursor.fetchall()
+        return Ticket.objects.count() + TicketResponse.objects.count()
+
+    def boolean_query(self, query):
+        # Every word is required, matching the AND semantics of the other backends
+        return ' '.join(f'+{term}' for term in tokenize(query))
+
+    def ranked_ticket_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        terms = self.boolean_query(query)
+        if not terms:
+            return []
+        ticket_match = RawSQL(self.TICKET_MATCH, [terms], output_field=FloatField())
+        response_match = RawSQL(self.RESPONSE_MATCH, [terms], output_field=FloatField())
+
+        scores = {}
+        ticket_rows = (
+            queryset.order_by()
+            .filter(RawSQL(self.TICKET_MATCH, [terms], output_field=BooleanField()))
+            .annotate(score=ticket_match)
+            .order_by('-score')
+            .values_list('id', 'score')[:limit]
+        )
+        for ticket_id, score in ticket_rows:
+            scores[ticket_id] = score
+
+        response_rows = (
+            TicketResponse.objects.filter(ticket__in=queryset.order_by().values('id'))
+            .filter(RawSQL(self.RESPONSE_MATCH, [terms], output_field=BooleanField()))
+            .values('ticket_id')
+            .annotate(score=Max(response_match))
+            .order_by('-score')
+            .values_list('ticket_id', 'score')[:limit]
+        )
+        for ticket_id, score in response_rows:
+            scores[ticket_id] = max(scores.get(ticket_id, 0), score * RESPONSE_WEIGHT)
+
+        return sorted(scores, key=lambda ticket_id: -scores[ticket_id])[:limit]
+
+    def ranked_response_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        terms = self.boolean_query(query)
+        if not terms:
+            return []
+        return list(
+            queryset.order_by()
+            .filter(RawSQL(self.RESPONSE_MATCH, [terms], output_field=BooleanField()))
+            .annotate(score=RawSQL(self.RESPONSE_MATCH, [terms], output_field=FloatField()))
+            .order_by('-score')
+            .values_list('id', flat=True)[:limit]
+        )
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    """An FTS5 table holding one document per ticket and per response.
+
+    The rowid encodes the source row (2 * id for tickets, 2 * id + 1 for
+    responses) so incremental updates are primary-key writes. The table is
+    created by migration 0011 or rebuild(), never on the write path.
+    """
+    TABLE = 'tickets_search_index'
+    TITLE_WEIGHT = 4.0
+    BODY_WEIGHT = 1.0
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.TABLE} "
+                f"USING fts5(title, body, ticket_id UNINDEXED, tokenize='porter unicode61')"
+            )
+
+    def uninstall(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.TABLE}')
+
+    def _write(self, rowid, title, body, ticket_id):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.TABLE} WHERE rowid = %s', [rowid])
+            cursor.execute(
+                f'INSERT INTO {self.TABLE} (rowid, title, body, ticket_id) VALUES (%s, %s, %s, %s)',
+                [rowid, title, body, ticket_id]
+            )
+
+    def _delete(self, rowid):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.TABLE} WHERE rowid = %s', [rowid])
+
+    def index_ticket(self, ticket):
+        self._write(ticket.pk * 2, ticket.title, ticket.description, ticket.pk)
+
+    def index_response(self, response):
+        self._write(response.pk * 2 + 1, '', response.message, response.ticket_id)
+
+    def remove_ticket(self, ticket_id):
+        self._delete(ticket_id * 2)
+
+    def remove_response(self, response_id):
+        self._delete(response_id * 2 + 1)
+
+    def rebuild(self, batch_size=2000):
+        self.install()
+        count = 0
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.TABLE}')
+            tickets = Ticket.objects.order_by('id').values_list('id', 'title', 'description')
+            responses = TicketResponse.objects.order_by('id').values_list('id', 'message', 'ticket_id')
+            documents = [
+                (tickets, lambda row: (row[0] * 2, row[1], row[2], row[0])),
+                (responses, lambda row: (row[0] * 2 + 1, '', row[1], row[2])),
+            ]
+            for rows, to_document in documents:
+                batch = []
+                for row in rows.iterator(chunk_size=batch_size):
+                    batch.append(to_document(row))
+                    if len(batch) >= batch_size:
+                        count += self._insert_many(cursor, batch)
+                        batch = []
+                count += self._insert_many(cursor, batch)
+        return count
+
+    def _insert_many(self, cursor, rows):
+        if rows:
+            cursor.executemany(
+                f'INSERT INTO {self.TABLE} (rowid, title, body, ticket_id) VALUES (%s, %s, %s, %s)', rows
+            )
+        return len(rows)
+
+    def match_expression(self, query):
+        # Quote every token so FTS5 query syntax in user input is taken literally
+        return ' '.join(f'"{term}"' for term in tokenize(query))
+
+    def _search(self, select, condition, subquery, query, limit):
+        """Runs a MATCH query restricted by condition, where {ids} stands for subquery's SQL"""
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        sql, params = subquery.query.sql_with_params()
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT {select} FROM {self.TABLE} '
+                f'WHERE {self.TABLE} MATCH %s AND {condition.format(ids=sql)} '
+                f'ORDER BY score LIMIT %s',
+                [expression, *params, limit]
+            )
+            return cursor.fetchall()
+
+    def ranked_ticket_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        # bm25() cannot be aggregated, so rows come back per document and the
+        # best (lowest) score per ticket wins
+        rows = self._search(
+            f'ticket_id, bm25({self.TABLE}, {self.TITLE_WEIGHT}, {self.BODY_WEIGHT}) * '
+            f'(CASE rowid % 2 WHEN 0 THEN 1.0 ELSE {RESPONSE_WEIGHT} END) AS score',
+            'ticket_id IN ({ids})', queryset.order_by().values('id'), query, limit * 4
+        )
+        ranked = []
+        seen = set()
+        for ticket_id, _ in rows:
+            if ticket_id not in seen:
+                seen.add(ticket_id)
+                ranked.append(ticket_id)
+        return ranked[:limit]
+
+    def ranked_response_ids(self, query, queryset, limit=DEFAULT_LIMIT):
+        rows = self._search(
+            f'rowid, bm25({self.TABLE}, {self.TITLE_WEIGHT}, {self.BODY_WEIGHT}) AS score',
+            'rowid % 2 = 1 AND (rowid - 1) / 2 IN ({ids})', queryset.order_by().values('id'),
+            query, limit
+        )
+        return [rowid // 2 for rowid, _ in rows]
+
+
+BACKENDS = {
+    'mysql': MySQLFullTextBackend,
+    'sqlite': SQLiteFTS5Backend,
+}
+
+_backends = {}
+
+
+def get_backend(using='default'):
+    """Returns the search backend for a database alias"""
+    if using not in _backends:
+        path = getattr(settings, 'TICKET_SEARCH_BACKEND', None)
+        if path:
+            backend_class = import_string(path)
+        else:
+            backend_class = BACKENDS.get(connections[using].vendor, BasicSearchBackend)
+        _backends[using] = backend_class(using)
+    return _backends[using]
+
+
+def search_tickets(query, queryset, limit=DEFAULT_LIMIT):
+    """Returns ids of tickets in queryset matching query, best match first.
+
+    Ticket references resolve to a primary-key lookup: 'TKT-0042' and '#42'
+    return only that ticket, while a bare '42' puts it ahead of text matches.
+    """
+    ticket_id, explicit = parse_ticket_reference(query)
+    ids = []
+    if ticket_id is not None:
+        ids = list(queryset.filter(pk=ticket_id).values_list('id', flat=True))
+        if explicit:
+            return ids
+    ranked = get_backend(queryset.db).ranked_ticket_ids(query, queryset, limit)
+    return ids + [ticket_id for ticket_id in ranked if ticket_id not in ids][:limit - len(ids)]
+
+
+def search_responses(query, queryset, limit=DEFAULT_LIMIT):
+    """Returns ids of responses in queryset matching query, best match first"""
+    return get_backend(queryset.db).ranked_response_ids(query, queryset, limit)
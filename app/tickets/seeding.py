@@ -0,0 +1,320 @@
+"""
+Fast generation of large, realistic data sets for benchmarking.
+
+Used by the seed_data command. Rows are generated as plain dicts and written
+with batched bulk_create (or MySQL LOAD DATA LOCAL INFILE), which sends no
+model signals. The work the signals would have done (profiles, role group
+membership, status counters, the search index) is done in bulk instead.
+
+Tickets are split into chunks that can run in separate processes. Ticket
+and user primary keys are planned up front, so a chunk needs nothing from
+the database or the other chunks. Each chunk's random generator is seeded
+from the run seed and the chunk number, so a run gives the same data however
+many processes it uses.
+
+The data is skewed the way a help desk is:
+- older tickets are mostly resolved or closed
+- new ones are pending or in progress
+- a few categories, requesters and agents account for most tickets
+"""
+import math
+import os
+import random
+import tempfile
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta, timezone as dt_timezone
+from functools import lru_cache
+from itertools import accumulate
+
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+
+from . import slow_queries
+from .models import Ticket, TicketAction, TicketResponse, UserMeta
+
+# Relative weights; tickets are grouped by age, in days
+STATUS_WEIGHTS_BY_AGE = [
+    (2, {'pending': 50, 'in_progress': 35, 'resolved': 12, 'closed': 3}),
+    (30, {'pending': 15, 'in_progress': 25, 'resolved': 40, 'closed': 20}),
+    (None, {'pending': 2, 'in_progress': 3, 'resolved': 35, 'closed': 60}),
+]
+PRIORITY_WEIGHTS = {'low': 30, 'medium': 45, 'high': 20, 'urgent': 5}
+ACTION_WEIGHTS = {'review': 30, 'status_change': 25, 'update': 20, 'assign': 15, 'note': 8, 'escalate': 2}
+
+# Share of pending tickets still waiting in the unassigned queue
+UNASSIGNED_PENDING_SHARE = 0.6
+
+# Exponent of the Zipf-like popularity of categories, requesters and agents
+POPULARITY_SKEW = 1.1
+
+# Days after creation over which a ticket's responses and actions are spread
+CONVERSATION_DAYS = 14
+
+SUBJECTS = ['Printer', 'Laptop', 'VPN', 'Email', 'Invoice', 'Password', 'Monitor', 'Wi-Fi', 'Account',
+            'Payroll portal', 'Shared drive', 'Phone', 'Calendar', 'Badge reader', 'CRM']
+PROBLEMS = ['does not work', 'is very slow', 'shows an error', 'keeps disconnecting', 'needs replacing',
+            'cannot be accessed', 'is missing data', 'was charged twice', 'is locked', 'needs an upgrade']
+SENTENCES = [
+    'It started this morning after the update.',
+    'I have already tried restarting it.',
+    'Several people on my team see the same thing.',
+    'The error message says to contact support.',
+    'This is blocking work on a customer deadline.',
+    'It happened once last week as well.',
+    'Please let me know if you need more details.',
+    'I attached a screenshot of the problem.',
+    'Nothing changed on my side as far as I know.',
+    'It only happens when I am working from home.',
+]
+REPLIES = [
+    'Thanks for reporting this, we are looking into it.',
+    'Could you try again and let us know if it still happens?',
+    'Any update on this?',
+    'It works now, thank you.',
+    'We have escalated this to the infrastructure team.',
+    'A fix has been rolled out, please confirm.',
+    'It is still happening for me.',
+]
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Priya', 'Chen', 'Maria', 'Omar', 'Lena', 'Kofi', 'Yuki', 'Ravi']
+LAST_NAMES = ['Smith', 'Garcia', 'Kumar', 'Nguyen', 'Okafor', 'Müller', 'Rossi', 'Kim', 'Silva', 'Cohen']
+
+
+def parse_count(value):
+    """Parses a row count such as '5000', '200k' or '5M'"""
+    text = str(value).strip().lower().replace('_', '')
+    multiplier = {'k': 10 ** 3, 'm': 10 ** 6, 'b': 10 ** 9}.get(text[-1:], 1)
+    if multiplier > 1:
+        text = text[:-1]
+    count = float(text) * multiplier
+    if count < 0 or count != int(count):
+        raise ValueError(f'Not a row count: {value}')
+    return int(count)
+
+
+@lru_cache(maxsize=16)
+def popularity_weights(count):
+    """Cumulative Zipf-like weights: the first of count items is the most popular"""
+    return tuple(accumulate(1 / (rank + 1) ** POPULARITY_SKEW for rank in range(count)))
+
+
+def pick_popular(rng, items):
+    """Picks from a sequence (or range) with the popularity skew"""
+    weights = popularity_weights(len(items))
+    return items[bisect_left(weights, rng.random() * weights[-1])]
+
+
+def pick_weighted(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Lets bulk_create store the generated created_at/updated_at values instead of now"""
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+@dataclass(frozen=True)
+class SeedPlan:
+    """Everything a ticket chunk needs, planned before any chunk runs"""
+    seed: int
+    tickets: int
+    first_ticket_id: int
+    requester_ids: range
+    agent_ids: range
+    category_ids: tuple
+    responses_per_ticket: float
+    actions_per_ticket: float
+    start: object
+    end: object
+    chunk_size: int
+    batch_size: int
+    using: str = 'default'
+    load_data: bool = False
+
+    @property
+    def chunk_count(self):
+        return math.ceil(self.tickets / self.chunk_size)
+
+    def chunk_ids(self, chunk):
+        first = self.first_ticket_id + chunk * self.chunk_size
+        return range(first, min(first + self.chunk_size, self.first_ticket_id + self.tickets))
+
+
+def _random_text(rng, sentences, low, high):
+    return ' '.join(rng.sample(sentences, rng.randint(low, high)))
+
+
+def _count_around(rng, mean):
+    """A per-ticket count averaging mean, with a long tail"""
+    return round(rng.expovariate(1 / mean)) if mean > 0 else 0
+
+
+def generate_chunk(plan, chunk):
+    """Returns the (tickets, responses, actions) rows of one chunk, as dicts of attnames"""
+    rng = random.Random(plan.seed * 1_000_003 + chunk)
+    span = (plan.end - plan.start).total_seconds()
+    tickets, responses, actions = [], [], []
+    for ticket_id in plan.chunk_ids(chunk):
+        # Ids grow with creation time, as they would have in production
+        position = (ticket_id - plan.first_ticket_id + rng.random()) / plan.tickets
+        created_at = plan.start + timedelta(seconds=span * position)
+        age_days = (plan.end - created_at).total_seconds() / 86400
+        status_weights = next(weights for limit, weights in STATUS_WEIGHTS_BY_AGE if limit is None or age_days < limit)
+        status = pick_weighted(rng, status_weights)
+        priority = pick_weighted(rng, PRIORITY_WEIGHTS)
+        requester_id = pick_popular(rng, plan.requester_ids)
+        agent_id = None
+        if plan.agent_ids and not (status == 'pending' and rng.random() < UNASSIGNED_PENDING_SHARE):
+            agent_id = pick_popular(rng, plan.agent_ids)
+        last_activity = min(created_at + timedelta(days=CONVERSATION_DAYS * rng.random()), plan.end)
+        tickets.append({
+            'id': ticket_id,
+            'user_id': requester_id,
+            'assigned_to_id': agent_id,
+            'category_id': pick_popular(rng, plan.category_ids),
+            'title': f'{rng.choice(SUBJECTS)} {rng.choice(PROBLEMS)}',
+            'description': _random_text(rng, SENTENCES, 1, 4),
+            'status': status,
+            'priority': priority,
+            'priority_rank': Ticket.PRIORITY_RANKS[priority],
+            'version': 0,
+            'created_at': created_at,
+            'updated_at': last_activity,
+        })
+
+        activity = (last_activity - created_at).total_seconds()
+        for number in range(_count_around(rng, plan.responses_per_ticket)):
+            at = created_at + timedelta(seconds=activity * rng.random())
+            # Requester and agent take turns; unassigned tickets only hear from the requester
+            author = agent_id if agent_id and number % 2 == 0 else requester_id
+            responses.append({'ticket_id': ticket_id, 'user_id': author, 'message': rng.choice(REPLIES),
+                              'created_at': at, 'updated_at': at})
+        for _ in range(_count_around(rng, plan.actions_per_ticket) if plan.agent_ids else 0):
+            at = created_at + timedelta(seconds=activity * rng.random())
+            action_type = pick_weighted(rng, ACTION_WEIGHTS)
+            actions.append({'ticket_id': ticket_id, 'performed_by_id': agent_id or pick_popular(rng, plan.agent_ids),
+                            'action_type': action_type, 'action_taken': dict(TicketAction.ACTION_CHOICES)[action_type],
+                            'resolution_summary': None, 'notes': rng.choice(REPLIES),
+                            'created_at': at, 'updated_at': at})
+    return tickets, responses, actions
+
+
+def _tsv_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if hasattr(value, 'astimezone'):
+        # Stored as naive UTC, as Django does with USE_TZ
+        return value.astimezone(dt_timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+    return str(value)
+
+
+def load_data_infile(model, rows, using):
+    """Writes rows through a temporary tab-separated file and MySQL LOAD DATA LOCAL INFILE.
+
+    The generated text holds no tabs, newlines or backslashes, so the
+    server's default field escaping applies unchanged.
+    """
+    attnames = list(rows[0])
+    column_names = {field.attname: field.column for field in model._meta.concrete_fields}
+    columns = ', '.join(f'`{column_names[attname]}`' for attname in attnames)
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, encoding='utf-8') as f:
+        for row in rows:
+            f.write('\t'.join(_tsv_value(row[attname]) for attname in attnames))
+            f.write('\n')
+    try:
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE `{model._meta.db_table}` CHARACTER SET utf8mb4 ({columns})",
+                [f.name],
+            )
+    finally:
+        os.remove(f.name)
+
+
+def write_rows(model, rows, plan):
+    if not rows:
+        return
+    if plan.load_data:
+        for start in range(0, len(rows), plan.batch_size * 10):
+            load_data_infile(model, rows[start:start + plan.batch_size * 10], plan.using)
+        return
+    with explicit_timestamps(model):
+        model.objects.using(plan.using).bulk_create([model(**row) for row in rows], batch_size=plan.batch_size)
+
+
+def seed_chunk(plan, chunk):
+    """Generates and writes one chunk; returns (tickets, responses, actions) written"""
+    tickets, responses, actions = generate_chunk(plan, chunk)
+    # One commit per chunk rather than per batch. Bulk INSERTs are slow by design,
+    # so they stay out of the slow query log (in forked workers too)
+    with slow_queries.paused(), transaction.atomic(using=plan.using):
+        write_rows(Ticket, tickets, plan)
+        write_rows(TicketResponse, responses, plan)
+        write_rows(TicketAction, actions, plan)
+    forget_statements(plan.using)
+    return len(tickets), len(responses), len(actions)
+
+
+def forget_statements(using):
+    """Drops the statements a DEBUG connection has kept; each holds the SQL of a whole batch"""
+    connections[using].queries_log.clear()
+
+
+def prepare_worker(using, load_data):
+    """Per-process setup: MySQL sessions skip checks the generator already guarantees"""
+    connection = connections[using]
+    if connection.vendor != 'mysql':
+        return
+    if load_data:
+        connection.close()
+        connection.settings_dict.setdefault('OPTIONS', {})['local_infile'] = 1
+    with connection.cursor() as cursor:
+        # Keys are planned up front, so neither can fail
+        cursor.execute('SET SESSION foreign_key_checks = 0, unique_checks = 0')
+
+
+def create_users(kind, count, first_id, role, password_hash, batch_size, seed, joined_range, using='default'):
+    """Bulk-creates count users of a role, with their profiles and role group membership.
+
+    Returns the range of their primary keys.
+    """
+    rng = random.Random(f'{seed}:{kind}')
+    start, end = joined_range
+    span = (end - start).total_seconds()
+    staff = role.name.lower() in ('admin', 'support_agent')
+    ids = range(first_id, first_id + count)
+    users, profiles = [], []
+    for user_id in ids:
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        users.append(User(
+            id=user_id, username=f'{kind}{user_id}', email=f'{kind}{user_id}@example.com', password=password_hash,
+            first_name=first_name, last_name=last_name, is_staff=staff, is_superuser=role.name.lower() == 'admin',
+            date_joined=start + timedelta(seconds=span * rng.random() * 0.5),
+        ))
+        profiles.append(UserMeta(
+            user_id=user_id, role=role, first_name=first_name, last_name=last_name,
+            full_name=f'{first_name} {last_name}', is_profile_completed=True,
+        ))
+    # Skips create_user_meta (one Role lookup and insert per user) and the permission sync per profile
+    User.objects.using(using).bulk_create(users, batch_size=batch_size)
+    UserMeta.objects.using(using).bulk_create(profiles, batch_size=batch_size)
+    if role.group_id:
+        memberships = [User.groups.through(user_id=user_id, group_id=role.group_id) for user_id in ids]
+        User.groups.through.objects.using(using).bulk_create(memberships, batch_size=batch_size)
+    forget_statements(using)
+    return ids
@@ -1,92 +1,198 @@
-from django.db.models.signals import post_save, pre_save, m2m_changed
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, post_migrate, m2m_changed
 from django.dispatch import receiver
 from django.contrib.auth.models import User, Permission, Group
 from django.contrib.contenttypes.models import ContentType
-from .models import Role, UserMeta, Ticket, TicketResponse, TicketAction
-
-# Map our custom permissions to Django's permission system
-ROLE_PERMISSION_MAPPING = {
-    'view_all_tickets': ['view_ticket'],
-    'edit_all_tickets': ['change_ticket'],
-    'assign_tickets': ['change_ticket'],
-    'view_assigned_tickets': ['view_ticket'],
-    'respond_to_tickets': ['add_ticketresponse', 'view_ticketresponse', 'change_ticketresponse'],
-    'close_tickets': ['change_ticket'],
-    'manage_users': ['view_user', 'change_user'],
-    'manage_categories': ['add_ticketcategory', 'change_ticketcategory', 'view_ticketcategory'],
-    'manage_faq': ['add_faqknowledgebase', 'change_faqknowledgebase', 'view_faqknowledgebase'],
-}
+from .models import Role, UserMeta, Ticket, TicketResponse, TicketAction, FAQKnowledgeBase, Media
+from . import counters, search, faq_index, permissions, permission_cache, slow_queries, storage, thumbnails
+
+# Sync Django permissions from the role (through its group), only when the
+# role assignment or the role itself actually changed
+@receiver(pre_save, sender=UserMeta)
+def load_previous_role(sender, instance, update_fields=None, **kwargs):
+    instance._role_changed = True
+    if instance._state.adding or not instance.pk:
+        return
+    if update_fields is not None and 'role' not in update_fields:
+        instance._role_changed = False
+        return
+    previous = UserMeta.objects.filter(pk=instance.pk).values_list('role_id', flat=True).first()
+    instance._role_changed = previous != instance.role_id
+
 
 @receiver(post_save, sender=UserMeta)
 def update_user_permissions(sender, instance, created, **kwargs):
     """
     Updates a user's permissions based on their role and ensures staff status for support agents
     """
-    if not instance.role:
+    if not getattr(instance, '_role_changed', True):
         return
         
     user = instance.user
     
     # Set staff status for support agents
-    if instance.role.name.lower() == 'support_agent' and not user.is_staff:
+    if instance.role and instance.role.name.lower() == 'support_agent' and not user.is_staff:
         user.is_staff = True
         user.save(update_fields=['is_staff'])
     
-    # Clear existing permissions to prevent duplication
-    user.user_permissions.clear()
-    
-    # Get all available django permissions
-    all_perms = Permission.objects.all()
-    
-    # Get permissions from role
-    role_perms = instance.role.get_permissions()
-    permissions_to_add = set()
-    
-    # Map our custom permissions to Django permissions
-    for role_perm in role_perms:
-        if role_perm in ROLE_PERMISSION_MAPPING:
-            for django_perm in ROLE_PERMISSION_MAPPING[role_perm]:
-                # Get the app_label and permission codename
-                parts = django_perm.split('_', 1)
-                if len(parts) > 1:
-                    action, model = parts[0], parts[1]
-                    
-                    matching_perms = Permission.objects.filter(
-                        codename__startswith=action,
-                        codename__endswith=model
-                    )
-                    
-                    for perm in matching_perms:
-                        permissions_to_add.add(perm)
-    
-    # Add ticket-specific permissions for support agents
-    if instance.role.name.lower() == 'support_agent':
-        # Get all the ticket-related models content types
-        ticket_ct = ContentType.objects.get_for_model(Ticket)
-        response_ct = ContentType.objects.get_for_model(TicketResponse)
-        action_ct = ContentType.objects.get_for_model(TicketAction)
-        
-        # View permissions only for ticket and related models (NO CHANGE PERMISSIONS)
-        view_perms = Permission.objects.filter(
-            codename__startswith='view_',
-            content_type__in=[ticket_ct, response_ct, action_ct]
-        )
-        permissions_to_add.update(view_perms)
-        
-        # Allow adding responses (but not changing tickets)
-        add_response_perm = Permission.objects.filter(
-            codename='add_ticketresponse',
-            content_type=response_ct
-        )
-        permissions_to_add.update(add_response_perm)
-        
-        # Add ticket action permission (for internal notes only)
-        add_action_perm = Permission.objects.filter(
-            codename='add_ticketaction',
-            content_type=action_ct
-        )
-        permissions_to_add.update(add_action_perm)
-    
-    # Apply the permissions
-    for perm in permissions_to_add:
-        user.user_permissions.add(perm)
+    # Permissions come from membership of the role's group
+    permissions.sync_user(user, instance.role)
+    permission_cache.invalidate()
+
+
+@receiver(pre_save, sender=Role)
+def load_previous_role_permissions(sender, instance, **kwargs):
+    instance._previous_permissions = None
+    if not instance._state.adding and instance.pk:
+        instance._previous_permissions = Role.objects.filter(pk=instance.pk).values_list('name', 'permissions').first()
+
+
+@receiver(post_save, sender=Role)
+def update_role_user_permissions(sender, instance, created, **kwargs):
+    """Re-syncs the group behind a role that is new or whose name or permissions changed"""
+    previous = getattr(instance, '_previous_permissions', None)
+    if not created and previous == (instance.name, instance.permissions) and instance.group_id:
+        return
+    permissions.sync_role(instance)
+    permission_cache.invalidate()
+
+
+@receiver(post_delete, sender=Role)
+def remove_role_group(sender, instance, **kwargs):
+    if instance.group_id:
+        Group.objects.filter(pk=instance.group_id).delete()
+    permission_cache.invalidate()
+
+
+# Direct permission or group changes made outside the role sync
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_permission_cache(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        permission_cache.invalidate()
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_permission_cache_for_group(sender, instance, **kwargs):
+    permission_cache.invalidate()
+
+
+# Permission rows only change on migrate; once ours exist, bring the role groups up to date
+@receiver(post_migrate)
+def clear_permission_cache(sender, **kwargs):
+    permissions.clear_cache()
+    apps = kwargs.get('apps')
+    if sender.label != 'tickets' or apps is None:
+        return
+    # Skip when migrated back to before roles had groups
+    if 'group' not in {field.name for field in apps.get_model('tickets', 'Role')._meta.fields}:
+        return
+    for role in Role.objects.all():
+        permissions.sync_group(role)
+
+
+# Keep the dashboard status counters in step with ticket writes. Ticket.save
+# reads the previous state from the locked row, so a stale in-memory copy
+# cannot move the counters twice.
+@receiver(post_save, sender=Ticket)
+def update_ticket_counters(sender, instance, created, update_fields=None, **kwargs):
+    old_state = getattr(instance, '_counter_state', None)
+    if not created and old_state is None:
+        return
+    new_state = counters.ticket_state(instance, fallback=old_state)
+    counters.apply_deltas(counters.record_transition(old_state, new_state))
+
+
+@receiver(pre_delete, sender=Ticket)
+def load_ticket_counter_state_for_delete(sender, instance, **kwargs):
+    # Deletes run in a transaction; the lock makes a concurrent delete of the same
+    # ticket find no row and leave the counters alone
+    instance._counter_state = Ticket.objects.select_for_update().filter(pk=instance.pk).values_list(
+        *counters.TRACKED_FIELDS
+    ).first()
+
+
+@receiver(post_delete, sender=Ticket)
+def remove_ticket_counters(sender, instance, **kwargs):
+    counters.apply_deltas(counters.record_transition(instance._counter_state, None))
+
+
+# Keep the full-text search index in step with ticket and response writes
+@receiver(post_save, sender=Ticket)
+def index_ticket_for_search(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'title', 'description'} & set(update_fields):
+        return
+    search.get_backend(instance._state.db).index_ticket(instance)
+
+
+@receiver(post_delete, sender=Ticket)
+def remove_ticket_from_search(sender, instance, **kwargs):
+    search.get_backend(instance._state.db).remove_ticket(instance.pk)
+
+
+@receiver(post_save, sender=TicketResponse)
+def index_response_for_search(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'message' not in update_fields:
+        return
+    search.get_backend(instance._state.db).index_response(instance)
+
+
+@receiver(post_delete, sender=TicketResponse)
+def remove_response_from_search(sender, instance, **kwargs):
+    search.get_backend(instance._state.db).remove_response(instance.pk)
+
+
+# Any FAQ change makes every worker rebuild its in-memory FAQ index
+@receiver(post_save, sender=FAQKnowledgeBase)
+@receiver(post_delete, sender=FAQKnowledgeBase)
+def invalidate_faq_index(sender, instance, **kwargs):
+    faq_index.invalidate()
+
+
+# Release stored attachment files that Media rows stop using, once the change is committed
+@receiver(pre_save, sender=Media)
+def load_previous_media_file(sender, instance, **kwargs):
+    instance._previous_file = None
+    if not instance._state.adding and instance.pk:
+        instance._previous_file = Media.objects.filter(pk=instance.pk).values_list('file', flat=True).first()
+
+
+@receiver(post_save, sender=Media)
+def release_replaced_media_file(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_file', None)
+    if previous and previous != instance.file.name:
+        transaction.on_commit(lambda: storage.release(previous))
+
+
+# Render image thumbnails off the request path once the upload is committed
+@receiver(post_save, sender=Media)
+def queue_media_thumbnails(sender, instance, created, **kwargs):
+    name = instance.file.name
+    if instance.is_image and (created or getattr(instance, '_previous_file', None) != name):
+        transaction.on_commit(lambda: thumbnails.pending.add(name))
+
+
+@receiver(post_delete, sender=Media)
+def release_media_file(sender, instance, **kwargs):
+    name = instance.file.name
+    if name:
+        transaction.on_commit(lambda: storage.release(name))
+
+
+# Time every statement on every connection for the slow query log, while it is enabled
+@receiver(connection_created)
+def capture_slow_queries(sender, connection, **kwargs):
+    if settings.SLOW_QUERY_THRESHOLD_MS > 0:
+        slow_queries.install(connection)
+
+
+# Turning the log on at runtime (override_settings) covers the connections already open
+@receiver(setting_changed)
+def capture_slow_queries_when_enabled(sender, setting, value, **kwargs):
+    if setting == 'SLOW_QUERY_THRESHOLD_MS' and value and value > 0:
+        for connection in connections.all(initialized_only=True):
+            slow_queries.install(connection)
@@ -0,0 +1,253 @@
+"""
+Capture of slow SQL statements, viewable in the admin.
+
+An execute wrapper installed on every database connection times each
+statement. Those that take SLOW_QUERY_THRESHOLD_MS or longer are put in a
+bounded in-memory buffer together with the view being served and the project
+frames (and template lines) that issued them. The request only pays for that
+append: a background thread per process writes the buffer to the SlowQuery
+table in batches and, on MySQL, stores the EXPLAIN of each slow SELECT. When
+the buffer is full the oldest entries are dropped rather than slowing
+requests down.
+
+Only the SQL with its placeholders is stored. Parameter values (passwords,
+tokens, personal data) stay in memory until the EXPLAIN has run and never
+reach the admin-visible table.
+"""
+import contextvars
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connections, router
+from django.utils import timezone
+
+from .query_budget import query_origin
+
+logger = logging.getLogger(__name__)
+
+# Entries held per process until the writer thread picks them up
+BUFFER_SIZE = 1000
+
+# Entries that wake the writer before its interval is up
+BATCH_SIZE = 100
+
+# Seconds between writes of the buffer
+FLUSH_INTERVAL = 5.0
+
+_view = contextvars.ContextVar('tickets_slow_query_view', default='')
+# Set while a thread's statements are not captured: the writer thread's own, and
+# those run inside paused()
+_paused = threading.local()
+_table_found = False
+
+STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+NUMBER_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+PLACEHOLDER = re.compile(r'%s|\?')
+VALUE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+REPEATED_ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """Returns sql with literals and parameters replaced, so repeats of one query compare equal"""
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = PLACEHOLDER.sub('?', sql)
+    # IN lists and multi-row VALUES vary in length with the data
+    sql = VALUE_LIST.sub('(...)', sql)
+    sql = REPEATED_ROWS.sub('(...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+def fingerprint(normalized_sql):
+    return hashlib.sha1(normalized_sql.encode()).hexdigest()
+
+
+@dataclass
+class SlowQueryEntry:
+    """A captured statement, waiting in the buffer to be written"""
+    recorded_at: datetime
+    duration_ms: float
+    sql: str
+    # Only for the EXPLAIN; not written to the table
+    params: object
+    many: bool
+    database: str
+    view_name: str
+    stack: list
+
+
+class SlowQueryLog:
+    """Per-process ring buffer of slow queries and the thread writing it out"""
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.entries = deque(maxlen=size)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer = None
+        self._writer_pid = None
+
+    def add(self, entry):
+        with self._lock:
+            if len(self.entries) == self.entries.maxlen:
+                self.dropped += 1
+            self.entries.append(entry)
+            batch_ready = len(self.entries) >= BATCH_SIZE
+        self._ensure_writer()
+        if batch_ready:
+            self._wake.set()
+
+    def take(self):
+        """Removes and returns the buffered entries"""
+        with self._lock:
+            entries = list(self.entries)
+            self.entries.clear()
+        return entries
+
+    def _ensure_writer(self):
+        # Threads do not survive a fork, so each worker starts its own
+        if self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid() and self._writer.is_alive():
+                return
+            self._writer = threading.Thread(target=self._run, name='slow-query-writer', daemon=True)
+            self._writer_pid = os.getpid()
+            self._writer.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                flush(self)
+            except Exception:
+                logger.exception('Could not write the slow query log')
+            finally:
+                # Connections are per thread; do not keep this one open between batches
+                connections.close_all()
+
+
+log = SlowQueryLog()
+
+
+def _explain(entry):
+    """Returns the EXPLAIN output of a slow MySQL SELECT, or '' for anything else"""
+    connection = connections[entry.database]
+    if connection.vendor != 'mysql' or entry.many or not entry.sql.lstrip().upper().startswith('SELECT'):
+        return ''
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN {entry.sql}', entry.params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+    except Exception as e:
+        return f'EXPLAIN failed: {e}'
+    lines = ['\t'.join(columns)]
+    lines.extend('\t'.join('' if value is None else str(value) for value in row) for row in rows)
+    return '\n'.join(lines)
+
+
+def _table_exists():
+    """Whether the SlowQuery table exists yet; once it does, that is remembered"""
+    global _table_found
+    from .models import SlowQuery
+
+    if not _table_found:
+        connection = connections[router.db_for_write(SlowQuery)]
+        with connection.cursor() as cursor:
+            _table_found = SlowQuery._meta.db_table in connection.introspection.table_names(cursor)
+    return _table_found
+
+
+def flush(slow_query_log=None):
+    """Writes the buffered entries to the SlowQuery table; returns how many were written"""
+    from .models import SlowQuery
+
+    entries = (slow_query_log or log).take()
+    if not entries:
+        return 0
+    with paused():
+        # Before migrate has created the table the entries are dropped without complaint
+        if not _table_exists():
+            return 0
+        rows = []
+        for entry in entries:
+            normalized = normalize(entry.sql)
+            rows.append(SlowQuery(
+                recorded_at=entry.recorded_at,
+                duration_ms=entry.duration_ms,
+                fingerprint=fingerprint(normalized),
+                normalized_sql=normalized,
+                sql=entry.sql,
+                database=entry.database,
+                view_name=entry.view_name,
+                stack='\n'.join(entry.stack),
+                explain=_explain(entry),
+            ))
+        SlowQuery.objects.bulk_create(rows)
+    return len(rows)
+
+
+@contextmanager
+def paused():
+    """Stops capturing the statements of the current thread inside the block.
+
+    For work that is slow by design (bulk loads, benchmarks) and would only
+    fill the log; other threads and processes keep capturing.
+    """
+    previous = getattr(_paused, 'active', False)
+    _paused.active = True
+    try:
+        yield
+    finally:
+        _paused.active = previous
+
+
+def capture(execute, sql, params, many, context):
+    """Execute wrapper timing a statement and buffering it if it was slow"""
+    threshold = settings.SLOW_QUERY_THRESHOLD_MS
+    if threshold <= 0 or getattr(_paused, 'active', False):
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms >= threshold:
+            log.add(SlowQueryEntry(
+                recorded_at=timezone.now(),
+                duration_ms=duration_ms,
+                sql=sql,
+                params=params,
+                many=many,
+                database=context['connection'].alias,
+                view_name=_view.get(),
+                stack=query_origin(sys._getframe(1)),
+            ))
+
+
+def install(connection):
+    """Adds the capture wrapper to a connection (once)"""
+    if capture not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, capture)
+
+
+def set_view(view_name):
+    """Names the view whose statements are being captured; returns a token for reset_view"""
+    return _view.set(view_name)
+
+
+def reset_view(token):
+    _view.reset(token)
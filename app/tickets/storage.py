@@ -0,0 +1,253 @@
+"""
+Content-addressed, deduplicated storage for ticket attachments.
+
+An upload is streamed in chunks into a temporary file inside the store and
+hashed as it goes. Its real type is read from the first bytes in the same
+pass. The file is then kept once, as <upload dir>/<aa>/<sha256>.<type>; a
+later upload of the same bytes only adds a reference to it.
+
+Each StoredFile row counts the Media rows that use its file, and releasing
+the last reference deletes the file. Taking and releasing a reference both
+lock the StoredFile row, so a file is never deleted while a new upload of
+the same bytes is being linked to it.
+
+Uploads saved before this storage existed keep their names and are never
+deleted automatically.
+"""
+import codecs
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+import time
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+# Bytes read from the upload (and written to disk) at a time
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes kept for type detection; enough to see the first parts of an Office zip
+SNIFF_BYTES = 8 * 1024
+
+# Per-directory folder of uploads still being hashed
+INCOMING_DIR = '.incoming'
+
+# Stored files are named <sha256>.<type>; those without a StoredFile row are
+# removed by reconcile() once this old (seconds)
+STORED_NAME = re.compile(r'^[0-9a-f]{64}\.\w+$')
+STRAY_AGE = 60 * 60
+
+MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'%PDF-', 'pdf'),
+    (b'PK\x03\x04', 'zip'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'ole'),
+]
+# Office Open XML files are zips whose part names give the application away
+OOXML_PARTS = [(b'word/', 'docx'), (b'xl/', 'xlsx'), (b'ppt/', 'pptx')]
+# Legacy Office files are OLE compound documents; only the name tells them apart
+OLE_TYPES = {'doc', 'xls', 'ppt'}
+# Types that get thumbnails ('jpeg' for uploads named before types were detected)
+IMAGE_TYPES = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+
+def extension(name):
+    return os.path.splitext(name)[1][1:].lower()
+
+
+def detect_type(head, name=''):
+    """Returns the type of a file from its leading bytes, as a file extension.
+
+    name is only consulted where the content is ambiguous (legacy Office
+    files). Text is 'txt' and anything unrecognised 'bin'.
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    detected = next((file_type for magic, file_type in MAGIC_NUMBERS if head.startswith(magic)), None)
+    if detected == 'zip':
+        return next((file_type for part, file_type in OOXML_PARTS if part in head), 'zip')
+    if detected == 'ole':
+        return extension(name) if extension(name) in OLE_TYPES else 'ole'
+    if detected:
+        return detected
+    if b'\0' not in head:
+        try:
+            # Incremental, so a character cut at the end of head does not count against it
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+            return 'txt'
+        except UnicodeDecodeError:
+            pass
+    return 'bin'
+
+
+class Spooled:
+    """An upload hashed into a file on the store's filesystem"""
+
+    def __init__(self, path, sha256, size, file_type, owned):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.file_type = file_type
+        # False when path is the upload handler's own temporary file
+        self.owned = owned
+
+    def discard(self):
+        if self.owned and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Stores each distinct file once under its SHA-256, reference counted by StoredFile rows"""
+
+    def get_available_name(self, name, max_length=None):
+        # The stored name comes from the content (see _save), so it never clashes
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        spooled = self.spool(directory, content, name)
+        try:
+            return self.add_reference(directory, spooled)
+        finally:
+            spooled.discard()
+
+    def spool(self, directory, content, name=''):
+        """Hashes content and detects its type in one streaming pass"""
+        digest, size, head = hashlib.sha256(), 0, b''
+        if hasattr(content, 'temporary_file_path'):
+            # Large uploads already sit in a temporary file: read it, and move rather than copy it later
+            with open(content.temporary_file_path(), 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    if len(head) < SNIFF_BYTES:
+                        head += chunk[:SNIFF_BYTES - len(head)]
+                    digest.update(chunk)
+                    size += len(chunk)
+            return Spooled(content.temporary_file_path(), digest.hexdigest(), size, detect_type(head, name), owned=False)
+
+        incoming = self.path(posixpath.join(directory, INCOMING_DIR))
+        os.makedirs(incoming, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=incoming)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    if len(head) < SNIFF_BYTES:
+                        head += chunk[:SNIFF_BYTES - len(head)]
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return Spooled(path, digest.hexdigest(), size, detect_type(head, name), owned=True)
+
+    def add_reference(self, directory, spooled):
+        """Links a spooled upload to its stored file, storing it first if it is new; returns the name"""
+        from .models import StoredFile
+
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(sha256=spooled.sha256).first()
+            if stored is None:
+                try:
+                    with transaction.atomic():
+                        stored = StoredFile.objects.create(
+                            sha256=spooled.sha256,
+                            name=posixpath.join(directory, spooled.sha256[:2], f'{spooled.sha256}.{spooled.file_type}'),
+                            size=spooled.size,
+                            file_type=spooled.file_type,
+                        )
+                except IntegrityError:
+                    # A concurrent upload of the same bytes created the row first
+                    stored = StoredFile.objects.select_for_update().get(sha256=spooled.sha256)
+            if not self.exists(stored.name):
+                self._place(spooled, stored.name)
+            StoredFile.objects.filter(pk=stored.pk).update(reference_count=F('reference_count') + 1)
+        return stored.name
+
+    def _place(self, spooled, name):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True, mode=self.directory_permissions_mode or 0o777)
+        if spooled.owned:
+            os.replace(spooled.path, path)
+        else:
+            file_move_safe(spooled.path, path)
+        if self.file_permissions_mode is not None:
+            os.chmod(path, self.file_permissions_mode)
+
+
+attachment_storage = ContentAddressedStorage()
+
+
+def _delete(stored):
+    from . import thumbnails
+
+    attachment_storage.delete(stored.name)
+    thumbnails.delete(stored.name)
+    stored.delete()
+
+
+def release(name):
+    """Drops one reference to a stored file, deleting the file with the last one.
+
+    Returns True if the file was deleted. Names without a StoredFile row
+    (uploads from before this storage) are left alone.
+    """
+    from .models import StoredFile
+
+    with transaction.atomic():
+        stored = StoredFile.objects.select_for_update().filter(name=name).first()
+        if stored is None:
+            return False
+        if stored.reference_count > 1:
+            StoredFile.objects.filter(pk=stored.pk).update(reference_count=F('reference_count') - 1)
+            return False
+        # Under the row lock: a concurrent upload of the same bytes waits, then stores them afresh
+        _delete(stored)
+    return True
+
+
+def reconcile(stray_age=STRAY_AGE):
+    """Recounts the references from the Media rows and removes unreferenced files.
+
+    Counts drift when Media rows go without their delete signals (raw SQL,
+    restored backups). Files left in the store by uploads whose transaction
+    rolled back are removed once stray_age seconds old. Returns a dict of
+    what changed.
+    """
+    from .models import Media, StoredFile
+
+    summary = {'recounted': 0, 'deleted': 0, 'stray_files': 0}
+    for stored in StoredFile.objects.iterator():
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(pk=stored.pk).first()
+            if stored is None:
+                continue
+            count = Media.objects.filter(file=stored.name).count()
+            if not count:
+                _delete(stored)
+                summary['deleted'] += 1
+            elif count != stored.reference_count:
+                StoredFile.objects.filter(pk=stored.pk).update(reference_count=count)
+                summary['recounted'] += 1
+
+    upload_dir = attachment_storage.path(Media._meta.get_field('file').upload_to)
+    known = set(StoredFile.objects.values_list('name', flat=True))
+    cutoff = time.time() - stray_age
+    for dirpath, _, filenames in os.walk(upload_dir):
+        incoming = os.path.basename(dirpath) == INCOMING_DIR
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, attachment_storage.location).replace(os.sep, '/')
+            stray = incoming or (STORED_NAME.match(filename) and name not in known)
+            if stray and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                summary['stray_files'] += 1
+    return summary
@@ -1,6 +1,7 @@
 from django import template
 from django.contrib.auth.models import User
 from ..models import Role
+from .. import thumbnails
 
 register = template.Library()
 
@@ -48,3 +49,10 @@ def get_ticket_priority_class(priority):
         'urgent': 'bg-danger'
     }
     return priority_classes.get(priority, 'bg-secondary')
+
+@register.simple_tag
+def thumbnail_url(media, size='small'):
+    """
+    Returns the URL of an image attachment's thumbnail.
+    """
+    return thumbnails.url(media, size)
@@ -1,3 +1,1716 @@
-from django.test import TestCase
+import io
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import zipfile
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import User
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core import signing
+from django.core.management import call_command
+from django.test import LiveServerTestCase, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .models import (
+    Role, UserMeta, Ticket, TicketCategory, TicketResponse, TicketAction, Media, FAQKnowledgeBase, SlowQuery, StoredFile,
+    CacheGeneration,
+)
+from . import (
+    assignment, benchmarks, bulk_actions, counters, faq_index, load_test, metrics, pagination, permission_cache, query_plans,
+    queue, sampling_profiler, search, seeding, signals, slow_queries, storage, thumbnails,
+)
+from .admin import FAQKnowledgeBaseAdmin, TicketAdmin, TicketAdminForm
+from .concurrency import TicketConflict, save_ticket
+from .query_budget import QueryRecorder
+from .timeline import build_timeline
+
+# The slow query log's writer thread would write outside the test transactions
+_no_slow_query_log = override_settings(SLOW_QUERY_THRESHOLD_MS=0)
+
+
+def setUpModule():
+    _no_slow_query_log.enable()
+
+
+def tearDownModule():
+    _no_slow_query_log.disable()
+
+
+class TicketCounterTests(TestCase):
+    """Dashboard status counters follow every ticket write"""
+
+    def setUp(self):
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.agents = [User.objects.create_user(username=f'agent{number}', password='secret') for number in range(2)]
+        self.category = TicketCategory.objects.create(name='General')
+
+    def create(self, **fields):
+        fields.setdefault('assigned_to', self.agents[0])
+        return Ticket.objects.create(user=self.requester, category=self.category, title='Printer', description='Jammed', **fields)
+
+    def counts(self, key, *fields):
+        counts = counters.get_counts(key)
+        return tuple(counts[field] for field in fields)
+
+    def test_counts_follow_single_ticket_writes(self):
+        ticket = self.create()
+        self.create(status='resolved')
+        self.assertEqual(self.counts(counters.GLOBAL_KEY, 'total', 'pending', 'resolved'), (2, 1, 1))
+        self.assertEqual(self.counts(counters.requester_key(self.requester.id), 'total'), (2,))
+
+        ticket.status = 'in_progress'
+        ticket.save()
+        self.assertEqual(self.counts(counters.GLOBAL_KEY, 'pending', 'in_progress'), (0, 1))
+
+        ticket.assigned_to = self.agents[1]
+        ticket.save()
+        self.assertEqual(self.counts(counters.agent_key(self.agents[0].id), 'total', 'in_progress'), (1, 0))
+        self.assertEqual(self.counts(counters.agent_key(self.agents[1].id), 'total', 'in_progress'), (1, 1))
+
+        ticket.delete()
+        self.assertEqual(self.counts(counters.GLOBAL_KEY, 'total', 'in_progress'), (1, 0))
+        self.assertEqual(self.counts(counters.agent_key(self.agents[1].id), 'total'), (0,))
+
+    def test_stale_copies_cannot_apply_a_transition_twice(self):
+        ticket = self.create()
+        mine, theirs = Ticket.objects.get(pk=ticket.pk), Ticket.objects.get(pk=ticket.pk)
+        for copy in (mine, theirs):
+            copy.status = 'resolved'
+            copy.save()
+
+        self.assertEqual(self.counts(counters.GLOBAL_KEY, 'total', 'pending', 'resolved'), (1, 0, 1))
+        self.assertEqual(Ticket.objects.get(pk=ticket.pk).version, ticket.version + 2)
+
+    def test_plain_save_reads_the_locked_row_once(self):
+        ticket = self.create()
+        ticket.title = 'Scanner'
+        # The locked read of version and state, and the UPDATE (savepoints and the
+        # search index write aside)
+        with CaptureQueriesContext(connection) as context:
+            ticket.save()
+        statements = [
+            query['sql'] for query in context.captured_queries
+            if 'SAVEPOINT' not in query['sql'] and 'tickets_search_index' not in query['sql']
+        ]
+        self.assertEqual(len(statements), 2, statements)
+        self.assertEqual(ticket.version, Ticket.objects.get(pk=ticket.pk).version)
+
+    def test_update_tickets_moves_the_counts_of_every_ticket(self):
+        for status in ['pending', 'pending', 'in_progress']:
+            self.create(status=status)
+
+        updated = counters.update_tickets(Ticket.objects.all(), status='closed', assigned_to=self.agents[1])
+
+        self.assertEqual(updated, 3)
+        self.assertEqual(self.counts(counters.GLOBAL_KEY, 'total', 'pending', 'in_progress', 'closed'), (3, 0, 0, 3))
+        self.assertEqual(self.counts(counters.agent_key(self.agents[0].id), 'total'), (0,))
+        self.assertEqual(self.counts(counters.agent_key(self.agents[1].id), 'total', 'closed'), (3, 3))
+
+    def test_reconcile_command_repairs_drifted_counts(self):
+        self.create()
+        self.create(status='closed')
+        # Bypasses the counters, as raw SQL or a restored backup would
+        Ticket.objects.update(status='resolved')
+        self.assertEqual(self.counts(counters.GLOBAL_KEY, 'resolved'), (0,))
+
+        call_command('reconcile_ticket_counters', stdout=io.StringIO())
+
+        self.assertEqual(self.counts(counters.GLOBAL_KEY, 'total', 'pending', 'closed', 'resolved'), (2, 0, 0, 2))
+        self.assertEqual(self.counts(counters.agent_key(self.agents[0].id), 'resolved'), (2,))
+
+
+class TicketTimelineTests(TestCase):
+    """Timeline assembly for the ticket detail page"""
+
+    def setUp(self):
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.requester.user_meta.is_profile_completed = True
+        self.requester.user_meta.save()
+
+        agent_role, _ = Role.objects.get_or_create(name='support_agent')
+        self.agent = User.objects.create_user(username='agent', password='secret')
+        self.agent.user_meta.role = agent_role
+        self.agent.user_meta.is_profile_completed = True
+        self.agent.user_meta.save()
+
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(
+            user=self.requester, assigned_to=self.agent, category=category,
+            title='Printer on fire', description='It is on fire'
+        )
+
+    def add_thread(self, count):
+        """Adds count responses alternating between requester and agent, each with a file"""
+        for index in range(count):
+            author = self.requester if index % 2 == 0 else self.agent
+            response = TicketResponse.objects.create(ticket=self.ticket, user=author, message=f'Message {index}')
+            Media.objects.create(
+                ticket=self.ticket, response=response, user=author,
+                file=f'uploads/file-{index}.txt', file_type='txt'
+            )
+            TicketAction.objects.create(ticket=self.ticket, performed_by=self.agent, action_type='review')
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context.captured_queries)
+
+    def test_files_attach_to_their_own_response(self):
+        self.add_thread(4)
+        responses = [item for item in build_timeline(self.ticket) if item['type'] == 'response']
+
+        self.assertEqual(len(responses), 4)
+        for index, item in enumerate(responses):
+            self.assertEqual([media.file.name for media in item['files']], [f'uploads/file-{index}.txt'])
+
+    def test_timeline_is_in_time_order_and_hides_notes(self):
+        self.add_thread(3)
+        TicketAction.objects.create(ticket=self.ticket, performed_by=self.agent, action_type='note', notes='internal')
+
+        staff_view = build_timeline(self.ticket, include_notes=True)
+        customer_view = build_timeline(self.ticket, include_notes=False)
+
+        times = [item['time'] for item in staff_view]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(len(staff_view), len(customer_view) + 1)
+        self.assertNotIn('internal', [item['content'] for item in customer_view])
+
+    def test_timeline_query_count_is_constant(self):
+        self.add_thread(3)
+        small = self.count_queries(lambda: [item['user'].user_meta.role for item in build_timeline(self.ticket)])
+
+        self.add_thread(30)
+        large = self.count_queries(lambda: [item['user'].user_meta.role for item in build_timeline(self.ticket)])
+
+        self.assertEqual(small, large)
+        self.assertEqual(large, 3)
+
+    def test_ticket_detail_query_count_is_constant(self):
+        self.client.force_login(self.requester)
+        url = reverse('ticket_detail', args=[self.ticket.id])
+
+        self.add_thread(3)
+        small = self.count_queries(lambda: self.client.get(url))
+
+        self.add_thread(30)
+        large = self.count_queries(lambda: self.client.get(url))
+
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(small, large)
+
+
+class KeysetPaginationTests(TestCase):
+    """Cursor pages over (created_at, id), newest first"""
+
+    def setUp(self):
+        requester = User.objects.create_user(username='requester', password='secret')
+        category = TicketCategory.objects.create(name='General')
+        for number in range(25):
+            Ticket.objects.create(user=requester, category=category, title=f'Ticket {number}', description='Jammed')
+        # Groups of five share a timestamp, so only the id orders them
+        start = timezone.now()
+        for index, pk in enumerate(Ticket.objects.order_by('id').values_list('pk', flat=True)):
+            Ticket.objects.filter(pk=pk).update(created_at=start + timedelta(minutes=index // 5))
+        self.newest_first = list(Ticket.objects.order_by('-created_at', '-id').values_list('pk', flat=True))
+
+    def ids(self, page):
+        return [ticket.pk for ticket in page]
+
+    def test_cursors_walk_forwards_and_backwards(self):
+        pages = [pagination.paginate(Ticket.objects.all(), per_page=10)]
+        while pages[-1].has_next:
+            pages.append(pagination.paginate(Ticket.objects.all(), pages[-1].next_cursor, per_page=10))
+
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum((self.ids(page) for page in pages), []), self.newest_first)
+        self.assertFalse(pages[0].has_previous)
+
+        back = pagination.paginate(Ticket.objects.all(), pages[2].previous_cursor, per_page=10)
+        self.assertEqual(self.ids(back), self.ids(pages[1]))
+        first = pagination.paginate(Ticket.objects.all(), back.previous_cursor, per_page=10)
+        self.assertEqual(self.ids(first), self.ids(pages[0]))
+        self.assertFalse(first.has_previous)
+        self.assertTrue(first.has_next)
+
+    def test_page_boundary_inside_a_timestamp_tie(self):
+        # Seven per page cuts the second group of equal timestamps in two
+        first = pagination.paginate(Ticket.objects.all(), per_page=7)
+        second = pagination.paginate(Ticket.objects.all(), first.next_cursor, per_page=7)
+
+        self.assertEqual(self.ids(first) + self.ids(second), self.newest_first[:14])
+
+    def test_invalid_cursors_give_the_first_page(self):
+        first_page = self.ids(pagination.paginate(Ticket.objects.all(), per_page=10))
+        valid = pagination.paginate(Ticket.objects.all(), per_page=10).next_cursor
+        signed_garbage = signing.dumps(['not', 'a', 'cursor'], salt=pagination.CURSOR_SALT)
+
+        for cursor in ['garbage', valid[:-3] + 'abc', signed_garbage, signing.dumps({'t': 'x', 'i': 1, 'd': 'next'})]:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.ids(pagination.paginate(Ticket.objects.all(), cursor, per_page=10)), first_page)
+
+    def test_approximate_count_is_capped(self):
+        self.assertEqual(pagination.approximate_count(Ticket.objects.all(), limit=100), (25, True))
+        self.assertEqual(pagination.approximate_count(Ticket.objects.all(), limit=25), (25, True))
+        self.assertEqual(pagination.approximate_count(Ticket.objects.all(), limit=10), (10, False))
+
+
+class SearchTestMixin:
+    """Tickets with known text to search for"""
+
+    def setUp(self):
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.category = TicketCategory.objects.create(name='General')
+
+    def create(self, title, description='Nothing else to say'):
+        return Ticket.objects.create(user=self.requester, category=self.category, title=title, description=description)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'FTS5 backend tests need SQLite')
+class FullTextSearchTests(SearchTestMixin, TestCase):
+    """The SQLite FTS5 backend and the ticket reference shortcut"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Outside the test transaction, for databases created without migrations
+        search.get_backend().install()
+        super().setUpClass()
+
+    def test_title_matches_rank_above_body_matches(self):
+        in_body = self.create('Cannot print', 'The printer on the third floor is jammed')
+        in_title = self.create('Printer jammed', 'Paper stuck somewhere')
+        in_response = self.create('Something odd')
+        TicketResponse.objects.create(ticket=in_response, user=self.requester, message='Now the printer is jammed too')
+        self.create('Unrelated', 'Mouse is broken')
+
+        self.assertEqual(search.search_tickets('jammed printer', Ticket.objects.all()),
+                         [in_title.pk, in_body.pk, in_response.pk])
+
+    def test_ticket_references(self):
+        self.assertEqual(search.parse_ticket_reference('TKT-0042'), (42, True))
+        self.assertEqual(search.parse_ticket_reference(' #7 '), (7, True))
+        self.assertEqual(search.parse_ticket_reference('42'), (42, False))
+        self.assertEqual(search.parse_ticket_reference('printer 42'), (None, False))
+
+        ticket = self.create('Printer jammed')
+        mentions_id = self.create(f'Error {ticket.pk} on screen')
+        self.assertEqual(search.search_tickets(f'#{ticket.pk}', Ticket.objects.all()), [ticket.pk])
+        # A bare number is also a word: the ticket itself comes first
+        self.assertEqual(search.search_tickets(str(ticket.pk), Ticket.objects.all()), [ticket.pk, mentions_id.pk])
+        # References outside the queryset are not leaked
+        self.assertEqual(search.search_tickets(f'#{ticket.pk}', Ticket.objects.exclude(pk=ticket.pk)), [])
+
+    def test_query_syntax_is_taken_literally(self):
+        ticket = self.create('Error code-42 (fatal)', 'Printer body says NEAR jam OR worse')
+
+        for query in ['code-42 (fatal', '"fatal', 'near(printer jam)', 'printer OR worse', 'fatal*', 'body:jam', '^error']:
+            with self.subTest(query=query):
+                self.assertEqual(search.search_tickets(query, Ticket.objects.all()), [ticket.pk])
+        # OR is a word to match, not an operator
+        self.assertEqual(search.search_tickets('printer OR mouse', Ticket.objects.all()), [])
+        self.assertEqual(search.search_tickets('*', Ticket.objects.all()), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        ticket = self.create('Printer jammed')
+        response = TicketResponse.objects.create(ticket=ticket, user=self.requester, message='Toner is empty')
+        self.assertEqual(search.search_tickets('toner', Ticket.objects.all()), [ticket.pk])
+        self.assertEqual(search.search_responses('toner', TicketResponse.objects.all()), [response.pk])
+
+        ticket.title = 'Scanner jammed'
+        ticket.save()
+        self.assertEqual(search.search_tickets('printer', Ticket.objects.all()), [])
+        self.assertEqual(search.search_tickets('scanner', Ticket.objects.all()), [ticket.pk])
+
+        response.delete()
+        self.assertEqual(search.search_tickets('toner', Ticket.objects.all()), [])
+        ticket.delete()
+        self.assertEqual(search.search_tickets('scanner', Ticket.objects.all()), [])
+
+    def test_rebuild_reindexes_everything(self):
+        ticket = self.create('Printer jammed')
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.SQLiteFTS5Backend.TABLE}')
+        self.assertEqual(search.search_tickets('printer', Ticket.objects.all()), [])
+
+        call_command('rebuild_search_index', stdout=io.StringIO())
+
+        self.assertEqual(search.search_tickets('printer', Ticket.objects.all()), [ticket.pk])
+
+
+class BasicSearchTests(SearchTestMixin, TestCase):
+    """The LIKE fallback for databases without a full-text engine"""
+
+    def test_every_word_must_match_somewhere(self):
+        backend = search.BasicSearchBackend()
+        both = self.create('Printer jammed', 'Paper stuck')
+        split = self.create('Printer offline', 'And now it is jammed')
+        in_response = self.create('Something odd')
+        TicketResponse.objects.create(ticket=in_response, user=self.requester, message='Printer jammed again')
+        self.create('Printer offline')
+
+        self.assertEqual(set(backend.ranked_ticket_ids('JAMMED printer', Ticket.objects.all())),
+                         {both.pk, split.pk, in_response.pk})
+        self.assertEqual(backend.ranked_ticket_ids('printer', Ticket.objects.filter(pk=both.pk)), [both.pk])
+        self.assertEqual(backend.ranked_ticket_ids('%_', Ticket.objects.all()), [])
+        self.assertEqual(backend.ranked_response_ids('again', TicketResponse.objects.all()),
+                         list(TicketResponse.objects.values_list('id', flat=True)))
+
+    def test_admin_search_matches_requester_name_prefixes(self):
+        ticket = self.create('Printer jammed')
+        other = User.objects.create_user(username='someone', password='secret')
+        Ticket.objects.create(user=other, category=self.category, title='Mouse broken', description='Nothing')
+        request = RequestFactory().get('/')
+        ticket_admin = TicketAdmin(Ticket, admin.site)
+
+        for term in ['requester', 'REQUEST', 'req']:
+            with self.subTest(term=term):
+                queryset, _ = ticket_admin.get_search_results(request, Ticket.objects.all(), term)
+                self.assertEqual(list(queryset), [ticket])
+        queryset, _ = ticket_admin.get_search_results(request, Ticket.objects.all(), 'quest')
+        self.assertEqual(list(queryset), [])
+
+
+class FAQIndexTests(TestCase):
+    """BM25 search over the published FAQs and its per-process invalidation"""
+
+    def setUp(self):
+        self.author = User.objects.create_user(username='author', password='secret')
+        # Earlier tests may have left an index built from their own rows
+        faq_index.invalidate()
+
+    def add(self, question, answer, **fields):
+        return FAQKnowledgeBase.objects.create(question=question, answer=answer, created_by=self.author, **fields)
+
+    def questions(self, query, category=None):
+        return [faq.question for faq in faq_index.get_index().search(query, category)]
+
+    def test_question_matches_outrank_answer_matches(self):
+        self.add('How do I reset my password?', 'Use the link on the login page.')
+        self.add('Why is my account locked?', 'Too many failed logins. Reset your password to unlock it.')
+        self.add('Where are my invoices?', 'Under billing.', category='billing')
+
+        self.assertEqual(self.questions('password'), ['How do I reset my password?', 'Why is my account locked?'])
+        self.assertEqual(self.questions('reset password locked'), ['Why is my account locked?'])
+        self.assertEqual(self.questions('password', category='billing'), [])
+        self.assertEqual(self.questions('passwords'), [])
+
+    def test_last_word_matches_as_a_prefix(self):
+        self.add('How do I reset my password?', 'Use the link on the login page.')
+        self.add('Can I change my email address?', 'Yes, in your profile.')
+
+        self.assertEqual(self.questions('pass'), ['How do I reset my password?'])
+        self.assertEqual(self.questions('reset pa'), ['How do I reset my password?'])
+        # Only the last word is a prefix
+        self.assertEqual(self.questions('pass reset'), [])
+
+    def test_unpublished_faqs_are_left_out(self):
+        self.add('How do I reset my password?', 'Use the link on the login page.')
+        self.add('Password policy draft', 'Not ready yet.', is_published=False)
+
+        self.assertEqual(self.questions('password'), ['How do I reset my password?'])
+        self.assertEqual(len(self.questions('')), 1)
+
+    def test_edits_invalidate_the_index(self):
+        faq = self.add('How do I reset my password?', 'Use the link on the login page.')
+        self.assertEqual(self.questions('token'), [])
+
+        # Saved in this process: the signal drops the index at once
+        faq.answer = 'Request a reset token by email.'
+        faq.save()
+        self.assertEqual(self.questions('token'), ['How do I reset my password?'])
+
+        # Saved in another process: only the shared generation moves, seen after CHECK_INTERVAL
+        FAQKnowledgeBase.objects.filter(pk=faq.pk).update(question='How do I unlock my account?')
+        CacheGeneration.bump(faq_index.GENERATION_NAME)
+        checked_at = faq_index._checked_at
+        with mock.patch.object(faq_index.time, 'monotonic', return_value=checked_at):
+            self.assertEqual(self.questions('unlock'), [])
+        with mock.patch.object(faq_index.time, 'monotonic', return_value=checked_at + faq_index.CHECK_INTERVAL):
+            self.assertEqual(self.questions('unlock'), ['How do I unlock my account?'])
+
+
+class AccessContextTests(TestCase):
+    """Role and profile are resolved once per request"""
+
+    def setUp(self):
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.requester.user_meta.is_profile_completed = True
+        self.requester.user_meta.save()
+
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(
+            user=self.requester, category=category, title='Printer on fire', description='It is on fire'
+        )
+
+    def access_queries(self, url):
+        """Returns the queries that read profile or role rows directly while serving url"""
+        tables = [connection.ops.quote_name(table) for table in ('tickets_usermeta', 'tickets_role')]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries
+                if any(f'FROM {table}' in query['sql'] for table in tables)]
+
+    def test_customer_pages_resolve_access_once(self):
+        self.client.force_login(self.requester)
+        for url in [reverse('dashboard'), reverse('ticket_list'), reverse('ticket_detail', args=[self.ticket.id])]:
+            queries = self.access_queries(url)
+            self.assertEqual(len(queries), 1, url)
+            self.assertIn('tickets_role', queries[0])
+
+    def test_incomplete_profile_is_redirected(self):
+        self.requester.user_meta.is_profile_completed = False
+        self.requester.user_meta.save()
+        self.client.force_login(self.requester)
+
+        response = self.client.get(reverse('dashboard'))
+        self.assertRedirects(response, reverse('profile'), fetch_redirect_response=False)
+
+    def test_staff_are_sent_to_admin(self):
+        agent_role, _ = Role.objects.get_or_create(name='support_agent')
+        self.requester.user_meta.role = agent_role
+        self.requester.user_meta.save()
+        self.client.force_login(self.requester)
+
+        response = self.client.get(reverse('ticket_list'))
+        self.assertRedirects(response, '/admin/', fetch_redirect_response=False)
+
+
+class RolePermissionTests(TestCase):
+    """Compiled role permission checks"""
+
+    def test_checks_follow_the_saved_permissions(self):
+        role = Role.objects.create(name='support_agent', permissions='respond_to_tickets, close_tickets')
+
+        self.assertTrue(role.has_permission('close_tickets'))
+        self.assertFalse(role.has_permission('manage_users'))
+        self.assertTrue(role.has_permissions('respond_to_tickets', 'close_tickets'))
+        self.assertFalse(role.has_permissions('close_tickets', 'manage_users'))
+        self.assertTrue(role.has_permissions('close_tickets', 'manage_users', require_all=False))
+        self.assertFalse(role.has_permission('not_a_permission'))
+
+        role.set_permission('manage_users')
+        self.assertTrue(Role.objects.get(pk=role.pk).has_permissions('close_tickets', 'manage_users'))
+        self.assertTrue(role.has_permission('manage_users'))
+
+    def test_admin_role_has_every_permission(self):
+        role = Role(name='Admin')
+        self.assertEqual(role.permission_mask, Role.ALL_PERMISSIONS)
+        self.assertTrue(role.has_permissions(*Role.PERMISSION_BITS))
+
+
+class PermissionSyncTests(TestCase):
+    """Django permissions follow the user's role through the role's group"""
+
+    def setUp(self):
+        self.role = Role.objects.create(name='support_agent', permissions='respond_to_tickets')
+
+    def codenames(self, user):
+        user = User.objects.get(pk=user.pk)
+        return {perm.split('.', 1)[1] for perm in user.get_all_permissions()}
+
+    def assign(self, username, role=None):
+        user = User.objects.create_user(username=username, password='secret')
+        user.user_meta.role = role or self.role
+        user.user_meta.save()
+        return user
+
+    def test_role_assignment_grants_mapped_permissions(self):
+        user = self.assign('agent')
+
+        self.assertEqual(self.codenames(user), {
+            'add_ticketresponse', 'view_ticketresponse', 'change_ticketresponse',
+            'view_ticket', 'view_ticketaction', 'add_ticketaction',
+        })
+        self.assertTrue(User.objects.get(pk=user.pk).is_staff)
+        self.assertFalse(user.user_permissions.exists())
+        self.assertEqual(list(user.groups.all()), [Role.objects.get(pk=self.role.pk).group])
+
+    def test_role_change_moves_the_user_between_groups(self):
+        user = self.assign('agent')
+        faq_role = Role.objects.create(name='editor', permissions='manage_faq')
+        meta = UserMeta.objects.get(user=user)
+        meta.role = faq_role
+        meta.save()
+
+        self.assertEqual(list(user.groups.all()), [Role.objects.get(pk=faq_role.pk).group])
+        self.assertIn('add_faqknowledgebase', self.codenames(user))
+        self.assertNotIn('change_ticketresponse', self.codenames(user))
+
+    def test_profile_edit_leaves_permissions_alone(self):
+        user = self.assign('agent')
+        meta = UserMeta.objects.get(user=user)
+        meta.location = 'Berlin'
+
+        with CaptureQueriesContext(connection) as context:
+            meta.save()
+        self.assertFalse([q for q in context.captured_queries if 'auth_' in q['sql']])
+
+    def role_edit_queries(self, holders):
+        for index in range(holders):
+            self.assign(f'agent{holders}-{index}')
+        self.role.permissions = 'manage_faq' if self.role.permissions != 'manage_faq' else 'respond_to_tickets'
+        with CaptureQueriesContext(connection) as context:
+            self.role.save()
+        return len(context.captured_queries)
+
+    def test_role_edit_cost_does_not_depend_on_holders(self):
+        self.assertEqual(self.role_edit_queries(2), self.role_edit_queries(20))
+
+        user = User.objects.filter(user_meta__role=self.role).first()
+        self.assertIn('change_ticketresponse', self.codenames(user))
+        self.assertNotIn('add_faqknowledgebase', self.codenames(user))
+
+
+class PermissionCacheTests(TestCase):
+    """Admin permission checks are answered from the cross-request cache"""
+
+    PERMISSION_TABLES = ('auth_permission', 'auth_group', 'auth_user_groups', 'auth_user_user_permissions')
+
+    def setUp(self):
+        role = Role.objects.create(name='support_agent', permissions='respond_to_tickets,view_assigned_tickets')
+        self.agent = User.objects.create_user(username='agent', password='secret')
+        self.agent.user_meta.role = role
+        self.agent.user_meta.is_profile_completed = True
+        self.agent.user_meta.save()
+
+        category = TicketCategory.objects.create(name='General')
+        for index in range(5):
+            Ticket.objects.create(user=self.agent, assigned_to=self.agent, category=category, title=f'Ticket {index}')
+
+    def permission_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries
+                if any(table in query['sql'] for table in self.PERMISSION_TABLES)]
+
+    def test_changelist_permission_checks_are_cached_across_requests(self):
+        self.client.force_login(self.agent)
+        url = reverse('admin:tickets_ticket_changelist')
+
+        self.assertLessEqual(len(self.permission_queries(url)), 2)
+        self.assertEqual(self.permission_queries(url), [])
+
+    def test_permission_change_is_visible_immediately(self):
+        self.assertTrue(User.objects.get(pk=self.agent.pk).has_perm('tickets.change_ticketresponse'))
+
+        role = Role.objects.get(name='support_agent')
+        role.permissions = 'manage_faq'
+        role.save()
+
+        agent = User.objects.get(pk=self.agent.pk)
+        self.assertFalse(agent.has_perm('tickets.change_ticketresponse'))
+        self.assertTrue(agent.has_perm('tickets.add_faqknowledgebase'))
+
+
+class AssignmentTests(TestCase):
+    """Least-loaded assignment of tickets to support agents"""
+
+    def setUp(self):
+        agent_role = Role.objects.create(name='support_agent')
+        self.agents = []
+        for index in range(3):
+            agent = User.objects.create_user(username=f'agent{index}', password='secret')
+            agent.user_meta.role = agent_role
+            agent.user_meta.save()
+            self.agents.append(agent)
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.category = TicketCategory.objects.create(name='General')
+
+    def create_tickets(self, count, **fields):
+        return [
+            Ticket.objects.create(user=self.requester, category=self.category, title=f'Ticket {index}', **fields)
+            for index in range(count)
+        ]
+
+    def loads(self):
+        return [Ticket.objects.filter(assigned_to=agent).count() for agent in self.agents]
+
+    def test_bulk_assignment_levels_the_load(self):
+        self.create_tickets(4, assigned_to=self.agents[0])
+        self.create_tickets(11)
+
+        assigned, skipped = assignment.assign_tickets(Ticket.objects.all(), performed_by=self.agents[0], batch_size=4)
+
+        self.assertEqual((assigned, skipped), (11, 4))
+        self.assertEqual(self.loads(), [5, 5, 5])
+        self.assertEqual(TicketAction.objects.filter(action_type='assign').count(), 11)
+        self.assertEqual(counters.get_counts(counters.agent_key(self.agents[1].id))['pending'], 5)
+
+    def test_rerun_does_not_reassign(self):
+        self.create_tickets(6)
+        assignment.assign_tickets(Ticket.objects.all())
+        before = dict(Ticket.objects.values_list('id', 'assigned_to_id'))
+
+        self.assertEqual(assignment.assign_tickets(Ticket.objects.all()), (0, 6))
+        self.assertEqual(dict(Ticket.objects.values_list('id', 'assigned_to_id')), before)
+
+    def test_new_tickets_round_robin_on_ties(self):
+        assigned = [assignment.assign_new_ticket(ticket) for ticket in self.create_tickets(3)]
+        self.assertEqual(sorted(assigned), sorted(agent.id for agent in self.agents))
+
+    def test_closed_tickets_do_not_count_as_load(self):
+        self.create_tickets(3, assigned_to=self.agents[0], status='closed')
+        ticket, = self.create_tickets(1)
+        self.assertEqual(assignment.assign_new_ticket(ticket), self.agents[0].id)
+
+    def test_role_names_match_case_insensitively(self):
+        Role.objects.filter(name='support_agent').update(name='Support_Agent')
+        self.assertEqual(set(assignment.support_agents()), set(self.agents))
+
+    def test_assigned_tickets_skip_the_load_lookup(self):
+        ticket, = self.create_tickets(1, assigned_to=self.agents[1])
+        with self.assertNumQueries(0):
+            self.assertIsNone(assignment.assign_new_ticket(ticket))
+
+
+class BulkActionTests(TestCase):
+    """Chunked bulk updates behind the ticket admin actions"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='boss', password='secret')
+        self.admin.user_meta.role = Role.objects.create(name='admin')
+        self.admin.user_meta.is_profile_completed = True
+        self.admin.user_meta.save()
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        category = TicketCategory.objects.create(name='General')
+        self.tickets = [
+            Ticket.objects.create(user=self.requester, category=category, title=f'Ticket {index}')
+            for index in range(7)
+        ]
+
+    def test_chunks_update_once_and_rerun_is_a_no_op(self):
+        self.tickets[0].status = 'resolved'
+        self.tickets[0].save()
+        progress = []
+
+        result = bulk_actions.bulk_update(
+            Ticket.objects.all(), {'status': 'resolved'}, 'status_change', 'Resolved', chunk_size=3,
+            progress=lambda result: progress.append(result.updated)
+        )
+        self.assertEqual((result.updated, result.unchanged, result.chunks), (6, 1, 3))
+        self.assertEqual(progress, [2, 5, 6])
+        self.assertEqual(TicketAction.objects.filter(action_type='status_change').count(), 6)
+        self.assertEqual(counters.get_counts(counters.GLOBAL_KEY)['resolved'], 7)
+
+        rerun = bulk_actions.bulk_update(Ticket.objects.all(), {'status': 'resolved'}, 'status_change', 'Resolved')
+        self.assertEqual((rerun.updated, rerun.unchanged), (0, 7))
+        self.assertEqual(TicketAction.objects.filter(action_type='status_change').count(), 6)
+
+    def test_select_all_admin_action(self):
+        self.client.force_login(self.admin)
+        response = self.client.post(reverse('admin:tickets_ticket_changelist'), {
+            'action': 'set_priority_urgent',
+            'select_across': '1',
+            '_selected_action': [self.tickets[0].pk],
+            'index': '0',
+        })
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Ticket.objects.filter(priority='urgent').count(), 7)
+        self.assertEqual(TicketAction.objects.filter(action_type='update').count(), 7)
+
+    def test_targeted_actions_ask_for_the_target_first(self):
+        agent = User.objects.create_user(username='agent', password='secret')
+        agent.user_meta.role = Role.objects.create(name='support_agent')
+        agent.user_meta.save()
+        hardware = TicketCategory.objects.create(name='Hardware')
+        self.client.force_login(self.admin)
+        changelist = reverse('admin:tickets_ticket_changelist')
+        # Filtered, so select_across covers only the tickets the filter still matches
+        selection = {'select_across': '1', '_selected_action': [self.tickets[0].pk]}
+        Ticket.objects.filter(pk=self.tickets[0].pk).update(priority='high')
+        filtered = f'{changelist}?priority__exact=medium'
+
+        page = self.client.post(filtered, {**selection, 'action': 'reassign_to_agent', 'index': '0'})
+        self.assertContains(page, '6 tickets selected')
+        self.assertEqual(list(page.context['form'].fields['target'].queryset), [agent])
+        self.assertIsNone(Ticket.objects.filter(assigned_to=agent).first())
+
+        response = self.client.post(filtered, {**selection, 'action': 'reassign_to_agent', 'apply': '1', 'target': agent.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Ticket.objects.filter(assigned_to=agent).count(), 6)
+        self.assertEqual(TicketAction.objects.filter(action_type='assign').count(), 6)
+
+        response = self.client.post(changelist, {'action': 'move_to_category', 'apply': '1', 'target': hardware.pk,
+                                                 '_selected_action': [self.tickets[1].pk, self.tickets[2].pk]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Ticket.objects.filter(category=hardware).count(), 2)
+
+    def test_action_list_does_not_grow_with_categories_and_agents(self):
+        for index in range(5):
+            TicketCategory.objects.create(name=f'Category {index}')
+        request = RequestFactory().get(reverse('admin:tickets_ticket_changelist'))
+        request.user = self.admin
+
+        actions = TicketAdmin(Ticket, admin.site).get_actions(request)
+
+        self.assertIn('move_to_category', actions)
+        self.assertIn('reassign_to_agent', actions)
+        self.assertFalse([name for name in actions if name.startswith(('set_category_', 'reassign_to_'))
+                          and name != 'reassign_to_agent'])
+
+
+class WorkQueueTests(TestCase):
+    """Atomic claiming of the next ticket by support agents"""
+
+    def setUp(self):
+        agent_role = Role.objects.create(name='support_agent')
+        self.agents = []
+        for index in range(2):
+            agent = User.objects.create_user(username=f'agent{index}', password='secret')
+            agent.user_meta.role = agent_role
+            agent.user_meta.is_profile_completed = True
+            agent.user_meta.save()
+            self.agents.append(agent)
+        requester = User.objects.create_user(username='requester', password='secret')
+        category = TicketCategory.objects.create(name='General')
+        self.low, self.urgent_old, self.urgent_new, self.taken = [
+            Ticket.objects.create(user=requester, category=category, title=title, priority=priority)
+            for title, priority in [('Low', 'low'), ('Urgent 1', 'urgent'), ('Urgent 2', 'urgent'), ('Taken', 'urgent')]
+        ]
+        self.taken.assigned_to = self.agents[1]
+        self.taken.save()
+
+    def test_claims_follow_priority_then_age_and_never_repeat(self):
+        claimed = [queue.claim_next(agent) for agent in (self.agents[0], self.agents[1], self.agents[0])]
+
+        self.assertEqual([ticket.pk for ticket in claimed], [self.urgent_old.pk, self.urgent_new.pk, self.low.pk])
+        self.assertIsNone(queue.claim_next(self.agents[1]))
+        self.assertEqual(counters.get_counts(counters.agent_key(self.agents[0].id))['pending'], 2)
+        self.assertEqual(TicketAction.objects.filter(action_type='assign').count(), 3)
+
+    def test_compare_and_set_loses_to_an_earlier_claim(self):
+        self.assertTrue(queue._assign(self.low.pk, self.low.user_id, self.agents[0]))
+        self.assertFalse(queue._assign(self.low.pk, self.low.user_id, self.agents[1]))
+        self.assertEqual(Ticket.objects.get(pk=self.low.pk).assigned_to, self.agents[0])
+
+    def test_priority_rank_follows_priority(self):
+        self.low.priority = 'high'
+        self.low.save(update_fields=['priority'])
+        self.assertEqual(Ticket.objects.get(pk=self.low.pk).priority_rank, Ticket.PRIORITY_RANKS['high'])
+
+    def test_agent_grabs_next_ticket_from_the_admin(self):
+        self.client.force_login(self.agents[0])
+        response = self.client.post(reverse('admin:tickets_ticket_claim_next'))
+
+        self.assertRedirects(response, reverse('admin:tickets_ticket_change', args=[self.urgent_old.pk]),
+                             fetch_redirect_response=False)
+        self.assertEqual(Ticket.objects.get(pk=self.urgent_old.pk).assigned_to, self.agents[0])
+
+    def test_agent_claims_among_the_selected_tickets(self):
+        self.client.force_login(self.agents[0])
+        response = self.client.post(reverse('admin:tickets_ticket_changelist'), {
+            'action': 'claim_next_selected',
+            admin.helpers.ACTION_CHECKBOX_NAME: [self.low.pk, self.urgent_new.pk, self.taken.pk],
+        })
+
+        self.assertRedirects(response, reverse('admin:tickets_ticket_change', args=[self.urgent_new.pk]),
+                             fetch_redirect_response=False)
+        self.assertEqual(Ticket.objects.get(pk=self.urgent_new.pk).assigned_to, self.agents[0])
+        self.assertEqual(Ticket.objects.get(pk=self.taken.pk).assigned_to, self.agents[1])
+        self.assertIsNone(Ticket.objects.get(pk=self.urgent_old.pk).assigned_to)
+
+
+class ConcurrencyTests(TestCase):
+    """Optimistic version checks on ticket writes"""
+
+    def setUp(self):
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(user=self.requester, category=category, title='Printer', description='Jammed')
+
+    def test_every_write_moves_the_version(self):
+        version = self.ticket.version
+        self.ticket.priority = 'high'
+        self.ticket.save()
+        self.assertEqual(self.ticket.version, version + 1)
+        counters.update_tickets(Ticket.objects.filter(pk=self.ticket.pk), status='closed')
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).version, version + 2)
+
+    def test_stale_write_is_rejected(self):
+        mine = Ticket.objects.get(pk=self.ticket.pk)
+        theirs = Ticket.objects.get(pk=self.ticket.pk)
+        theirs.status = 'resolved'
+        save_ticket(theirs, ['status'])
+
+        mine.status = 'closed'
+        with self.assertRaises(TicketConflict) as raised:
+            save_ticket(mine, ['status'])
+
+        self.assertEqual(raised.exception.current.status, 'resolved')
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).status, 'resolved')
+        counts = counters.get_counts(counters.GLOBAL_KEY)
+        self.assertEqual((counts['resolved'], counts['closed'], counts['pending']), (1, 0, 0))
+
+    def test_only_the_named_fields_are_written(self):
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        ticket.title = 'Unsaved edit'
+        ticket.priority = 'urgent'
+        save_ticket(ticket, ['priority'])
+
+        stored = Ticket.objects.get(pk=self.ticket.pk)
+        self.assertEqual((stored.title, stored.priority_rank), ('Printer', Ticket.PRIORITY_RANKS['urgent']))
+        self.assertEqual(stored.version, ticket.version)
+
+    def test_admin_form_rejects_a_stale_version(self):
+        data = {
+            'user': self.requester.pk, 'title': 'Printer', 'description': 'Jammed',
+            'status': 'in_progress', 'priority': 'medium', 'category': self.ticket.category_id,
+            'expected_version': self.ticket.version,
+        }
+        Ticket.objects.filter(pk=self.ticket.pk).update(status='resolved', version=self.ticket.version + 1)
+
+        form = TicketAdminForm(data, instance=Ticket.objects.get(pk=self.ticket.pk))
+        self.assertFalse(form.is_valid())
+        self.assertIn('changed by someone else', str(form.non_field_errors()))
+
+    def admin_change_form(self):
+        """Logs in an admin and returns the change page URL and the data its form would post back unchanged"""
+        admin_user = User.objects.create_superuser(username='boss', password='secret')
+        admin_user.user_meta.role = Role.objects.create(name='admin')
+        admin_user.user_meta.is_profile_completed = True
+        admin_user.user_meta.save()
+        self.client.force_login(admin_user)
+        url = reverse('admin:tickets_ticket_change', args=[self.ticket.pk])
+        page = self.client.get(url)
+
+        data = {}
+        for form in [page.context['adminform'].form] + [
+            form for inline in page.context['inline_admin_formsets']
+            for form in [inline.formset.management_form, *inline.formset.forms]
+        ]:
+            for field in form:
+                if field.value() is not None:
+                    data[field.html_name] = field.value()
+        # The version must come from the page itself, not from the form class
+        data['expected_version'] = re.search(r'<input type="hidden" name="expected_version" value="(\d+)"',
+                                             page.content.decode()).group(1)
+        return url, data
+
+    def add_response(self, data):
+        data['responses-TOTAL_FORMS'] = 1
+        data['responses-0-message'] = 'Sent from the admin'
+        data['responses-0-ticket'] = self.ticket.pk
+
+    def test_admin_change_page_rejects_a_stale_edit(self):
+        url, data = self.admin_change_form()
+        self.assertEqual(data['expected_version'], str(self.ticket.version))
+        # Someone else saves the ticket while the page is open
+        theirs = Ticket.objects.get(pk=self.ticket.pk)
+        theirs.status = 'resolved'
+        save_ticket(theirs, ['status'])
+
+        data['status'] = 'closed'
+        self.add_response(data)
+        response = self.client.post(url, data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('changed by someone else', str(response.context['adminform'].form.non_field_errors()))
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).status, 'resolved')
+        self.assertFalse(TicketResponse.objects.exists())
+        self.assertFalse(LogEntry.objects.exists())
+
+    def test_admin_conflict_after_validation_saves_nothing(self):
+        url, data = self.admin_change_form()
+        data['status'] = 'closed'
+        self.add_response(data)
+        conflict = TicketConflict(self.ticket, self.ticket.version, self.ticket)
+
+        with mock.patch('tickets.admin.save_ticket', side_effect=conflict):
+            response = self.client.post(url, data, follow=True)
+
+        self.assertRedirects(response, url)
+        self.assertContains(response, 'nothing was saved')
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).status, 'pending')
+        self.assertFalse(TicketResponse.objects.exists())
+        self.assertFalse(LogEntry.objects.exists())
+
+    def test_admin_edit_at_the_current_version_is_saved(self):
+        url, data = self.admin_change_form()
+        data['status'] = 'closed'
+        self.add_response(data)
+
+        response = self.client.post(url, data)
+
+        self.assertRedirects(response, reverse('admin:tickets_ticket_changelist'), fetch_redirect_response=False)
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).status, 'closed')
+        self.assertEqual(TicketResponse.objects.get().message, 'Sent from the admin')
+
+
+@skipUnless(query_plans.is_supported(), 'no query plan reader for this database')
+class QueryPlanTests(TestCase):
+    """The queries of the hot pages are served by indexes: no full scans, no filesorts"""
+
+    def setUp(self):
+        self.requester = self.make_user('requester', 'user')
+        self.agent = self.make_user('agent', 'support_agent')
+        self.admin = self.make_user('boss', 'admin')
+        self.admin.is_superuser = self.admin.is_staff = True
+        self.admin.save()
+
+        category = TicketCategory.objects.create(name='General')
+        for index in range(3):
+            self.ticket = Ticket.objects.create(
+                user=self.requester, assigned_to=self.agent, category=category,
+                title=f'Ticket {index}', description='Details'
+            )
+            response = TicketResponse.objects.create(ticket=self.ticket, user=self.agent, message='On it')
+            Media.objects.create(ticket=self.ticket, response=response, user=self.agent, file='uploads/log.txt', file_type='text')
+            TicketAction.objects.create(ticket=self.ticket, performed_by=self.agent, action_type='review')
+        for index in range(3):
+            FAQKnowledgeBase.objects.create(question=f'Question {index}', answer='Answer', created_by=self.admin)
+
+    def make_user(self, username, role_name):
+        user = User.objects.create_user(username=username, password='secret')
+        user.user_meta.role, _ = Role.objects.get_or_create(name=role_name)
+        user.user_meta.is_profile_completed = True
+        user.user_meta.save()
+        return user
+
+    def assertIndexedPlans(self, user, url):
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        problems = query_plans.check_queries(context.captured_queries)
+        self.assertEqual(problems, [], f'{url}:\n' + '\n'.join(map(str, problems)))
+
+    def test_requester_pages(self):
+        self.assertIndexedPlans(self.requester, reverse('dashboard'))
+        self.assertIndexedPlans(self.requester, reverse('ticket_list'))
+        self.assertIndexedPlans(self.requester, reverse('ticket_list') + '?status=pending&priority=medium')
+        self.assertIndexedPlans(self.requester, reverse('ticket_detail', args=[self.ticket.pk]))
+
+    def test_faq_pages(self):
+        # The FAQ page reads every published FAQ once per process, by design
+        faq_index.get_index()
+        self.assertIndexedPlans(self.requester, reverse('faq'))
+        self.assertIndexedPlans(self.requester, reverse('home'))
+
+    # Fewer rows than a page would read them all without a LIMIT, unlike real data
+    @mock.patch.object(TicketAdmin, 'list_per_page', 2)
+    @mock.patch.object(FAQKnowledgeBaseAdmin, 'list_per_page', 2)
+    def test_admin_changelists(self):
+        changelist = reverse('admin:tickets_ticket_changelist')
+        self.assertIndexedPlans(self.admin, changelist)
+        self.assertIndexedPlans(self.admin, changelist + '?status__exact=pending')
+        self.assertIndexedPlans(self.agent, changelist)
+        self.assertIndexedPlans(self.agent, changelist + '?status__exact=pending')
+        self.assertIndexedPlans(self.admin, reverse('admin:tickets_faqknowledgebase_changelist'))
+
+    def test_admin_ticket_page(self):
+        self.assertIndexedPlans(self.admin, reverse('admin:tickets_ticket_change', args=[self.ticket.pk]))
+
+
+# Maximum queries per page: (viewer, url name, url arguments, query string) -> budget.
+# The count must also be the same for the small fixture and the one ten times larger.
+QUERY_BUDGETS = {
+    (None, 'home', None, ''): 1,
+    (None, 'about', None, ''): 0,
+    (None, 'contact', None, ''): 0,
+    (None, 'faq', None, ''): 0,
+    (None, 'login', None, ''): 0,
+    (None, 'register', None, ''): 0,
+    ('requester', 'dashboard', None, ''): 8,
+    ('requester', 'ticket_list', None, ''): 9,
+    ('requester', 'ticket_list', None, '?status=pending'): 9,
+    ('requester', 'ticket_detail', 'ticket', ''): 11,
+    ('requester', 'create_ticket', None, ''): 7,
+    ('requester', 'profile', None, ''): 7,
+    ('admin', 'admin:index', None, ''): 7,
+    ('admin', 'admin:tickets_ticket_changelist', None, ''): 16,
+    ('admin', 'admin:tickets_ticket_change', 'ticket', ''): 18,
+    ('admin', 'admin:tickets_ticketresponse_changelist', None, ''): 10,
+    ('admin', 'admin:tickets_ticketaction_changelist', None, ''): 10,
+    ('admin', 'admin:tickets_media_changelist', None, ''): 10,
+    ('admin', 'admin:tickets_faqknowledgebase_changelist', None, ''): 9,
+    ('admin', 'admin:tickets_ticketcategory_changelist', None, ''): 9,
+    ('admin', 'admin:tickets_role_changelist', None, ''): 9,
+    ('admin', 'admin:auth_user_changelist', None, ''): 10,
+    ('agent', 'admin:tickets_ticket_changelist', None, ''): 10,
+}
+
+
+# Cache generations are only re-checked after a local invalidation (the warm-up request does it),
+# not once a second, so the counts do not depend on timing
+@mock.patch.object(permission_cache, 'CHECK_INTERVAL', float('inf'))
+@mock.patch.object(faq_index, 'CHECK_INTERVAL', float('inf'))
+class QueryBudgetTests(TestCase):
+    """Query counts of the public views and admin pages stay within budget and do not grow with data"""
+
+    def setUp(self):
+        self.users = {
+            'requester': self.make_user('requester', 'user'),
+            'agent': self.make_user('agent', 'support_agent'),
+            'admin': self.make_user('boss', 'admin'),
+        }
+        self.users['admin'].is_superuser = self.users['admin'].is_staff = True
+        self.users['admin'].save()
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(
+            user=self.users['requester'], assigned_to=self.users['agent'], category=category,
+            title='Printer', description='Jammed'
+        )
+
+    def make_user(self, username, role_name):
+        user = User.objects.create_user(username=username, password='secret')
+        user.user_meta.role, _ = Role.objects.get_or_create(name=role_name)
+        user.user_meta.is_profile_completed = True
+        user.user_meta.save()
+        return user
+
+    def seed(self, start, units):
+        """Adds units of data touching every page: users, tickets, a thread on the ticket, FAQs"""
+        requester, agent = self.users['requester'], self.users['agent']
+        for index in range(start, start + units):
+            customer = self.make_user(f'customer{index}', 'user')
+            other_agent = self.make_user(f'agent{index}', 'support_agent')
+            category = TicketCategory.objects.create(name=f'Category {index}')
+            for owner in (requester, requester, customer):
+                Ticket.objects.create(user=owner, assigned_to=agent, category=category, title=f'Ticket {index}', description='Details')
+            for author in (requester, other_agent, customer, agent):
+                response = TicketResponse.objects.create(ticket=self.ticket, user=author, message='Reply')
+                Media.objects.create(ticket=self.ticket, response=response, user=author, file='uploads/log.txt', file_type='text')
+            Media.objects.create(ticket=self.ticket, user=customer, file='uploads/screenshot.png', file_type='image')
+            for performer in (other_agent, agent):
+                TicketAction.objects.create(ticket=self.ticket, performed_by=performer, action_type='review')
+            FAQKnowledgeBase.objects.create(question=f'Question {index}', answer='Answer', created_by=self.users['admin'])
+
+    def measure(self):
+        """Returns a QueryRecorder per page, each for a request made after a warm-up request"""
+        recorders = {}
+        for page in QUERY_BUDGETS:
+            viewer, name, argument, query = page
+            if viewer:
+                self.client.force_login(self.users[viewer])
+            else:
+                self.client.logout()
+            url = reverse(name, args=[self.ticket.pk] if argument else None) + query
+            self.client.get(url)
+            with QueryRecorder() as recorder:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            recorders[page] = recorder
+        return recorders
+
+    def test_query_counts_are_flat_and_within_budget(self):
+        self.seed(0, 1)
+        small = self.measure()
+        self.seed(1, 9)
+        large = self.measure()
+
+        for page, budget in QUERY_BUDGETS.items():
+            with self.subTest(page=page):
+                count, larger_count = len(small[page]), len(large[page])
+                self.assertEqual(larger_count, count,
+                                 f'{page}: {count} queries, {larger_count} with 10x the data\n{large[page].report()}')
+                self.assertLessEqual(count, budget, f'{page}: {count} queries, budget {budget}\n{small[page].report()}')
+
+
+class RequestProfilingTests(TestCase):
+    """Sampled request profiling reported through Server-Timing and the log"""
+
+    def setUp(self):
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.requester.user_meta.is_profile_completed = True
+        self.requester.user_meta.save()
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(user=self.requester, category=category, title='Printer', description='Jammed')
+
+    def test_off_by_default(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('home')))
+
+    @override_settings(REQUEST_PROFILING_RATE=1.0)
+    def test_profiled_request_reports_sql_templates_and_caches(self):
+        self.client.force_login(self.requester)
+        with self.assertLogs('tickets.profiling', 'INFO') as logs, CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('ticket_detail', args=[self.ticket.pk]))
+
+        record = logs.records[0].profile
+        self.assertEqual(record['view'], 'ticket_detail')
+        self.assertEqual(record['sql_count'], len(queries))
+        self.assertGreater(record['template_ms'], 0)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+
+    @override_settings(REQUEST_PROFILING_RATE=1.0)
+    def test_cache_lookups_are_counted(self):
+        faq_index.get_index()
+        with self.assertLogs('tickets.profiling', 'INFO') as logs:
+            response = self.client.get(reverse('faq'))
+
+        self.assertEqual(logs.records[0].profile['cache_hits'], {'faq_index': 1})
+        self.assertIn('cache;desc="1 hits, 0 misses"', response['Server-Timing'])
+
+
+def _record_in_child_process():
+    metrics.DB_QUERIES.inc(5, view='dashboard')
+    # A gauge left raised by a worker that exits must not count any more
+    metrics.REQUESTS_IN_FLIGHT.inc()
+
+
+class MetricsTests(TestCase):
+    """Prometheus metrics shared between worker processes"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(METRICS_DIR=directory.name, METRICS_TOKEN='scrape-token')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        store = mock.patch.object(metrics, '_store', None)
+        store.start()
+        self.addCleanup(store.stop)
+
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.requester.user_meta.is_profile_completed = True
+        self.requester.user_meta.save()
+        category = TicketCategory.objects.create(name='General')
+        Ticket.objects.create(user=self.requester, category=category, title='Printer', description='Jammed')
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode().splitlines()
+
+    def test_endpoint_requires_the_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    def test_requests_are_recorded_by_view_and_status(self):
+        self.client.force_login(self.requester)
+        self.client.get(reverse('dashboard'))
+        self.client.get(reverse('faq'))
+        self.client.logout()
+
+        lines = self.scrape()
+        self.assertIn('# TYPE tms_http_request_duration_seconds histogram', lines)
+        self.assertIn('tms_http_request_duration_seconds_count{status="200",view="dashboard"} 1.0', lines)
+        self.assertIn('tms_http_request_duration_seconds_bucket{status="200",view="dashboard",le="+Inf"} 1.0', lines)
+        self.assertTrue(any(line.startswith('tms_db_queries_total{view="dashboard"} ') for line in lines))
+        self.assertTrue(any(line.startswith('tms_cache_requests_total{cache="faq_index",') for line in lines))
+        self.assertIn('tms_ticket_queue_depth{status="pending"} 1.0', lines)
+        # The scrape itself is in flight while the metrics are rendered
+        self.assertIn('tms_http_requests_in_flight 1.0', lines)
+
+    def test_values_of_all_processes_are_added_up(self):
+        metrics.DB_QUERIES.inc(2, view='dashboard')
+        child = multiprocessing.get_context('fork').Process(target=_record_in_child_process)
+        child.start()
+        child.join()
+
+        text = metrics.render()
+        self.assertIn('tms_db_queries_total{view="dashboard"} 7.0', text)
+        self.assertIn('tms_http_requests_in_flight', text)
+        self.assertNotIn('tms_http_requests_in_flight 1.0', text)
+
+
+@override_settings(SLOW_QUERY_THRESHOLD_MS=1e-6)
+class SlowQueryLogTests(TestCase):
+    """Statements over the threshold are buffered, written in batches and grouped in the admin"""
+
+    @classmethod
+    def setUpClass(cls):
+        # The buffer is written explicitly here instead of by the background thread, which
+        # must not start even for the class's own setup statements (cleanups run last first)
+        writer = mock.patch.object(slow_queries.log, '_ensure_writer')
+        writer.start()
+        cls.addClassCleanup(writer.stop)
+        cls.addClassCleanup(slow_queries.log.take)
+        super().setUpClass()
+
+    def setUp(self):
+        self.requester = User.objects.create_user(username='requester', password='secret')
+        self.requester.user_meta.is_profile_completed = True
+        self.requester.user_meta.save()
+        category = TicketCategory.objects.create(name='General')
+        Ticket.objects.create(user=self.requester, category=category, title='Printer', description='Jammed')
+        slow_queries.log.take()
+
+    def test_normalized_sql_ignores_literals_and_list_lengths(self):
+        first = slow_queries.normalize("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'a' LIMIT 21")
+        second = slow_queries.normalize("SELECT *  FROM t WHERE id IN (%s) AND name = 'it''s' LIMIT 5")
+        self.assertEqual(first, second)
+        self.assertEqual(first, 'SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?')
+
+    def test_buffer_drops_oldest_entries_when_full(self):
+        log = slow_queries.SlowQueryLog(size=2)
+        with mock.patch.object(log, '_ensure_writer'):
+            for number in range(3):
+                log.add(number)
+        self.assertEqual(log.take(), [1, 2])
+        self.assertEqual(log.dropped, 1)
+
+    def test_slow_queries_are_recorded_with_view_and_origin(self):
+        self.client.force_login(self.requester)
+        self.client.get(reverse('ticket_list'))
+        written = slow_queries.flush()
+        # The writes of the log itself are not captured
+        self.assertEqual(slow_queries.log.take(), [])
+
+        self.assertEqual(SlowQuery.objects.count(), written)
+        entry = SlowQuery.objects.filter(view_name='ticket_list', sql__contains='tickets_ticket').first()
+        self.assertIsNotNone(entry)
+        self.assertIn('tickets/views.py', entry.stack)
+        self.assertNotIn('slow_queries.py', entry.stack)
+
+    def test_paused_statements_are_not_captured(self):
+        with slow_queries.paused():
+            list(Ticket.objects.all())
+            with slow_queries.paused():
+                pass
+            list(Ticket.objects.all())
+        self.assertEqual(slow_queries.log.take(), [])
+
+        list(Ticket.objects.all())
+        self.assertEqual(len(slow_queries.log.take()), 1)
+
+    def test_parameter_values_are_not_stored(self):
+        list(User.objects.filter(username='secret-token-value'))
+        slow_queries.flush()
+
+        entry = SlowQuery.objects.filter(sql__contains='auth_user').latest('id')
+        self.assertIn('%s', entry.sql)
+        self.assertFalse(any('secret-token-value' in str(value)
+                             for value in SlowQuery.objects.values_list().get(pk=entry.pk)))
+
+    def test_admin_groups_entries_by_fingerprint(self):
+        admin = User.objects.create_user(username='boss', password='secret', is_staff=True, is_superuser=True)
+        admin.user_meta.role, _ = Role.objects.get_or_create(name='admin')
+        admin.user_meta.is_profile_completed = True
+        admin.user_meta.save()
+        for pk in (1, 2, 3):
+            list(Ticket.objects.filter(pk=pk))
+        slow_queries.flush()
+
+        self.client.force_login(admin)
+        with override_settings(SLOW_QUERY_THRESHOLD_MS=0):
+            response = self.client.get(reverse('admin:tickets_slowquery_changelist'))
+        groups = {group['normalized_sql']: group for group in response.context['fingerprint_groups']}
+        lookup = next(sql for sql in groups if sql.startswith('SELECT') and 'WHERE "tickets_ticket"."id" = ?' in sql)
+        self.assertEqual(groups[lookup]['count'], 3)
+        self.assertContains(response, 'Slowest queries by total time')
+
+
+class SlowQueryCaptureSwitchTests(TestCase):
+    """The slow query log stays out of the way while it is off or has no table yet"""
+
+    def test_wrapper_is_only_installed_while_enabled(self):
+        connection_stub = mock.Mock(execute_wrappers=[])
+        signals.capture_slow_queries(sender=None, connection=connection_stub)
+        self.assertEqual(connection_stub.execute_wrappers, [])
+
+        # Turning it on also covers the connections already open
+        with mock.patch.object(connection, 'execute_wrappers', []), override_settings(SLOW_QUERY_THRESHOLD_MS=200):
+            self.assertEqual(connection.execute_wrappers, [slow_queries.capture])
+            signals.capture_slow_queries(sender=None, connection=connection_stub)
+        self.assertEqual(connection_stub.execute_wrappers, [slow_queries.capture])
+
+    def test_flush_drops_entries_until_the_table_exists(self):
+        log = slow_queries.SlowQueryLog()
+        with mock.patch.object(log, '_ensure_writer'):
+            log.add(slow_queries.SlowQueryEntry(timezone.now(), 300.0, 'SELECT 1', None, False, 'default', '', []))
+        found = mock.patch.object(slow_queries, '_table_found', False)
+        found.start()
+        self.addCleanup(found.stop)
+
+        with mock.patch.object(connection.introspection, 'table_names', return_value=[]):
+            self.assertEqual(slow_queries.flush(log), 0)
+
+        self.assertEqual(log.take(), [])
+        self.assertFalse(SlowQuery.objects.exists())
+        self.assertFalse(slow_queries._table_found)
+
+
+class SamplingProfilerTests(TestCase):
+    """Superusers can have single requests stack-sampled with a signed token"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(SAMPLING_PROFILES_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        interval = mock.patch.object(sampling_profiler, 'SAMPLE_INTERVAL', 0.0005)
+        interval.start()
+        self.addCleanup(interval.stop)
+
+        self.admin = User.objects.create_user(username='boss', password='secret', is_staff=True, is_superuser=True)
+        self.admin.user_meta.role, _ = Role.objects.get_or_create(name='admin')
+        self.admin.user_meta.is_profile_completed = True
+        self.admin.user_meta.save()
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(user=self.admin, category=category, title='Printer', description='Jammed')
+        self.client.force_login(self.admin)
+
+    def test_requests_without_a_valid_token_are_not_profiled(self):
+        url = reverse('admin:tickets_ticket_change', args=[self.ticket.pk])
+        self.assertNotIn('X-Profile-File', self.client.get(url))
+        self.assertNotIn('X-Profile-File', self.client.get(url, {'_profile': 'forged'}))
+        self.assertEqual(sampling_profiler.list_profiles(), [])
+
+    def test_token_of_another_user_is_rejected(self):
+        other = User.objects.create_user(username='other', is_superuser=True)
+        token = sampling_profiler.make_token(other)
+        self.assertFalse(sampling_profiler.token_is_valid(token, self.admin))
+        self.assertTrue(sampling_profiler.token_is_valid(token, other))
+
+    def test_profiled_request_writes_collapsed_stacks(self):
+        token = sampling_profiler.make_token(self.admin)
+        response = self.client.get(
+            reverse('admin:tickets_ticket_change', args=[self.ticket.pk]), HTTP_X_PROFILE_TOKEN=token,
+        )
+        name = response['X-Profile-File']
+        self.assertTrue(name.endswith('admin_tickets_ticket_change.collapsed'))
+
+        with open(sampling_profiler.profile_path(name)) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('tickets/middleware.py' in line for line in lines))
+
+        listing = self.client.get(reverse('admin:tickets_slowquery_profiles'))
+        self.assertContains(listing, name)
+        download = self.client.get(reverse('admin:tickets_slowquery_profile_download', args=[name]))
+        self.assertEqual(b''.join(download.streaming_content).decode().splitlines(), lines)
+        self.assertEqual(
+            self.client.get(reverse('admin:tickets_slowquery_profile_download', args=['settings.py'])).status_code, 404,
+        )
+
+
+class LoadTestSummaryTests(SimpleTestCase):
+    """Percentiles and baseline comparison of load-test results"""
+
+    def test_nearest_rank_percentiles(self):
+        values = [index / 1000 for index in range(1, 101)]
+        self.assertEqual(load_test.percentile(values, 50), 0.05)
+        self.assertEqual(load_test.percentile(values, 99), 0.099)
+        self.assertEqual(load_test.percentile([0.2], 95), 0.2)
+        self.assertEqual(load_test.percentile([], 95), 0.0)
+
+    def test_personas_follow_the_mix(self):
+        personas = load_test.assign_personas(10, {'requester': 70, 'agent': 20, 'admin': 10})
+        self.assertEqual(sorted(personas), ['admin'] + ['agent'] * 2 + ['requester'] * 7)
+
+    def test_regressions_against_baseline(self):
+        recorder = load_test.Recorder()
+        for seconds in (0.010, 0.012, 0.030):
+            recorder.add('dashboard', seconds, ok=True)
+        recorder.add('ticket_list', 0.5, ok=False)
+        results = load_test.summarize(recorder, elapsed=2.0)
+        self.assertEqual(results['endpoints']['dashboard']['requests'], 3)
+        self.assertEqual(results['endpoints']['dashboard']['p95_ms'], 30.0)
+        self.assertEqual(results['total']['throughput_rps'], 2.0)
+
+        baseline = {'endpoints': {
+            'dashboard': {'p95_ms': 20.0, 'error_rate': 0.0},
+            'ticket_list': {'p95_ms': 600.0, 'error_rate': 0.0},
+        }}
+        self.assertEqual(load_test.compare(results, baseline, tolerance=0.2), [
+            ('dashboard p95_ms', 20.0, 30.0),
+            ('ticket_list error_rate', 0.0, 1.0),
+        ])
+        self.assertEqual(load_test.compare(results, baseline, tolerance=0.6)[:1], [('ticket_list error_rate', 0.0, 1.0)])
+
+
+class LoadTestRunTests(LiveServerTestCase):
+    """The load_test command drives every persona's pages against a live server"""
+
+    def test_run_reports_each_url_name(self):
+        # One worker at a time: the SQLite test database is a single shared connection under the live server
+        results = {}
+        for persona in load_test.PERSONAS:
+            output = os.path.join(tempfile.mkdtemp(), 'results.json')
+            self.addCleanup(os.remove, output)
+            call_command(
+                'load_test', base_url=self.live_server_url, workers=1, duration=0.3, seed=1, mix=f'{persona}=1',
+                tickets_per_requester=2, output=output, stdout=open(os.devnull, 'w'),
+            )
+            with open(output) as f:
+                results[persona] = json.load(f)
+
+        for persona, names in [
+            ('requester', ['login', 'dashboard', 'ticket_list', 'ticket_detail']),
+            ('agent', ['login', 'admin:tickets_ticket_changelist', 'admin:tickets_ticketresponse_changelist']),
+            ('admin', ['login', 'admin:index', 'admin:tickets_ticket_change', 'admin:auth_user_changelist']),
+        ]:
+            endpoints = results[persona]['endpoints']
+            for name in names:
+                self.assertIn(name, endpoints, persona)
+            self.assertEqual(results[persona]['total']['errors'], 0, endpoints)
+            self.assertTrue(all(summary['p50_ms'] <= summary['p99_ms'] for summary in endpoints.values()))
+
+
+class SeedDataTests(TestCase):
+    """The seed_data command writes a consistent, reproducible data set without model signals"""
+
+    def seed(self, **options):
+        options = {'processes': 1, 'stdout': open(os.devnull, 'w'), **options}
+        call_command(
+            'seed_data', tickets=300, users=20, agents=4, admins=1, categories=3, responses_per_ticket=2,
+            actions_per_ticket=1, chunk_size=100, batch_size=50, seed=7, **options,
+        )
+
+    def test_seeded_rows_match_what_the_signals_would_have_done(self):
+        self.seed()
+
+        self.assertEqual(Ticket.objects.count(), 300)
+        self.assertEqual(User.objects.count(), 25)
+        self.assertEqual(UserMeta.objects.count(), 25)
+        self.assertTrue(TicketResponse.objects.exists())
+        self.assertTrue(TicketAction.objects.exists())
+        self.assertEqual(TicketCategory.objects.count(), 3)
+
+        agent = User.objects.filter(user_meta__role__name='support_agent').first()
+        self.assertTrue(agent.is_staff)
+        self.assertEqual(list(agent.groups.values_list('id', flat=True)), [Role.objects.get(name='support_agent').group_id])
+        self.assertTrue(agent.check_password('seed-password'))
+
+        ranks_match = all(Ticket.PRIORITY_RANKS[priority] == rank for priority, rank in Ticket.objects.values_list('priority', 'priority_rank'))
+        self.assertTrue(ranks_match)
+        self.assertEqual(counters.get_counts(counters.GLOBAL_KEY)['total'], 300)
+        self.assertEqual(counters.get_counts(counters.GLOBAL_KEY)['pending'], Ticket.objects.filter(status='pending').count())
+
+        # Old tickets are mostly done; creation times follow the ids
+        oldest = Ticket.objects.order_by('id')[:100]
+        self.assertGreater(sum(ticket.status in ('resolved', 'closed') for ticket in oldest), 70)
+        created = list(Ticket.objects.order_by('id').values_list('created_at', flat=True))
+        self.assertEqual(created, sorted(created))
+        self.assertLess(created[0], created[-1] - timedelta(days=300))
+
+    @skipUnless(connection.vendor == 'sqlite', 'Only SQLite is limited to one writer')
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=1e-6)
+    def test_sqlite_seeds_in_one_process_outside_the_slow_query_log(self):
+        output = io.StringIO()
+        with mock.patch.object(slow_queries.log, '_ensure_writer'):
+            slow_queries.log.take()
+            self.seed(processes=4, stdout=output)
+            self.assertEqual(slow_queries.log.take(), [])
+
+        self.assertIn('on 1 processes', output.getvalue())
+        self.assertEqual(Ticket.objects.count(), 300)
+
+    def test_chunks_are_reproducible(self):
+        self.seed()
+        plan = seeding.SeedPlan(
+            seed=7, tickets=300, first_ticket_id=1, requester_ids=range(1, 21), agent_ids=range(21, 25),
+            category_ids=(1, 2, 3), responses_per_ticket=2, actions_per_ticket=1, start=timezone.now() - timedelta(days=365),
+            end=timezone.now(), chunk_size=100, batch_size=50,
+        )
+        self.assertEqual(seeding.generate_chunk(plan, 2), seeding.generate_chunk(plan, 2))
+        self.assertNotEqual(seeding.generate_chunk(plan, 1)[0], seeding.generate_chunk(plan, 2)[0])
+        self.assertEqual(plan.chunk_count, 3)
+        self.assertEqual(list(plan.chunk_ids(2)), list(range(201, 301)))
+
+    def test_parse_count(self):
+        self.assertEqual(seeding.parse_count('5M'), 5_000_000)
+        self.assertEqual(seeding.parse_count('200k'), 200_000)
+        self.assertEqual(seeding.parse_count('1.5k'), 1500)
+        self.assertEqual(seeding.parse_count(42), 42)
+        with self.assertRaises(ValueError):
+            seeding.parse_count('1.5')
+
+
+class BenchmarkTests(TestCase):
+    """The benchmark command times every registered benchmark and leaves no rows behind"""
+
+    def test_every_benchmark_runs_and_is_rolled_back(self):
+        output = os.path.join(tempfile.mkdtemp(), 'benchmarks.json')
+        self.addCleanup(os.remove, output)
+        users = User.objects.count()
+        call_command('benchmark', number=2, repeat=1, output=output, stdout=open(os.devnull, 'w'))
+
+        with open(output) as f:
+            results = json.load(f)
+        self.assertEqual(set(results['benchmarks']), set(benchmarks.BENCHMARKS))
+        for result in results['benchmarks'].values():
+            self.assertEqual((result['number'], result['repeat']), (2, 1))
+            self.assertGreater(result['best_us'], 0)
+        self.assertEqual(User.objects.count(), users)
+        self.assertFalse(Ticket.objects.exists())
+        self.assertFalse(results['debug'])
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=1e-6)
+    def test_benchmark_statements_stay_out_of_the_slow_query_log(self):
+        with mock.patch.object(slow_queries.log, '_ensure_writer'):
+            slow_queries.log.take()
+            call_command('benchmark', 'timeline.build_timeline', number=1, repeat=1, stdout=open(os.devnull, 'w'))
+            self.assertEqual(slow_queries.log.take(), [])
+
+    def test_compare_flags_slower_benchmarks(self):
+        baseline = {'benchmarks': {'a': {'best_us': 10.0}, 'b': {'best_us': 10.0}}}
+        results = {'benchmarks': {'a': {'best_us': 11.0}, 'b': {'best_us': 13.0}, 'new': {'best_us': 1.0}}}
+        self.assertEqual(benchmarks.compare(results, baseline, tolerance=0.2), [('b', 10.0, 13.0)])
+
+
+class AttachmentStorageTests(TestCase):
+    """Attachments are stored once per content, typed from their bytes and deleted with their last reference"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media_root = override_settings(MEDIA_ROOT=directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.user = User.objects.create_user(username='requester', password='secret')
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(user=self.user, category=category, title='Printer', description='Jammed')
+
+    def attach(self, name, content):
+        return Media.objects.create(ticket=self.ticket, user=self.user, file=SimpleUploadedFile(name, content))
+
+    def test_duplicate_uploads_are_stored_once(self):
+        first = self.attach('screenshot.png', benchmarks.SAMPLE_PNG)
+        second = self.attach('renamed.txt', benchmarks.SAMPLE_PNG)
+
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertRegex(first.file.name, r'^uploads/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertEqual((first.original_name, second.original_name), ('screenshot.png', 'renamed.txt'))
+        # The type comes from the content, not from the name it was uploaded under
+        self.assertEqual((first.file_type, second.file_type), ('png', 'png'))
+        stored = StoredFile.objects.get()
+        self.assertEqual((stored.reference_count, stored.size), (2, len(benchmarks.SAMPLE_PNG)))
+        with storage.attachment_storage.open(stored.name) as f:
+            self.assertEqual(f.read(), benchmarks.SAMPLE_PNG)
+        self.assertEqual(os.listdir(storage.attachment_storage.path('uploads/.incoming')), [])
+
+    def test_file_is_deleted_with_its_last_reference(self):
+        first = self.attach('a.txt', b'log line\n')
+        second = self.attach('b.txt', b'log line\n')
+        name = first.file.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(storage.attachment_storage.exists(name))
+        self.assertEqual(StoredFile.objects.get().reference_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ticket.delete()
+        self.assertFalse(storage.attachment_storage.exists(name))
+        self.assertFalse(StoredFile.objects.exists())
+        self.assertFalse(Media.objects.filter(pk=second.pk).exists())
+
+    def test_large_uploads_are_moved_rather_than_copied(self):
+        upload = TemporaryUploadedFile('big.pdf', 'application/pdf', 0, None)
+        self.addCleanup(upload.close)
+        upload.write(b'%PDF-1.7\n' + b'x' * (3 * storage.CHUNK_SIZE))
+        upload.flush()
+        media = Media.objects.create(ticket=self.ticket, user=self.user, file=upload)
+
+        self.assertEqual(media.file_type, 'pdf')
+        self.assertFalse(os.path.exists(upload.temporary_file_path()))
+        self.assertEqual(StoredFile.objects.get().size, 9 + 3 * storage.CHUNK_SIZE)
+
+    def test_detect_type(self):
+        docx = io.BytesIO()
+        with zipfile.ZipFile(docx, 'w') as archive:
+            archive.writestr('[Content_Types].xml', '<Types/>')
+            archive.writestr('word/document.xml', '<document/>')
+        self.assertEqual(storage.detect_type(docx.getvalue()), 'docx')
+        self.assertEqual(storage.detect_type(b'PK\x03\x04rest'), 'zip')
+        self.assertEqual(storage.detect_type(b'\xff\xd8\xff\xe0'), 'jpg')
+        self.assertEqual(storage.detect_type(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'budget.xls'), 'xls')
+        self.assertEqual(storage.detect_type('café'.encode()[:-1]), 'txt')
+        self.assertEqual(storage.detect_type(b'\x00\x01\x02', 'notes.txt'), 'bin')
+
+    def test_reconcile_recounts_and_removes_unreferenced_files(self):
+        kept = self.attach('a.txt', b'kept\n')
+        dropped = self.attach('b.txt', b'dropped\n')
+        # Deleted without signals, so its reference is never released
+        Media.objects.filter(pk=dropped.pk)._raw_delete(Media.objects.db)
+        StoredFile.objects.filter(name=kept.file.name).update(reference_count=5)
+        stray = storage.attachment_storage.path(f"uploads/00/{'0' * 64}.txt")
+        os.makedirs(os.path.dirname(stray))
+        with open(stray, 'w') as f:
+            f.write('left by a rolled back upload')
+        os.utime(stray, (0, 0))
+
+        summary = storage.reconcile()
+
+        self.assertEqual(summary, {'recounted': 1, 'deleted': 1, 'stray_files': 1})
+        self.assertEqual(StoredFile.objects.get().reference_count, 1)
+        self.assertTrue(storage.attachment_storage.exists(kept.file.name))
+        self.assertFalse(storage.attachment_storage.exists(dropped.file.name))
+        self.assertFalse(os.path.exists(stray))
+
+
+class ThumbnailTests(TestCase):
+    """Image attachments get thumbnails in the background, or on their first request"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media_root = override_settings(MEDIA_ROOT=directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.user = User.objects.create_user(username='requester', password='secret')
+        category = TicketCategory.objects.create(name='General')
+        self.ticket = Ticket.objects.create(user=self.user, category=category, title='Printer', description='Jammed')
+
+    def attach(self, size=(800, 400)):
+        image = io.BytesIO()
+        Image.new('RGBA', size, (200, 30, 30, 128)).save(image, 'PNG')
+        return Media.objects.create(ticket=self.ticket, user=self.user,
+                                    file=SimpleUploadedFile('photo.png', image.getvalue()))
+
+    def thumbnail_path(self, media, size):
+        return storage.attachment_storage.path(thumbnails.thumbnail_name(media.file.name, size))
+
+    def test_thumbnails_are_rendered_in_the_background_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            media = self.attach()
+        thumbnails.pending.join()
+
+        for size, pixels in thumbnails.SIZES.items():
+            with Image.open(self.thumbnail_path(media, size)) as image:
+                self.assertEqual(image.format, 'JPEG')
+                self.assertEqual(image.size, (pixels, pixels // 2))
+
+    def test_missing_thumbnail_is_rendered_on_first_request(self):
+        media = self.attach()
+        self.client.force_login(self.user)
+        url = thumbnails.url(media, 'small')
+        self.assertFalse(os.path.exists(self.thumbnail_path(media, 'small')))
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(os.path.exists(self.thumbnail_path(media, 'small')))
+        # A stale key (the file was replaced) redirects to the current thumbnail
+        stale = reverse('media_thumbnail', args=[media.pk, 'small', '0' * 40])
+        self.assertRedirects(self.client.get(stale), url, fetch_redirect_response=False)
+
+    def test_thumbnails_are_only_shown_to_those_who_can_see_the_ticket(self):
+        media = self.attach()
+        other = User.objects.create_user(username='other', password='secret')
+        self.client.force_login(other)
+
+        self.assertEqual(self.client.get(thumbnails.url(media, 'small')).status_code, 404)
+        self.assertFalse(os.path.exists(self.thumbnail_path(media, 'small')))
+
+    def test_thumbnails_are_deleted_with_the_file(self):
+        media = self.attach()
+        thumbnails.generate_all(media.file.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            media.delete()
+
+        for size in thumbnails.SIZES:
+            self.assertFalse(os.path.exists(self.thumbnail_path(media, size)))
@@ -0,0 +1,154 @@
+"""
+Thumbnails of image attachments.
+
+Once a Media row with an image is committed, its file name is put on a
+per-process queue. A background thread (started on first use, like the
+slow query log's writer) renders every size in SIZES with Pillow. The
+thumbnail view renders any that are still missing on first request, so a
+thumbnail is never more than one slow request away.
+
+Thumbnails are JPEGs stored under the media root at
+thumbnails/<size>/<aa>/<key>.jpg, where key is derived from the source
+file's name. Stored attachment names change whenever their content does
+(see tickets.storage), so a thumbnail never goes stale. Its URL carries the
+key too and can be cached for good.
+"""
+import hashlib
+import logging
+import os
+import posixpath
+import queue as queue_module
+import tempfile
+import threading
+
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+from .storage import attachment_storage
+
+logger = logging.getLogger(__name__)
+
+# Largest side, in pixels, of each thumbnail size
+SIZES = {'small': 160, 'medium': 640}
+
+THUMBNAIL_DIR = 'thumbnails'
+JPEG_QUALITY = 85
+
+# Seconds browsers may keep a thumbnail (a year: its URL changes with the file)
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Attachments waiting for the background thread; beyond this they wait for their first request
+QUEUE_SIZE = 1000
+
+
+def key(source_name):
+    return hashlib.sha1(source_name.encode()).hexdigest()
+
+
+def thumbnail_name(source_name, size):
+    source_key = key(source_name)
+    return posixpath.join(THUMBNAIL_DIR, size, source_key[:2], f'{source_key}.jpg')
+
+
+def url(media, size='small'):
+    """The URL of a Media row's thumbnail (rendered on first request if needed)"""
+    return reverse('media_thumbnail', args=[media.pk, size, key(media.file.name)])
+
+
+def _flatten(image):
+    """Converts to RGB for JPEG, putting transparent images on white"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def generate(source_name, size):
+    """Renders one thumbnail unless it exists; returns its name, or None if the source is no readable image"""
+    name = thumbnail_name(source_name, size)
+    path = attachment_storage.path(name)
+    if os.path.exists(path):
+        return name
+    pixels = SIZES[size]
+    try:
+        with Image.open(attachment_storage.path(source_name)) as image:
+            # Lets JPEGs decode at a reduced scale instead of at full size
+            image.draft('RGB', (pixels, pixels))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((pixels, pixels), Image.Resampling.LANCZOS)
+            image = _flatten(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        logger.warning('Could not render a thumbnail of %s', source_name, exc_info=True)
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written beside the target and renamed, so readers never see half a file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return name
+
+
+def generate_all(source_name):
+    for size in SIZES:
+        generate(source_name, size)
+
+
+def delete(source_name):
+    """Removes every thumbnail of a source file"""
+    for size in SIZES:
+        attachment_storage.delete(thumbnail_name(source_name, size))
+
+
+class ThumbnailQueue:
+    """Per-process queue of image attachments waiting for thumbnails, and the thread rendering them"""
+
+    def __init__(self, size=QUEUE_SIZE):
+        self.queue = queue_module.Queue(maxsize=size)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+
+    def add(self, source_name):
+        try:
+            self.queue.put_nowait(source_name)
+        except queue_module.Full:
+            # The thumbnail view renders it on first request instead
+            self.dropped += 1
+            return
+        self._ensure_worker()
+
+    def join(self):
+        """Waits until every queued attachment has been rendered"""
+        self.queue.join()
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker_pid == os.getpid() and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name='thumbnail-renderer', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            source_name = self.queue.get()
+            try:
+                generate_all(source_name)
+            except Exception:
+                logger.exception('Could not render the thumbnails of %s', source_name)
+            finally:
+                self.queue.task_done()
+
+
+pending = ThumbnailQueue()
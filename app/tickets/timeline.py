@@ -0,0 +1,75 @@
+"""
+Activity timeline assembly for the ticket detail page.
+
+Responses, actions, their authors (with profile and role) and response
+attachments are loaded with a fixed number of queries regardless of how long
+the thread is, then merged in time order without re-sorting.
+"""
+import heapq
+from collections import defaultdict
+from operator import itemgetter
+
+from .models import Media
+
+
+def response_files(ticket):
+    """Returns the ticket's response attachments grouped by response id"""
+    files = defaultdict(list)
+    for media in Media.objects.filter(ticket=ticket, response__isnull=False).order_by('uploaded_at', 'id'):
+        files[media.response_id].append(media)
+    return files
+
+
+def response_items(ticket):
+    """Yields timeline entries for the ticket's responses, oldest first"""
+    files = response_files(ticket)
+    responses = (
+        ticket.responses
+        .select_related('user__user_meta__role')
+        .order_by('created_at', 'id')
+    )
+    for response in responses:
+        yield {
+            'type': 'response',
+            'user': response.user,
+            'content': response.message,
+            'time': response.created_at,
+            'files': files.get(response.id, []),
+            'id': response.id
+        }
+
+
+def action_items(ticket, include_notes=True):
+    """Yields timeline entries for the ticket's actions, oldest first"""
+    actions = (
+        ticket.actions
+        .select_related('performed_by__user_meta__role')
+        .order_by('created_at', 'id')
+    )
+    if not include_notes:
+        actions = actions.exclude(action_type='note')
+    for action in actions:
+        yield {
+            'type': 'action',
+            'user': action.performed_by,
+            'content': action.notes,
+            'action_type': action.get_action_type_display(),
+            'action_taken': action.action_taken,
+            'resolution_summary': action.resolution_summary,
+            'time': action.created_at,
+            'id': action.id
+        }
+
+
+def build_timeline(ticket, include_notes=True):
+    """Returns the ticket's responses and actions merged in ascending time order.
+
+    Both sources are already sorted by the database, so they are combined
+    with a streaming merge; on equal timestamps responses come first.
+    Internal notes are left out unless include_notes is set.
+    """
+    return list(heapq.merge(
+        response_items(ticket),
+        action_items(ticket, include_notes=include_notes),
+        key=itemgetter('time'),
+    ))
@@ -33,6 +33,12 @@ urlpatterns = [
     path('tickets/<int:ticket_id>/', views.ticket_detail, name='ticket_detail'),
     path('tickets/<int:ticket_id>/update-status/', views.update_ticket_status, name='update_ticket_status'),
     
+    # Attachment thumbnails (under /media/ so staff are not sent to the admin for them)
+    path('media/thumbnails/<int:media_id>/<str:size>/<str:key>.jpg', views.media_thumbnail, name='media_thumbnail'),
+    
     # Admin/Support FAQ Management
     path('manage-faq/', views.manage_faq, name='manage_faq'),
+
+    # Prometheus scrape endpoint
+    path('metrics', views.metrics_view, name='metrics'),
 ]
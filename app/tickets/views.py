@@ -1,3 +1,5 @@
+import hmac
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, views as auth_views
 from django.contrib.auth import login as auth_login
@@ -5,14 +7,22 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
 from django.db.models import Q
-from django.http import JsonResponse, HttpResponseForbidden
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, HttpResponseForbidden
 from .models import Role, UserMeta, TicketCategory, Ticket, TicketResponse, TicketAction, FAQKnowledgeBase, Media
+from . import assignment, counters, metrics, search, faq_index, thumbnails
+from .access import get_access, resolve_access
+from .storage import attachment_storage
+from .concurrency import TicketConflict, parse_version, save_ticket
+from .timeline import build_timeline
+from .pagination import paginate, paginate_ranked, approximate_count, filter_querystring
 from .forms import (
     CustomerRegistrationForm, CustomLoginForm, UserProfileForm, TicketForm,
     TicketResponseForm, TicketActionForm, MediaUploadForm, FAQForm
 )
-from django.core.paginator import Paginator
 from django.utils import timezone
+from django.conf import settings
+
+CONFLICT_MESSAGE = 'This ticket was changed by someone else while you were viewing it. Please review the latest version and try again.'
 
 # Landing page view
 def home(request):
@@ -79,44 +89,29 @@ def profile(request):
 @login_required(login_url='login')
 def dashboard(request):
     user = request.user
-    role = user.user_meta.role.name.lower()
+    access = get_access(request)
+    role = access.role
     
-    # Get ticket statistics based on user role
-    if role == 'admin':
+    # Get ticket statistics based on user role from the maintained counters
+    if access.is_admin:
         # For admin, show all tickets and stats
-        stats = {
-            'total': Ticket.objects.count(),
-            'pending': Ticket.objects.filter(status='pending').count(),
-            'in_progress': Ticket.objects.filter(status='in_progress').count(),
-            'resolved': Ticket.objects.filter(status='resolved').count(),
-            'closed': Ticket.objects.filter(status='closed').count(),
-        }
-        tickets = Ticket.objects.all().order_by('-created_at')[:10]  # Recent 10 tickets for admin
+        stats = counters.get_counts(counters.GLOBAL_KEY)
+        tickets = Ticket.objects.select_related('user', 'category', 'assigned_to')
         
-    elif role == 'support_agent':
+    elif access.is_support_agent:
         # For support agents, show only assigned tickets
-        assigned_tickets = Ticket.objects.filter(assigned_to=user)
-        stats = {
-            'total': assigned_tickets.count(),
-            'pending': assigned_tickets.filter(status='pending').count(),
-            'in_progress': assigned_tickets.filter(status='in_progress').count(),
-            'resolved': assigned_tickets.filter(status='resolved').count(),
-            'closed': assigned_tickets.filter(status='closed').count(),
-        }
-        tickets = assigned_tickets.order_by('-created_at')[:10]  # Recent 10 assigned tickets
+        stats = counters.get_counts(counters.agent_key(user.id))
+        tickets = Ticket.objects.filter(assigned_to=user).select_related('user', 'category')
         
     else:  # User
         # For users, show only their own tickets
-        user_tickets = Ticket.objects.filter(user=user)
-        stats = {
-            'total': user_tickets.count(),
-            'pending': user_tickets.filter(status='pending').count(),
-            'in_progress': user_tickets.filter(status='in_progress').count(),
-            'resolved': user_tickets.filter(status='resolved').count(),
-            'closed': user_tickets.filter(status='closed').count(),
-        }
-        tickets = user_tickets.order_by('-created_at')  # All user tickets, newest first
+        stats = counters.get_counts(counters.requester_key(user.id))
+        tickets = Ticket.objects.filter(user=user).select_related('category', 'assigned_to')
         
+    # Most recent tickets first, 10 per page
+    tickets = paginate(tickets, request.GET.get('cursor'))
+    tickets.total, tickets.total_is_exact = stats['total'], True
+    
     # Prepare context for the template
     context = {
         'user': user,
@@ -127,12 +122,13 @@ def dashboard(request):
         'in_progress_count': stats['in_progress'],
         'resolved_count': stats['resolved'],
         'closed_count': stats.get('closed', 0),  # Use get to handle if closed isn't in stats
+        'filter_query': filter_querystring(request),
     }
     
     # Add website_contents to context if user is admin
-    if role == 'admin':
+    if access.is_admin:
         return render(request, 'tickets/dashboard_admin.html', context)
-    elif role == 'support_agent':
+    elif access.is_support_agent:
         return render(request, 'tickets/dashboard_support.html', context)
     else:  # User
         return render(request, 'tickets/dashboard.html', context)
@@ -141,15 +137,19 @@ def dashboard(request):
 def ticket_list(request):
     """View for listing tickets with filtering and search capabilities"""
     user = request.user
-    role = user.user_meta.role.name
+    access = get_access(request)
+    role = access.role
     
-    # Base queryset depends on user role
-    if role == 'admin':
+    # Base queryset depends on user role; each scope has its own status counters
+    if access.is_admin:
         tickets = Ticket.objects.all()
-    elif role == 'support':
+        counter_key = counters.GLOBAL_KEY
+    elif access.is_support_agent:
         tickets = Ticket.objects.filter(assigned_to=user)
+        counter_key = counters.agent_key(user.id)
     else:  # User
         tickets = Ticket.objects.filter(user=user)
+        counter_key = counters.requester_key(user.id)
     
     # Get all categories for the filter dropdown
     categories = TicketCategory.objects.all()
@@ -171,19 +171,21 @@ def ticket_list(request):
         tickets = tickets.filter(category_id=category)
     
     if search_query:
-        tickets = tickets.filter(
-            Q(title__icontains=search_query) | 
-            Q(description__icontains=search_query) |
-            Q(id__icontains=search_query)
-        )
-    
-    # Order by most recent
-    tickets = tickets.order_by('-created_at')
-    
-    # Pagination
-    paginator = Paginator(tickets, 10)  # Show 10 tickets per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+        # Ranked full-text search; "TKT-0042" or "#42" is a direct id lookup
+        ranked_ids = search.search_tickets(search_query, tickets)
+        page_obj = paginate_ranked(tickets.select_related('category'), ranked_ids, request.GET.get('cursor'))
+        page_obj.total = len(ranked_ids)
+        page_obj.total_is_exact = len(ranked_ids) < search.DEFAULT_LIMIT
+    else:
+        # Keyset pagination, most recent first (no COUNT(*) or OFFSET scans)
+        page_obj = paginate(tickets.select_related('category'), request.GET.get('cursor'))
+        
+        # Totals come from the status counters when possible, otherwise a capped count
+        if not (priority or category) and (not status or status in counters.STATUS_FIELDS):
+            page_obj.total = counters.get_counts(counter_key)[status or 'total']
+            page_obj.total_is_exact = True
+        else:
+            page_obj.total, page_obj.total_is_exact = approximate_count(tickets)
     
     context = {
         'tickets': page_obj,
@@ -192,6 +194,7 @@ def ticket_list(request):
         'priority': priority,
         'category': category,
         'search_query': search_query,
+        'filter_query': filter_querystring(request),
         'role': role
     }
     
@@ -200,7 +203,7 @@ def ticket_list(request):
 # Create ticket view
 @login_required(login_url='login')
 def create_ticket(request):
-    if not hasattr(request.user, 'user_meta') or not request.user.user_meta.is_profile_completed:
+    if not get_access(request).is_profile_completed:
         messages.warning(request, 'Please complete your profile first.')
         return redirect('profile')
         
@@ -213,6 +216,10 @@ def create_ticket(request):
             ticket.user = request.user
             ticket.save()
             
+            # Hand new tickets to the least-loaded support agent when enabled
+            if settings.TICKET_AUTO_ASSIGN:
+                assignment.assign_new_ticket(ticket)
+            
             # Save multiple attachments if provided
             files = request.FILES.getlist('attachments')
             allowed_extensions = ['jpg', 'jpeg', 'png', 'gif', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'txt']
@@ -224,12 +231,11 @@ def create_ticket(request):
                 
                 # Validate file type
                 if extension in allowed_extensions:
-                    # Create the media object with file type info
+                    # Streamed into the deduplicating store; file_type comes from the content
                     Media.objects.create(
                         file=file,
                         ticket=ticket,
-                        user=request.user,
-                        file_type=extension
+                        user=request.user
                     )
                 else:
                     messages.warning(request, f'File {filename} was not uploaded. Only {", ".join(allowed_extensions)} files are allowed.')
@@ -256,18 +262,19 @@ def create_ticket(request):
 # Ticket detail view
 @login_required(login_url='login')
 def ticket_detail(request, ticket_id):
-    ticket = get_object_or_404(Ticket, id=ticket_id)
+    ticket = get_object_or_404(Ticket.objects.select_related('user', 'assigned_to', 'category'), id=ticket_id)
     
     # Check permission to view this ticket based on role
-    role = request.user.user_meta.role.name.lower()
+    access = get_access(request)
+    role = access.role
     
     # Users can only view their own tickets
-    if role == 'user' and ticket.user != request.user:
+    if role == 'user' and ticket.user_id != request.user.id:
         messages.error(request, "You don't have permission to view this ticket.")
         return redirect('ticket_list')
     
     # Support agents can only view tickets assigned to them
-    if role == 'support_agent' and ticket.assigned_to != request.user:
+    if access.is_support_agent and ticket.assigned_to_id != request.user.id:
         messages.error(request, "You can only view tickets assigned to you.")
         return redirect('ticket_list')
     
@@ -290,6 +297,7 @@ def ticket_detail(request, ticket_id):
                     Media.objects.create(
                         file=file,
                         ticket=ticket,
+                        response=response,
                         user=request.user
                     )
                 
@@ -303,16 +311,20 @@ def ticket_detail(request, ticket_id):
                     )
                 
                 # Update ticket status if it was pending and a support agent responded
-                if ticket.status == 'pending' and role in ['admin', 'support_agent']:
+                # (skipped if someone else changed the ticket meanwhile)
+                if ticket.status == 'pending' and access.is_staff_role:
                     ticket.status = 'in_progress'
-                    ticket.save()
-                    messages.info(request, 'Ticket status automatically updated to In Progress.')
+                    try:
+                        save_ticket(ticket, ['status'])
+                        messages.info(request, 'Ticket status automatically updated to In Progress.')
+                    except TicketConflict:
+                        pass
                 
                 messages.success(request, 'Your response has been added successfully.')
                 return redirect('ticket_detail', ticket_id=ticket.id)
         
         # Process action form (admin/support only)
-        elif form_type == 'action' and role in ['admin', 'support_agent']:
+        elif form_type == 'action' and access.is_staff_role:
             action_form = TicketActionForm(request.POST)
             if action_form.is_valid():
                 # Create the action record
@@ -324,7 +336,11 @@ def ticket_detail(request, ticket_id):
                 action_type = action.action_type
                 if action_type in ['resolve', 'close']:
                     ticket.status = 'resolved' if action_type == 'resolve' else 'closed'
-                    ticket.save()
+                    try:
+                        save_ticket(ticket, ['status'], parse_version(request.POST.get('version'), ticket.version))
+                    except TicketConflict:
+                        messages.error(request, CONFLICT_MESSAGE)
+                        return redirect('ticket_detail', ticket_id=ticket.id)
                     messages.success(request, f'Ticket status updated to {ticket.get_status_display()}')
                     
                 # Log the action
@@ -340,36 +356,10 @@ def ticket_detail(request, ticket_id):
     
     # Gather ticket information
     responses = ticket.responses.all().order_by('created_at')
-    actions = ticket.actions.all().order_by('-created_at')
-    ticket_files = Media.objects.filter(ticket=ticket)
-    
-    # Create activity timeline (combine responses and actions, sorted by time)
-    timeline_items = []
-    for response in responses:
-        timeline_items.append({
-            'type': 'response',
-            'user': response.user,
-            'content': response.message,
-            'time': response.created_at,
-            'files': Media.objects.filter(ticket=ticket, user=response.user),
-            'id': response.id
-        })
-    
-    for action in actions:
-        if action.action_type != 'note' or role in ['admin', 'support_agent']:  # Show notes only to staff
-            timeline_items.append({
-                'type': 'action',
-                'user': action.performed_by,
-                'content': action.notes,
-                'action_type': action.get_action_type_display(),
-                'action_taken': action.action_taken,
-                'resolution_summary': action.resolution_summary,
-                'time': action.created_at,
-                'id': action.id
-            })
-    
-    # Sort timeline by time (ascending)
-    timeline_items.sort(key=lambda x: x['time'])
+    ticket_files = Media.objects.filter(ticket=ticket, response__isnull=True).select_related('user')
+    
+    # Create activity timeline (responses and actions merged by time, notes only for staff)
+    timeline_items = build_timeline(ticket, include_notes=access.is_staff_role)
     
     context = {
         'ticket': ticket,
@@ -389,33 +379,42 @@ def update_ticket_status(request, ticket_id):
     ticket = get_object_or_404(Ticket, id=ticket_id)
     
     # Check if user has permission to update the ticket
-    user_meta = request.user.user_meta
-    role = user_meta.role.name if user_meta.role else 'user'
+    access = get_access(request)
     
-    if role not in ['support', 'admin'] or (role == 'support' and ticket.assigned_to != request.user):
+    if not access.is_staff_role or (access.is_support_agent and ticket.assigned_to_id != request.user.id):
         return HttpResponseForbidden("You don't have permission to update this ticket.")
     
     if request.method == 'POST':
+        # Both changes are written together, only if nobody saved the ticket since the form was shown
+        changed = []
         new_status = request.POST.get('status')
         if new_status in [status[0] for status in Ticket.STATUS_CHOICES]:
             ticket.status = new_status
-            ticket.save()
-            messages.success(request, f'Ticket status updated to {dict(Ticket.STATUS_CHOICES)[new_status]}.')
+            changed.append('status')
         
         # If the ticket is being assigned
-        if 'assigned_to' in request.POST and role == 'admin':
+        if 'assigned_to' in request.POST and access.is_admin:
             agent_id = request.POST.get('assigned_to')
             if agent_id:
-                from django.contrib.auth.models import User
                 try:
                     agent = User.objects.get(id=agent_id)
                     # Check if agent has support role
-                    if hasattr(agent, 'user_meta') and agent.user_meta.role and agent.user_meta.role.name == 'support':
+                    if resolve_access(agent).is_support_agent:
                         ticket.assigned_to = agent
-                        ticket.save()
-                        messages.success(request, f'Ticket assigned to {agent.username}.')
+                        changed.append('assigned_to')
                 except User.DoesNotExist:
                     messages.error(request, 'Selected support agent does not exist.')
+        
+        if changed:
+            try:
+                save_ticket(ticket, changed, parse_version(request.POST.get('version'), ticket.version))
+            except TicketConflict:
+                messages.error(request, CONFLICT_MESSAGE)
+                return redirect('ticket_detail', ticket_id=ticket.id)
+            if 'status' in changed:
+                messages.success(request, f'Ticket status updated to {dict(Ticket.STATUS_CHOICES)[new_status]}.')
+            if 'assigned_to' in changed:
+                messages.success(request, f'Ticket assigned to {ticket.assigned_to.username}.')
     
     return redirect('ticket_detail', ticket_id=ticket.id)
 
@@ -425,28 +424,18 @@ def faq(request):
     query = request.GET.get('q', None)
     category = request.GET.get('category', None)
     
-    # Base queryset - only show published FAQs
-    faqs = FAQKnowledgeBase.objects.filter(is_published=True)
+    # Search the in-memory index of published FAQs (no per-request queries)
+    index = faq_index.get_index()
+    if category == 'all':
+        category = None
+    faqs = index.search(query, category=category)
     
-    # Apply search if query provided
+    # Keep ranked results grouped by category for the template's regroup
     if query:
-        faqs = faqs.filter(Q(question__icontains=query) | Q(answer__icontains=query))
-    
-    # Apply category filter if provided
-    if category and category != 'all':
-        faqs = faqs.filter(category=category)
-    
-    # Get distinct categories for the filter - use set to ensure uniqueness
-    category_values = set(FAQKnowledgeBase.objects.filter(is_published=True).values_list('category', flat=True))
-    category_choices = dict(FAQKnowledgeBase.CATEGORY_CHOICES)
+        faqs.sort(key=lambda faq: faq.category)
     
-    # Only display categories that have FAQs
-    available_categories = []
-    for cat in category_values:
-        available_categories.append((cat, category_choices.get(cat, cat)))
-    
-    # Sort categories by their display name for consistent ordering
-    available_categories.sort(key=lambda x: x[1])
+    # Only display categories that have FAQs, sorted by display name
+    available_categories = index.categories
     
     context = {
         'faqs': faqs,
@@ -457,13 +446,43 @@ def faq(request):
     
     return render(request, 'tickets/faq.html', context)
 
+# Attachment thumbnail, rendered here if the background thread has not got to it yet
+@login_required(login_url='login')
+def media_thumbnail(request, media_id, size, key):
+    media = get_object_or_404(Media.objects.select_related('ticket', 'response__ticket'), id=media_id)
+    if size not in thumbnails.SIZES or not media.is_image:
+        raise Http404
+    # The key names the file the thumbnail was made from; a replaced file gets a new URL
+    if key != thumbnails.key(media.file.name):
+        return redirect(thumbnails.url(media, size))
+    
+    # Visible to whoever may see the ticket: its requester, its agent, and staff working in the admin
+    ticket = media.ticket or (media.response.ticket if media.response else None)
+    participants = {ticket.user_id, ticket.assigned_to_id} if ticket else set()
+    if request.user.id not in participants and not (request.user.is_staff and request.user.has_perm('tickets.view_ticket')):
+        raise Http404
+    
+    name = thumbnails.generate(media.file.name, size)
+    if name is None:
+        raise Http404
+    response = FileResponse(attachment_storage.open(name), content_type='image/jpeg')
+    response['Cache-Control'] = f'private, max-age={thumbnails.CACHE_MAX_AGE}, immutable'
+    return response
+
+# Prometheus metrics of all worker processes, for scrapers holding METRICS_TOKEN
+def metrics_view(request):
+    token = settings.METRICS_TOKEN
+    if not token:
+        raise Http404
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        return HttpResponseForbidden('Invalid metrics token')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # Admin FAQ management view
 @login_required(login_url='login')
 def manage_faq(request):
-    user_meta = request.user.user_meta
-    role = user_meta.role.name if user_meta.role else 'user'
-    
-    if role not in ['admin', 'support']:
+    if not get_access(request).is_staff_role:
         return HttpResponseForbidden("You don't have permission to manage FAQs.")
     
     faqs = FAQKnowledgeBase.objects.all().order_by('-created_at')
@@ -490,20 +509,12 @@ def login_view(request):
             auth_login(request, user)
             
             # Redirect based on user role
-            try:
-                role = user.user_meta.role.name.lower()
-                if role in ['admin', 'support_agent']:
-                    # Admins and support agents go directly to admin panel
-                    messages.success(request, f'Welcome back, {user.username}!')
-                    return redirect('/admin/')
-                else:
-                    # Users go to dashboard
-                    messages.success(request, f'Welcome back, {user.username}!')
-                    return redirect('dashboard')
-            except:
-                # Default to dashboard if role check fails
-                messages.success(request, f'Welcome back, {user.username}!')
-                return redirect('dashboard')
+            messages.success(request, f'Welcome back, {user.username}!')
+            if get_access(request).is_staff_role:
+                # Admins and support agents go directly to admin panel
+                return redirect('/admin/')
+            # Users go to dashboard
+            return redirect('dashboard')
         else:
             messages.error(request, 'Invalid username or password.')
     else:
@@ -512,21 +523,16 @@ def login_view(request):
 
 # Helper function to redirect users based on their role
 def redirect_based_on_role(request):
-    try:
-        role = request.user.user_meta.role.name.lower()
-        
-        # Redirect support agents and admins to admin interface
-        if role in ['support_agent', 'admin']:
-            messages.info(request, f'{role.capitalize()} users should use the admin interface.')
-            return redirect('/admin/')
-        
-        # Redirect users to dashboard
-        elif role == 'user':
-            return redirect('dashboard')
-        
-        # Default fallback
-        else:
-            return redirect('home')
-    except Exception as e:
-        # If role lookup fails, default to dashboard
-        return redirect('home')
+    access = get_access(request)
+    
+    # Redirect support agents and admins to admin interface
+    if access.is_staff_role:
+        messages.info(request, f'{access.role.capitalize()} users should use the admin interface.')
+        return redirect('/admin/')
+    
+    # Redirect users to dashboard
+    elif access.role == 'user':
+        return redirect('dashboard')
+    
+    # Default fallback (also when the role lookup fails)
+    return redirect('home')
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import tempfile
 from pathlib import Path
 from decouple import config
 
@@ -59,11 +60,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tickets.middleware.MetricsMiddleware',  # Request latency and query metrics for /metrics
+    'tickets.middleware.SlowQueryViewMiddleware',  # Names the view on captured slow queries
+    'tickets.middleware.RequestProfilingMiddleware',  # Sampled request profiling (off unless REQUEST_PROFILING_RATE > 0)
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'tickets.middleware.SamplingProfilerMiddleware',  # Stack sampling of requests with a superuser's profiling token
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'tickets.middleware.ProfileCompletionMiddleware',  # Add profile completion middleware
@@ -74,7 +79,7 @@ ROOT_URLCONF = 'tms.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'tickets.profiling.ProfiledDjangoTemplates',  # DjangoTemplates that reports render time to the profiler
         'DIRS': [BASE_DIR / 'templates'],  # Add templates directory
         'APP_DIRS': True,
         'OPTIONS': {
@@ -168,6 +173,29 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Authentication backend with cross-request caching of permission checks
+AUTHENTICATION_BACKENDS = ['tickets.backends.CachedModelBackend']
+
+# Assign new tickets to the least-loaded support agent on creation
+TICKET_AUTO_ASSIGN = config('TICKET_AUTO_ASSIGN', default=False, cast=bool)
+
+# Share of requests profiled by RequestProfilingMiddleware (0 disables it, 1 profiles every request)
+REQUEST_PROFILING_RATE = config('REQUEST_PROFILING_RATE', default=0.0, cast=float)
+
+# Directory of the per-process metric files read by /metrics (emptied by start.sh)
+METRICS_DIR = config('METRICS_DIR', default=os.path.join(tempfile.gettempdir(), 'tms-metrics'))
+
+# Bearer token Prometheus sends to /metrics (the endpoint answers 404 while unset)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# Statements taking this many milliseconds or more go to the slow query log (0 disables it).
+# The test suite turns it off, and until migrate has created the SlowQuery table the
+# captured statements are dropped
+SLOW_QUERY_THRESHOLD_MS = config('SLOW_QUERY_THRESHOLD_MS', default=200.0, cast=float)
+
+# Directory of the request profiles written by the sampling profiler
+SAMPLING_PROFILES_DIR = config('SAMPLING_PROFILES_DIR', default=os.path.join(tempfile.gettempdir(), 'tms-profiles'))
+
 # Login/Logout redirect URLs
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGOUT_REDIRECT_URL = 'home'